@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# Copyright (c) Marius Gheorghescu. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for full license information.
+#
+# Throughput benchmarks for CurrentViewer, runs against the simulated CurrentRanger (no hardware needed):
+#   parse   - bulk line parser throughput (lines/second)
+#   ingest  - max sustained SPS through the pty + serialStream acquisition loop
+#   devices - aggregate SPS with several simulated devices captured at once (one reader thread each)
+#   serve   - capture SPS and frames delivered with streaming clients attached (--serve)
+#   decimate- per frame decimation cost for each chart decimation mode and buffer size
+#   draw    - per frame update + Agg draw time of the live chart, with and without blitting
+#   memory  - bytes per buffered sample (ring buffer + aggregate pyramid)
+#   startup - import time and RSS of the headless path vs. with the GUI modules, time to the first sample with -g
+import sys
+import os
+import signal
+import subprocess
+import time
+import json
+import argparse
+import platform
+import logging
+import io
+import contextlib
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import current_viewer as cv
+
+# the benchmarks run current_viewer.py from the repo directory, wherever they are launched from
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def bench_parse(lines=200000):
+    simulator = cv.SimulatedRanger(rate=1000, seed=1, corrupt_rate=0.0)
+    chunk = simulator.encode(simulator.samples(np.arange(lines)))
+
+    start = time.perf_counter()
+    values, control, invalid, remainder = cv.parse_chunk(chunk)
+    elapsed = time.perf_counter() - start
+    return {"lines": lines, "lines_per_second": lines/elapsed}
+
+
+def bench_ingest(rates, duration):
+    results = []
+    for rate in rates:
+        simulator = cv.SimulatedRanger(rate=rate, seed=1)
+        port = simulator.start()
+        csp = cv.CRPlot(sample_buffer=max(rate*int(duration + 2), 1000))
+        # the acquisition loop reports progress on the console, keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            connected = csp.serialStart(port=port)
+        if not connected:
+            simulator.stop()
+            raise RuntimeError("Could not connect to the simulated device on {}".format(port))
+
+        start_count, start_sent = csp.sample_count, simulator.sent_samples
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            time.sleep(duration)
+            received = (csp.sample_count - start_count)/(time.perf_counter() - start)
+            sent = simulator.sent_samples - start_sent
+            csp.close()
+        simulator.stop()
+
+        # sustained: everything that was sent was received (within the in-flight margin) and nothing overflowed
+        sustained = simulator.dropped_bytes == 0 and received >= 0.98*sent/duration
+        results.append({"rate": rate, "received_sps": received, "dropped_bytes": simulator.dropped_bytes, "sustained": sustained})
+        print("  ingest {:>7} SPS: received {:>10.1f} SPS, dropped {} bytes{}".format(rate, received, simulator.dropped_bytes, "" if sustained else "  <- not sustained"))
+
+    sustained = [result["rate"] for result in results if result["sustained"]]
+    return {"max_sustained_sps": max(sustained) if sustained else 0, "runs": results}
+
+
+def bench_devices(counts, rate, duration):
+    results = []
+    for count in counts:
+        simulators = [cv.SimulatedRanger(rate=rate, seed=i) for i in range(count)]
+        devices = [cv.CRPlot(sample_buffer=max(rate*int(duration + 2), 1000), name=str(i), device=i) for i in range(count)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            connected = all([device.serialStart(port=simulator.start()) for device, simulator in zip(devices, simulators)])
+        if not connected:
+            for simulator in simulators:
+                simulator.stop()
+            raise RuntimeError("Could not connect to the simulated devices")
+
+        start_count = sum(device.sample_count for device in devices)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            time.sleep(duration)
+            received = (sum(device.sample_count for device in devices) - start_count)/(time.perf_counter() - start)
+            for device in devices:
+                device.close()
+        dropped = sum(simulator.dropped_bytes for simulator in simulators)
+        for simulator in simulators:
+            simulator.stop()
+
+        results.append({"devices": count, "rate": rate, "received_sps": received, "dropped_bytes": dropped, "scaling": received/(count*rate)})
+        print("  devices {:>2} x {:>6} SPS: received {:>10.1f} SPS ({:.0%} of linear), dropped {} bytes".format(count, rate, received, received/(count*rate), dropped))
+    return results
+
+
+def bench_serve(counts, rate, duration):
+    results = []
+    for count in counts:
+        simulator = cv.SimulatedRanger(rate=rate, seed=1)
+        csp = cv.CRPlot(sample_buffer=max(rate*int(duration + 2), 1000))
+        with contextlib.redirect_stdout(io.StringIO()):
+            connected = csp.serialStart(port=simulator.start())
+        if not connected:
+            simulator.stop()
+            raise RuntimeError("Could not connect to the simulated device")
+        server = cv.StreamServer([csp], port=0)
+        # half the clients at one resolution, half at another, plus one raw subscriber
+        clients = [cv.StreamClient("127.0.0.1", server.address[1], points=(1024 if i % 2 else 256), frames=True, raw=(i == 0), timeout=0.1) for i in range(count)]
+        frames = [0]*count
+
+        start_count = csp.sample_count
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            while time.perf_counter() - start < duration:
+                for i, client in enumerate(clients):
+                    message = client.receive()
+                    frames[i] += message != None and message[0] == "frame"
+            received = (csp.sample_count - start_count)/(time.perf_counter() - start)
+            for client in clients:
+                client.close()
+            server.close()
+            csp.close()
+        simulator.stop()
+
+        results.append({"clients": count, "rate": rate, "received_sps": received, "dropped_bytes": simulator.dropped_bytes, "frames_per_client": sum(frames)/max(1, count)/duration})
+        print("  serve {:>3} clients: received {:>10.1f} SPS, dropped {} bytes, {:.1f} frames/s per client".format(count, received, simulator.dropped_bytes, sum(frames)/max(1, count)/duration))
+    return results
+
+
+def filled_buffer(size):
+    buffer = cv.SampleBuffer(size)
+    simulator = cv.SimulatedRanger(rate=1000, seed=1)
+    timestamps = np.arange(size, dtype=np.int64)*1000000
+    buffer.extend(timestamps, np.maximum(simulator.samples(np.arange(size)), 1.0e-11))
+    return buffer
+
+
+def bench_decimate(sizes, repeat=10):
+    results = []
+    for size in sizes:
+        window_ts, window_data = filled_buffer(size).last()
+        for mode in cv.decimation_modes:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                if mode == 'MINMAX':
+                    cv.decimate_minmax(window_ts, window_data, cv.chart_max_samples)
+                elif mode == 'LTTB':
+                    cv.decimate_lttb(window_ts, window_data, cv.chart_max_samples)
+                else:
+                    cv.decimate(window_ts, window_data, cv.chart_max_samples, cv.max_supersampling, mode == 'MEDIAN')
+            elapsed = (time.perf_counter() - start)/repeat
+            results.append({"samples": size, "mode": mode, "ms_per_frame": 1000*elapsed})
+            print("  decimate {:>9} samples {:<6}: {:8.2f} ms/frame".format(size, mode, 1000*elapsed))
+    return results
+
+
+def bench_draw(size, blit, frames=50, rate=1000):
+    from datetime import datetime
+    cv.chart_blit = blit
+    csp = cv.CRPlot(sample_buffer=size)
+    simulator = cv.SimulatedRanger(rate=rate, seed=1)
+    now = np.datetime64(datetime.now(), 'ns').astype(np.int64)
+    step = 1000000000//rate
+    csp.buffer.extend(now - (size - np.arange(size, dtype=np.int64))*step, np.maximum(simulator.samples(np.arange(size)), 1.0e-11))
+    csp.dataStartTS = datetime.now()
+    csp.chartSetup(refresh_interval=cv.refresh_interval)
+    canvas = csp.ax.figure.canvas
+    canvas.draw()
+
+    # one refresh interval worth of new samples per frame, like a live stream
+    per_frame = rate*cv.refresh_interval//1000
+    full_draws = 0
+    elapsed = 0.0
+    for frame in range(frames):
+        last = int(csp.buffer.last(1)[0][0])
+        csp.buffer.extend(last + step*np.arange(1, per_frame + 1, dtype=np.int64), np.maximum(simulator.samples(np.arange(per_frame)), 1.0e-11))
+        full_draws += csp.redraw_needed or not blit
+        start = time.perf_counter()
+        csp.refreshChart()
+        elapsed += time.perf_counter() - start
+    cv.plt.close(csp.ax.figure)
+    return {"samples": size, "blit": blit, "frame_ms": 1000*elapsed/frames, "full_redraws": int(full_draws), "frames": frames}
+
+
+def bench_memory(size):
+    tracemalloc.start()
+    buffer = filled_buffer(size)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"samples": len(buffer), "bytes_per_sample": current/len(buffer)}
+
+
+# import time and peak RSS in a fresh interpreter, with or without the GUI modules. The peak is read from
+# /proc (VmHWM) on Linux: ru_maxrss would include the benchmark process the interpreter was forked from.
+def measure_import(gui):
+    script = ("import time, resource, platform\n"
+              "start = time.perf_counter()\n"
+              "import current_viewer\n"
+              + ("current_viewer.import_gui()\n" if gui else "") +
+              "elapsed = time.perf_counter() - start\n"
+              "if platform.system() == 'Linux':\n"
+              "    peak = next(int(line.split()[1])*1024 for line in open('/proc/self/status') if line.startswith('VmHWM'))\n"
+              "else:\n"
+              "    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+              "print(elapsed, peak)\n")
+    seconds, peak = subprocess.run([sys.executable, "-c", script], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.split()
+    return float(seconds), int(peak)
+
+
+# wall time from launching a -g capture of a simulated device until it streams, and its RSS (Linux)
+def measure_headless_start():
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(repo_dir, "current_viewer.py"), "--simulate", "1000", "-g", "-n", "--summary-interval", "0"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    for line in process.stdout:
+        if line.startswith("Running with no GUI"):
+            break
+    elapsed = time.perf_counter() - start
+    # RSS after a second of streaming
+    time.sleep(1)
+    rss = None
+    with contextlib.suppress(OSError):
+        with open("/proc/{}/status".format(process.pid)) as f:
+            rss = next(int(line.split()[1])*1024 for line in f if line.startswith("VmRSS"))
+    process.send_signal(signal.SIGINT)
+    process.communicate(timeout=30)
+    return elapsed, rss
+
+
+def bench_startup(repeat=3):
+    headless = [measure_import(False) for _ in range(repeat)]
+    gui = [measure_import(True) for _ in range(repeat)]
+    started = [measure_headless_start() for _ in range(repeat)]
+    result = {"import_seconds": min(run[0] for run in headless), "import_rss_bytes": min(run[1] for run in headless),
+              "gui_import_seconds": min(run[0] for run in gui), "gui_import_rss_bytes": min(run[1] for run in gui),
+              "first_sample_seconds": min(run[0] for run in started), "streaming_rss_bytes": min((run[1] for run in started if run[1]), default=None)}
+    print("  startup: import {:.0f} ms, {:.1f} MB RSS (with the GUI modules {:.0f} ms, {:.1f} MB)".format(1000*result["import_seconds"], result["import_rss_bytes"]/1.0e6, 1000*result["gui_import_seconds"], result["gui_import_rss_bytes"]/1.0e6))
+    print("  startup: -g capture streaming after {:.0f} ms{}".format(1000*result["first_sample_seconds"], ", {:.1f} MB RSS".format(result["streaming_rss_bytes"]/1.0e6) if result["streaming_rss_bytes"] else ""))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CurrentViewer throughput benchmarks (simulated device)")
+    parser.add_argument("--rates", metavar='<sps>', type=int, nargs='+', default=[1000, 5000, 20000, 50000, 100000], help="Ingest rates to try (default: 1000 5000 20000 50000 100000)")
+    parser.add_argument("--duration", metavar='<s>', type=float, default=3.0, help="Seconds per ingest run (default: 3)")
+    parser.add_argument("--devices", metavar='<n>', type=int, nargs='+', default=[1, 2, 4, 8], help="Device counts for the multi-device benchmark (default: 1 2 4 8)")
+    parser.add_argument("--device-rate", metavar='<sps>', type=int, default=10000, help="Per device rate for the multi-device benchmark (default: 10000)")
+    parser.add_argument("--clients", metavar='<n>', type=int, nargs='+', default=[0, 1, 8, 32], help="Streaming client counts for the serve benchmark (default: 0 1 8 32)")
+    parser.add_argument("--sizes", metavar='<samples>', type=int, nargs='+', default=[100000, 1000000], help="Buffer sizes for the decimation benchmark (default: 100000 1000000)")
+    parser.add_argument("--skip", metavar='<bench>', nargs='*', default=[], help="Benchmarks to skip: parse, ingest, devices, serve, decimate, draw, memory, startup")
+    parser.add_argument("--json", metavar='<file>', help="Also save the results to <file> (to track them over time)")
+    args = parser.parse_args()
+
+    # the simulated negative/corrupted samples are logged as warnings/errors, which is expected here
+    logging.disable(logging.ERROR)
+
+    results = {"version": cv.version, "python": platform.python_version(), "machine": platform.machine(), "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    if not "parse" in args.skip:
+        results["parse"] = bench_parse()
+        print("  parse: {:.0f} lines/second".format(results["parse"]["lines_per_second"]))
+    if not "ingest" in args.skip:
+        results["ingest"] = bench_ingest(args.rates, args.duration)
+        print("  ingest: max sustained {} SPS".format(results["ingest"]["max_sustained_sps"]))
+    if not "devices" in args.skip:
+        results["devices"] = bench_devices(args.devices, args.device_rate, args.duration)
+    if not "serve" in args.skip:
+        results["serve"] = bench_serve(args.clients, args.device_rate, args.duration)
+    if not "decimate" in args.skip:
+        results["decimate"] = bench_decimate(args.sizes)
+    if not "draw" in args.skip:
+        results["draw"] = [bench_draw(cv.buffer_max_samples, blit) for blit in (False, True)]
+        for result in results["draw"]:
+            print("  draw {} samples{}: {:.2f} ms per frame ({} full redraws in {} frames)".format(result["samples"], " (blit)" if result["blit"] else "", result["frame_ms"], result["full_redraws"], result["frames"]))
+    if not "startup" in args.skip:
+        results["startup"] = bench_startup()
+    if not "memory" in args.skip:
+        results["memory"] = bench_memory(max(args.sizes))
+        print("  memory: {:.1f} bytes per buffered sample".format(results["memory"]["bytes_per_sample"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+  main()
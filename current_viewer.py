@@ -8,17 +8,61 @@ import logging
 from logging.handlers import RotatingFileHandler
 import argparse
 import platform
-import collections
+import struct
+import math
+import json
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import mplcursors
-import matplotlib.animation as animation
-from matplotlib.dates import num2date, MinuteLocator, SecondLocator, DateFormatter
-from matplotlib.widgets import Button
 from datetime import datetime, timedelta
-from threading import Thread
+from threading import Thread, Lock, Event
+from bisect import bisect_left
+from collections import deque
+from multiprocessing import shared_memory
+import multiprocessing
+from itertools import groupby
+import queue
+import signal
+import gzip
+import zlib
+import io
+import re
+import tempfile
+import socket
+import hashlib
+import base64
+import importlib.util
+import shutil
+import subprocess
 from os import path
+import os
+
+# The GUI modules (matplotlib, mplcursors), pandas (CSV parsing), pyarrow (Parquet segments) and zstandard
+# (CSV.ZST segments) take seconds and tens of MB to import on small boards, they are imported on first use
+# so -g captures only load pyserial and NumPy
+plt = mplcursors = num2date = DateFormatter = Button = None
+pa = pq = None
+zstandard = None
+
+def import_gui():
+    global plt, mplcursors, num2date, DateFormatter, Button
+    import matplotlib.pyplot as plt
+    import mplcursors
+    from matplotlib.dates import num2date, DateFormatter
+    from matplotlib.widgets import Button
+
+# False when pyarrow is not installed
+def import_parquet():
+    global pa, pq
+    if pq == None and importlib.util.find_spec("pyarrow") != None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    return pq != None
+
+# False when zstandard is not installed
+def import_zstandard():
+    global zstandard
+    if zstandard == None and importlib.util.find_spec("zstandard") != None:
+        import zstandard
+    return zstandard != None
 
 version = '1.0.7'
 
@@ -29,46 +73,2521 @@ logfile = 'current_viewer.log'
 
 refresh_interval = 66 # 66ms = 15fps
 
+# blit the live chart (redraw only the line and stats over a cached background) when the backend supports it
+chart_blit = True
+
+# the refresh interval is stretched so drawing the chart takes at most 1/frame_budget of the time (leaves CPU for acquisition)
+frame_budget = 4
+
 # controls the window size (and memory usage). 100k samples = 3 minutes
 buffer_max_samples = 100000
 
+# disk tier of the buffer (--history): samples evicted from the window are kept in a file of up to history_max_gb
+# in history_dir (temporary directory by default) to browse them while paused, 0 = disabled
+history_max_gb = 0
+history_dir = None
+
+# animation saved by the [GIF] button: GIF, MP4 or WEBM (the videos are encoded by ffmpeg) and its length in frames
+animation_format = 'GIF'
+animation_formats = ['GIF', 'MP4', 'WEBM']
+animation_frames = 100
+# the animation process gets each device's window reduced to about this many (mean, min, max) buckets
+# (the samples themselves when there are fewer), not a copy of the whole buffer
+animation_points = 65536
+video_codecs = {"MP4": ["-c:v", "libx264", "-pix_fmt", "yuv420p"], "WEBM": ["-c:v", "libvpx-vp9", "-b:v", "0", "-crf", "32", "-pix_fmt", "yuv420p"]}
+
 # controls how many samples to display in the chart (and CPU usage). Ie 4k display should be ok with 2k samples
 chart_max_samples = 2048
 
+# --open: zooming into a range of more samples than this shows the capture overview instead of the raw samples
+capture_zoom_samples = 5000000
+
 # how many samples to average (median) 
 max_supersampling = 16;
 
 # set to true to compute median instead of average (less noise, more CPU)
 median_filter = 0;
 
+# how the buffer is reduced to chart_max_samples points: AVG/MEDIAN (strided supersampling, see above),
+# MINMAX (per bucket min/max envelope drawn as a band) or LTTB (Largest-Triangle-Three-Buckets)
+decimation_mode = 'AVG'
+decimation_modes = ['AVG', 'MEDIAN', 'MINMAX', 'LTTB']
+
 # 
 save_file = None;
 save_format = None;
+save_formats = ["CSV", "JSON", "BIN", "BIN64", "PARQUET", "CSV.GZ", "CSV.ZST"]
+
+# rolling recording (PARQUET, CSV.GZ, CSV.ZST): segments are closed at this size (MB) or when the clock enters a new slot of this many seconds
+segment_max_mb = 64
+segment_seconds = 3600
+
+# export writer settings: how often the file is flushed (seconds) and how many sample batches can be queued
+export_flush_interval = 1.0
+export_queue_batches = 1024
+export_writer = None
+
+# pipeline metrics: print them with the capture statistics (--stats), rewrite them to metrics_file every
+# metrics_interval seconds, serve them in Prometheus text format on localhost:metrics_port
+print_metrics = False
+metrics_file = None
+metrics_interval = 10
+metrics_port = None
+
+# how often the GUI picks up new samples from the acquisition process (--process), seconds
+ring_poll_interval = 0.02
 
 connected_device = "CurrentRanger"
 
+# capture statistics: print them every stats_interval seconds in --no-gui mode (0 = only at exit), save them to stats_file at exit
+stats_interval = 60
+stats_file = None
+
+# power state segmentation: thresholds (amps) between the states, hysteresis factor around each threshold,
+# and how many consecutive samples a new state needs before the transition is accepted
+state_thresholds = [1.0e-6, 1.0e-3]
+state_names = ['sleep', 'idle', 'active']
+state_hysteresis = 2.0
+state_debounce = 3
+events_file = None
+
+# streaming server (--serve [host:]port) and how many frames/raw batches per second it publishes
+serve_address = None
+serve_fps = 15
+
+# triggered capture (--trigger): only the samples from trigger_pre seconds before to trigger_post seconds after
+# each trigger are exported, with a mean/min/max summary line every trigger_summary seconds (0 = none)
+trigger_condition = None
+trigger_pre = 0.1
+trigger_post = 0.5
+trigger_window = 0.01
+trigger_summary = 1.0
+trigger_kinds = ['RISE', 'FALL', 'AVG', 'STATE']
+summary_writer = None
+
+# Fixed capacity ring buffer of (timestamp, amps) samples backed by contiguous numpy arrays.
+# Every sample is stored twice (at i and i+capacity) so the last N samples are always a
+# contiguous zero-copy slice, regardless of where the write head currently is.
+# storage optionally provides the (timestamps, amps) arrays of 2*capacity items, e.g. in shared memory.
+class SampleBuffer:
+    def __init__(self, capacity, storage=None, pyramid=True):
+        self.capacity = max(1, int(capacity))
+        self.count = 0
+        if storage != None:
+            self._ts, self._data = storage
+        else:
+            self._ts = np.zeros(2*self.capacity, dtype=np.int64)
+            self._data = np.zeros(2*self.capacity, dtype=np.float64)
+        self.pyramid = SamplePyramid(self) if pyramid else None
+        # optional disk tier (SampleHistory) receiving the evicted samples
+        self.history = None
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, ts, value):
+        pos = self.count % self.capacity
+        if self.history and self.count >= self.capacity:
+            self.history.extend(self._ts[pos:pos+1], self._data[pos:pos+1])
+        ts_ns = np.datetime64(ts, 'ns').astype(np.int64)
+        self._ts[pos] = self._ts[pos + self.capacity] = ts_ns
+        self._data[pos] = self._data[pos + self.capacity] = value
+        self.count += 1
+        if self.pyramid:
+            self.pyramid.update()
+
+    # bulk append: ts is int64 nanoseconds (or datetime64), values are amps
+    def extend(self, ts, values):
+        ts = np.asarray(ts)
+        ts = ts.astype('datetime64[ns]').view(np.int64) if ts.dtype.kind == 'M' else ts.astype(np.int64, copy=False)
+        values = np.asarray(values, dtype=np.float64)
+        total = len(values)
+        if total == 0:
+            return
+        skip = max(0, total - self.capacity)
+        if self.history:
+            # the oldest samples about to be overwritten (and new ones that do not even fit) go to disk first
+            evicted = min(len(self), len(self) + total - self.capacity)
+            if evicted > 0:
+                window_ts, window_data = self.last()
+                self.history.extend(window_ts[:evicted], window_data[:evicted])
+            if skip:
+                self.history.extend(ts[:skip], values[:skip])
+        ts = ts[skip:]
+        values = values[skip:]
+
+        start = (self.count + skip) % self.capacity
+        first = min(len(values), self.capacity - start)
+        self._write(start, ts[:first], values[:first])
+        if first < len(values):
+            self._write(0, ts[first:], values[first:])
+        self.count += total
+        if self.pyramid:
+            self.pyramid.update()
+
+    def _write(self, pos, ts, values):
+        for base in (pos, pos + self.capacity):
+            self._ts[base:base+len(values)] = ts
+            self._data[base:base+len(values)] = values
+
+    # returns zero-copy views (int64 ns timestamps, float64 amps) of the last n samples
+    def last(self, n=None):
+        size = len(self)
+        n = size if n is None else max(0, min(n, size))
+        end = self.count % self.capacity + self.capacity
+        return self._ts[end-n:end], self._data[end-n:end]
+
+    def timestamps(self, n=None):
+        return self.last(n)[0].view('datetime64[ns]')
+
+    def lastTimestamp(self):
+        return self.timestamps(1)[0] if self.count else None
+
+    # Reduces the samples between t0 and t1 (int64 ns, inclusive) to ~max_points buckets (ts, means, mins, maxs)
+    # across both tiers: the window from the pyramid, anything older from the disk tier. The points are
+    # shared between the tiers in proportion to the time they cover.
+    def query(self, t0, t1, max_points):
+        window_ts, window_data = self.last()
+        start = int(window_ts[0]) if len(window_data) else None
+        parts = []
+        if self.history and self.history.count and (start == None or t0 < start):
+            end = t1 if start == None else min(t1, start - 1)
+            parts.append(self.history.query(t0, end, max(2, max_points*(end - t0)//max(1, t1 - t0))))
+        if start != None and t1 >= start:
+            t0 = max(t0, start)
+            points = max(2, max_points - len(parts[0][0])) if parts else max_points
+            if self.pyramid:
+                parts.append(self.pyramid.query(t0, t1, points))
+            else:
+                i0, i1 = np.searchsorted(window_ts, t0, side='left'), np.searchsorted(window_ts, t1, side='right')
+                parts.append(decimate_minmax(window_ts[i0:i1], window_data[i0:i1], points))
+        parts = [part for part in parts if len(part[0])]
+        if not parts:
+            return window_ts[:0].view('datetime64[ns]'), window_data[:0], window_data[:0], window_data[:0]
+        return tuple(np.concatenate(column) for column in zip(*parts)) if len(parts) > 1 else parts[0]
+
+    # copies of the samples between t0 and t1 (int64 ns, inclusive) from both tiers: (int64 ns timestamps, float64 amps)
+    def read(self, t0, t1):
+        window_ts, window_data = self.last()
+        i0, i1 = np.searchsorted(window_ts, t0, side='left'), np.searchsorted(window_ts, t1, side='right')
+        timestamps, amps = window_ts[i0:i1].copy(), window_data[i0:i1].copy()
+        if self.history and self.history.count and (not len(window_data) or t0 < window_ts[0]):
+            older_ts, older = self.history.read(t0, min(t1, int(window_ts[0]) - 1) if len(window_data) else t1)
+            timestamps, amps = np.concatenate((older_ts, timestamps)), np.concatenate((older, amps))
+        return timestamps, amps
+
+
+# Multi-resolution (mipmap) aggregates of a SampleBuffer: level L keeps min/max/sum of every
+# aligned block of 2^L samples (the count is implicit), in rings sized to cover the buffer.
+# Blocks are built from the level below as soon as they complete, so appends cost O(1) amortized
+# and any time range can be reduced to ~max_points buckets without touching the raw samples.
+class SamplePyramid:
+    base_level = 3
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.levels = []
+        level = self.base_level
+        while (1 << level) <= buffer.capacity:
+            size = (buffer.capacity >> level) + 2
+            self.levels.append((np.zeros(size), np.zeros(size), np.zeros(size)))
+            level += 1
+        # next block to be computed, for each level
+        self.next_block = [0]*len(self.levels)
+
+    def update(self):
+        count = self.buffer.count
+        if not self.levels or (count >> self.base_level) == self.next_block[0]:
+            return
+
+        window_ts, window_data = self.buffer.last()
+        offset = count - len(window_data)
+
+        for j, (mins, maxs, sums) in enumerate(self.levels):
+            level = self.base_level + j
+            block = 1 << level
+            end = count >> level
+            if end == self.next_block[j]:
+                break
+
+            # blocks that were (partially) evicted before they completed are skipped
+            start = max(self.next_block[j], -(-offset // block))
+            if start < end:
+                pos = np.arange(start, end) % len(mins)
+                if j == 0:
+                    rows = window_data[start*block - offset:end*block - offset].reshape(-1, block)
+                    mins[pos] = rows.min(axis=1)
+                    maxs[pos] = rows.max(axis=1)
+                    sums[pos] = rows.sum(axis=1)
+                else:
+                    prev_mins, prev_maxs, prev_sums = self.levels[j-1]
+                    lo = (2*np.arange(start, end)) % len(prev_mins)
+                    hi = (lo + 1) % len(prev_mins)
+                    mins[pos] = np.minimum(prev_mins[lo], prev_mins[hi])
+                    maxs[pos] = np.maximum(prev_maxs[lo], prev_maxs[hi])
+                    sums[pos] = prev_sums[lo] + prev_sums[hi]
+            self.next_block[j] = end
+
+    # Reduces the samples between t0 and t1 (int64 ns, inclusive) to at most ~2*max_points buckets
+    # using the coarsest level that still gives max_points buckets. Returns (ts, means, mins, maxs)
+    def query(self, t0, t1, max_points):
+        window_ts, window_data = self.buffer.last()
+        count = self.buffer.count
+        offset = count - len(window_data)
+
+        # one extra sample on each side keeps the line continuous past the chart edges
+        i0 = max(0, np.searchsorted(window_ts, t0, side='left') - 1)
+        i1 = min(len(window_data), np.searchsorted(window_ts, t1, side='right') + 1)
+        visible = i1 - i0
+        if visible <= 0:
+            return window_ts[:0].view('datetime64[ns]'), window_data[:0], window_data[:0], window_data[:0]
+
+        level = int(np.log2(max(1, visible // max(1, max_points))))
+        if level < self.base_level or not self.levels:
+            return decimate_minmax(window_ts[i0:i1], window_data[i0:i1], max_points)
+
+        j = min(level, self.base_level + len(self.levels) - 1) - self.base_level
+        level = self.base_level + j
+        block = 1 << level
+        mins, maxs, sums = self.levels[j]
+
+        # complete blocks inside [a0, a1), raw samples for the partial blocks at both ends
+        a0, a1 = i0 + offset, i1 + offset
+        b0 = -(-a0 // block)
+        b1 = min(a1 >> level, self.next_block[j])
+        if b1 <= b0:
+            return decimate_minmax(window_ts[i0:i1], window_data[i0:i1], max_points)
+        pos = np.arange(b0, b1) % len(mins)
+
+        first = b0*block - offset
+        last = b1*block - offset
+        head = window_data[i0:first]
+        tail = window_data[last:i1]
+
+        def partial(ts, part):
+            return [ts[:1], part.min(keepdims=True), part.max(keepdims=True), part.sum(keepdims=True), [len(part)]]
+
+        columns = [window_ts[np.arange(b0, b1)*block - offset], mins[pos], maxs[pos], sums[pos], np.full(len(pos), block)]
+        if len(head):
+            columns = [np.concatenate(c) for c in zip(partial(window_ts[i0:], head), columns)]
+        if len(tail):
+            columns = [np.concatenate(c) for c in zip(columns, partial(window_ts[last:], tail))]
+
+        bucket_ts, bucket_min, bucket_max, bucket_sum, bucket_count = columns
+        return bucket_ts.view('datetime64[ns]'), bucket_sum / bucket_count, bucket_min, bucket_max
+
+
+# Disk tier of a SampleBuffer (--history): the samples evicted from the RAM window are appended to a ring
+# file of at most max_bytes on local disk (oldest samples overwritten first). The file is written with plain
+# writes and read through a read-only memory map, so only the pages a query touches are mapped in and the
+# resident memory stays that of the window. Each block of block_samples samples also keeps its first
+# timestamp and min/max/sum in RAM (~32 bytes per block): hours of history are reduced to chart points
+# from those, the samples themselves are read only once the range is narrow enough.
+class SampleHistory:
+    block_samples = 4096
+    record_dtype = np.dtype([('ts', '<i8'), ('amps', '<f8')])
+
+    def __init__(self, file_name, max_bytes):
+        self.file_name = file_name
+        self.blocks = max(2, int(max_bytes) // (self.record_dtype.itemsize*self.block_samples))
+        self.capacity = self.blocks*self.block_samples
+        self.count = 0
+        self.file = open(file_name, "w+b", buffering=0)
+        self.file.truncate(self.capacity*self.record_dtype.itemsize)
+        self.samples = np.memmap(file_name, dtype=self.record_dtype, mode='r', shape=(self.capacity,))
+        self.block_ts = np.zeros(self.blocks, dtype=np.int64)
+        self.block_min = np.zeros(self.blocks)
+        self.block_max = np.zeros(self.blocks)
+        self.block_sum = np.zeros(self.blocks)
+
+    # oldest sample still in the file
+    def first(self):
+        return max(0, self.count - self.capacity)
+
+    def extend(self, ts, values):
+        total = len(values)
+        if total == 0:
+            return
+        skip = max(0, total - self.capacity)
+        records = np.empty(total - skip, dtype=self.record_dtype)
+        records['ts'] = ts[skip:]
+        records['amps'] = values[skip:]
+
+        begin = self.count + skip
+        start = begin % self.capacity
+        first = min(len(records), self.capacity - start)
+        self.write(start, records[:first])
+        if first < len(records):
+            self.write(0, records[first:])
+        self.count += total
+
+        # summaries of the blocks these samples completed, a block started by a previous extend is read back
+        block = self.block_samples
+        b0 = max(begin // block, -(-self.first() // block))
+        b1 = self.count // block
+        if b1 > b0:
+            head = self.range(b0*block, begin) if b0*block < begin else records[:0]
+            blocks = np.concatenate((head, records[max(0, b0*block - begin):b1*block - begin]))
+            rows = blocks['amps'].reshape(-1, block)
+            slots = np.arange(b0, b1) % self.blocks
+            self.block_ts[slots] = blocks['ts'][::block]
+            self.block_min[slots] = rows.min(axis=1)
+            self.block_max[slots] = rows.max(axis=1)
+            self.block_sum[slots] = rows.sum(axis=1)
+
+    def write(self, pos, records):
+        self.file.seek(pos*self.record_dtype.itemsize)
+        self.file.write(records.tobytes())
+
+    # copy of the records [i0, i1) (indexes since the first sample written)
+    def range(self, i0, i1):
+        p0, p1 = i0 % self.capacity, (i1 - 1) % self.capacity + 1
+        if i1 <= i0:
+            return self.samples[:0].copy()
+        if p0 < p1:
+            return np.array(self.samples[p0:p1])
+        return np.concatenate((self.samples[p0:], self.samples[:p1]))
+
+    # index of the first sample at or after t (side='left') or after t (side='right')
+    def search(self, t, side='left'):
+        lo, hi = self.first(), self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            ts = int(self.samples['ts'][mid % self.capacity])
+            if ts < t or (side == 'right' and ts == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # samples between t0 and t1 (int64 ns, inclusive): (int64 ns timestamps, float64 amps)
+    def read(self, t0, t1):
+        records = self.range(self.search(t0), self.search(t1, side='right'))
+        return records['ts'], records['amps']
+
+    # (ts, means, mins, maxs) of the samples between t0 and t1 in ~max_points buckets, from the block summaries
+    # when they give at least max_points/4 buckets, otherwise from the samples
+    def query(self, t0, t1, max_points):
+        block = self.block_samples
+        i0, i1 = self.search(t0), self.search(t1, side='right')
+        b0, b1 = -(-i0 // block), i1 // block
+        if b1 - b0 < max(1, max_points // 4):
+            timestamps, amps = self.read(t0, t1)
+            if not len(amps):
+                return timestamps.view('datetime64[ns]'), amps, amps, amps
+            return decimate_minmax(timestamps, amps, max_points)
+
+        # groups of whole blocks, plus one bucket for the partial blocks at each end
+        slots = np.arange(b0, b1) % self.blocks
+        edges = np.arange(0, len(slots), -(-len(slots) // max_points))
+        columns = [self.block_ts[slots][edges], np.minimum.reduceat(self.block_min[slots], edges), np.maximum.reduceat(self.block_max[slots], edges),
+                   np.add.reduceat(self.block_sum[slots], edges), np.diff(np.append(edges, len(slots)))*block]
+        for part, at_end in ((self.range(i0, b0*block), False), (self.range(b1*block, i1), True)):
+            if len(part):
+                amps = part['amps']
+                bucket = [part['ts'][:1], amps.min(keepdims=True), amps.max(keepdims=True), amps.sum(keepdims=True), [len(part)]]
+                columns = [np.concatenate((c, b) if at_end else (b, c)) for c, b in zip(columns, bucket)]
+
+        bucket_ts, bucket_min, bucket_max, bucket_sum, bucket_count = columns
+        return bucket_ts.view('datetime64[ns]'), bucket_sum / bucket_count, bucket_min, bucket_max
+
+    # unmaps and deletes the file
+    def close(self):
+        self.samples = None
+        self.file.close()
+        try:
+            os.remove(self.file_name)
+        except OSError as e:
+            logging.warning("Could not remove the history file {}: {}".format(self.file_name, e))
+
+
+# SampleBuffer in a multiprocessing.shared_memory block, written by the acquisition process (--process)
+# and mapped by the GUI process. The block starts with a small int64 header:
+#   capacity, head (samples written), tail (samples read by the GUI), acquisition state,
+#   writing (head the writer is storing samples up to)
+# followed by the mirrored timestamp and amps arrays. There is a single writer and a single reader and
+# no lock: the writer announces how far it is writing, stores the samples and publishes the head after,
+# the reader only looks at samples up to the head it read, and publishes how far it got as the tail.
+# The writer never waits for the reader, a reader that falls more than capacity samples behind loses the
+# oldest ones, and the samples overwritten while the reader copied them are dropped too (both counted).
+class SharedSampleBuffer(SampleBuffer):
+    CAPACITY, HEAD, TAIL, STATE, WRITING = range(5)
+    header_size = 64
+
+    # acquisition states
+    STARTING, STREAMING, STOPPED, FAILED = 0, 1, 2, -1
+
+    # creates the block when name is None, attaches to an existing one otherwise (capacity is then read from it)
+    def __init__(self, capacity=None, name=None, pyramid=True):
+        if name == None:
+            capacity = max(1, int(capacity))
+            self.shm = shared_memory.SharedMemory(create=True, size=self.header_size + 2*capacity*(8 + 8))
+            self.header = np.ndarray(5, dtype=np.int64, buffer=self.shm.buf)
+            self.header[:] = [capacity, 0, 0, self.STARTING, 0]
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.header = np.ndarray(5, dtype=np.int64, buffer=self.shm.buf)
+            capacity = int(self.header[self.CAPACITY])
+
+        ts = np.ndarray(2*capacity, dtype=np.int64, buffer=self.shm.buf, offset=self.header_size)
+        data = np.ndarray(2*capacity, dtype=np.float64, buffer=self.shm.buf, offset=self.header_size + 2*capacity*8)
+        super().__init__(capacity, storage=(ts, data), pyramid=pyramid)
+        # attached late (e.g. the GUI restarted), start from the current head
+        self.count = int(self.header[self.HEAD])
+        self.lost = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def state(self):
+        return int(self.header[self.STATE])
+
+    def setState(self, state):
+        self.header[self.STATE] = state
+
+    # writer side: samples are stored before the head moves
+    def extend(self, ts, values):
+        self.header[self.WRITING] = self.count + len(values)
+        super().extend(ts, values)
+        self.header[self.HEAD] = self.count
+
+    # how many written samples the reader did not get to yet
+    def lag(self):
+        return int(self.header[self.HEAD] - self.header[self.TAIL])
+
+    # reader side: moves to the published head and returns copies of the new samples and how many were lost
+    def poll(self):
+        head = int(self.header[self.HEAD])
+        new = head - self.count
+        lost = max(0, new - self.capacity)
+        self.count = head
+        if self.pyramid and new:
+            self.pyramid.update()
+        timestamps, values = self.last(new - lost)
+        timestamps, values = timestamps.copy(), values.copy()
+        # the oldest copied samples may have been overwritten by the writer meanwhile (torn), they are dropped
+        torn = min(len(values), max(0, int(self.header[self.WRITING]) - self.capacity - (head - len(values))))
+        lost += torn
+        self.lost += lost
+        self.header[self.TAIL] = head
+        return timestamps[torn:], values[torn:], lost
+
+    # unmaps the block, the creator also frees it
+    def close(self, unlink=False):
+        self.header = self._ts = self._data = None
+        self.pyramid = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # views are still referenced (e.g. by the chart), the mapping goes away with the process
+            pass
+        if unlink:
+            self.shm.unlink()
+
+
+# Reduces the last samples to at most max_points chart points: the window is split in equal
+# strides and the first `supersampling` samples of each stride are averaged (or median filtered)
+def decimate(ts, data, max_points, supersampling=max_supersampling, median=False):
+    stride = max(1, len(data) // max_points)
+    points = min(max_points, len(data) // stride)
+    offset = len(data) - points*stride
+
+    # reshape is a view: (points, stride), reduce only the leading supersamples of each row
+    rows = data[offset:].reshape(points, stride)[:, :max(1, min(supersampling, stride))]
+    samples = np.median(rows, axis=1) if median else np.mean(rows, axis=1)
+    return ts[offset::stride].view('datetime64[ns]'), samples
+
+# Splits the whole window in max_points buckets and reduces every sample of each bucket to its
+# min, max and mean. Short spikes between stride points survive in the envelope.
+def decimate_minmax(ts, data, max_points):
+    return decimate_envelope(ts, data, data, data, max_points)
+
+# Same for points that are already (means, mins, maxs) buckets, e.g. from SampleBuffer.query()
+def decimate_envelope(ts, means, mins, maxs, max_points):
+    points = min(max_points, len(means))
+    edges = (np.arange(points, dtype=np.int64)*len(means)) // points
+    mins = np.minimum.reduceat(mins, edges)
+    maxs = np.maximum.reduceat(maxs, edges)
+    means = np.add.reduceat(means, edges) / np.diff(np.append(edges, len(means)))
+    return ts[edges].view('datetime64[ns]'), means, mins, maxs
+
+
+# Largest-Triangle-Three-Buckets downsampling, vectorized: the previous bucket's selected point
+# is approximated with its mean so all buckets can be solved at once (first/last points are kept).
+# Triangle areas are computed in log10(amps) since that is how the chart is drawn.
+def decimate_lttb(ts, data, max_points):
+    n = len(data)
+    if n <= max(max_points, 3):
+        return ts.view('datetime64[ns]'), data
+
+    width = -(-(n - 2) // (max_points - 2))
+    buckets = -(-(n - 2) // width)
+    pad = buckets*width - (n - 2)
+
+    # only the middle samples are bucketed, padding (if any) is filled with the last sample
+    middle = slice(1, n - 1)
+    x = (ts[middle] - ts[0]).astype(np.float64)
+    y = np.log10(np.maximum(data[middle], 1.0e-12))
+    if pad:
+        x = np.concatenate((x, np.full(pad, x[-1])))
+        y = np.concatenate((y, np.full(pad, y[-1])))
+    bx = x.reshape(buckets, width)
+    by = y.reshape(buckets, width)
+
+    counts = np.full(buckets, width)
+    counts[-1] -= pad
+    mean_x = bx.sum(axis=1) / counts
+    mean_y = by.sum(axis=1) / counts
+    if pad:
+        mean_x[-1] -= pad*x[-1]/counts[-1]
+        mean_y[-1] -= pad*y[-1]/counts[-1]
+    first_y = np.log10(max(data[0], 1.0e-12))
+    last_x, last_y = float(ts[-1] - ts[0]), np.log10(max(data[-1], 1.0e-12))
+    ax = np.concatenate(([0.0], mean_x[:-1]))
+    ay = np.concatenate(([first_y], mean_y[:-1]))
+    cx = np.concatenate((mean_x[1:], [last_x]))
+    cy = np.concatenate((mean_y[1:], [last_y]))
+
+    # twice the triangle area is linear in the candidate point: |(ax-cx)*by + (cy-ay)*bx + k|
+    k = -(ax - cx)*ay - ax*(cy - ay)
+    area = np.abs((ax - cx)[:, None]*by + (cy - ay)[:, None]*bx + k[:, None])
+    selected = 1 + np.arange(buckets)*width + np.argmax(area, axis=1)
+    index = np.concatenate(([0], selected, [n - 1]))
+    return ts[index].view('datetime64[ns]'), data[index]
+
+
+# Reduces a window to chart points with the current decimation_mode: (timestamps, samples, (mins, maxs) or None)
+# mode/max_samples default to the chart's --decimation and --max-chart
+def decimate_window(ts, data, mode=None, max_samples=None):
+    mode = decimation_mode if mode == None else mode
+    max_samples = chart_max_samples if max_samples == None else max_samples
+    if mode == 'MINMAX':
+        timestamps, samples, lower, upper = decimate_minmax(ts, data, max_samples)
+        return timestamps, samples, (lower, upper)
+    if mode == 'LTTB':
+        return decimate_lttb(ts, data, max_samples) + (None,)
+    return decimate(ts, data, max_samples, max_supersampling, median_filter or mode == 'MEDIAN') + (None,)
+
+
+# Splits a chunk of serial data in complete lines and converts all samples with one vectorized call.
+# Returns (values, control lines, invalid lines, remainder) where remainder is the incomplete last line
+def parse_chunk(chunk):
+    lines = chunk.split(b"\n")
+    remainder = lines.pop()
+
+    control = []
+    if b"USB_LOGGING" in chunk:
+        control = [line for line in lines if line.startswith(b"USB_LOGGING")]
+        lines = [line for line in lines if not line.startswith(b"USB_LOGGING")]
+
+    invalid = []
+    try:
+        values = np.array(lines, dtype=np.bytes_).astype(np.float64)
+    except ValueError:
+        # slow path: at least one line is corrupted, convert one by one
+        values = []
+        for line in lines:
+            try:
+                values.append(float(line))
+            except ValueError:
+                invalid.append(line)
+        values = np.array(values, dtype=np.float64)
+
+    finite = np.isfinite(values)
+    if not finite.all():
+        invalid += [repr(value).encode() for value in values[~finite].tolist()]
+        values = values[finite]
+
+    return values, control, invalid, remainder
+
+
+# Sample clock shared by all devices: int64 ns of local time, anchored once and advanced by the monotonic
+# clock so timestamps from different reader threads stay aligned (and never jump with wall clock changes)
+clock_origin = np.datetime64(datetime.now(), 'ns').astype(np.int64) - time.monotonic_ns()
+
+def clock_ns():
+    return clock_origin + time.monotonic_ns()
+
+
+# spreads n sample timestamps (int64 ns) evenly between two chunk arrival times
+def interpolate_timestamps(start, end, n):
+    return start + ((end - start)*np.arange(1, n+1, dtype=np.int64)) // max(1, n)
+
+
+# formats timestamps (int64 ns) in the same layout as str(datetime)
+def format_timestamps(timestamps):
+    return np.char.replace(np.datetime_as_string(np.asarray(timestamps).view('datetime64[ns]').astype('datetime64[us]')), 'T', ' ')
+
+
+# formats a batch of samples as CSV lines or JSON array items (first=True for the first item in the file),
+# with a device column when capturing from several devices
+def format_samples(timestamps, values, fmt, first=False, device=None):
+    times = format_timestamps(timestamps).tolist()
+    # float32 (binary captures) is formatted with its own shortest representation
+    amps = values.astype(str).tolist() if values.dtype == np.float32 else values.tolist()
+    if fmt == 'CSV':
+        if device != None:
+            return "".join([f"{ts},{data},{device}\n" for ts, data in zip(times, amps)])
+        return "".join([f"{ts},{data}\n" for ts, data in zip(times, amps)])
+    elif fmt == 'JSON':
+        if device != None:
+            items = ",\n".join(["{{\"time\":\"{}\",\"amps\":\"{}\",\"device\":\"{}\"}}".format(ts, data, device) for ts, data in zip(times, amps)])
+        else:
+            items = ",\n".join(["{{\"time\":\"{}\",\"amps\":\"{}\"}}".format(ts, data) for ts, data in zip(times, amps)])
+        return items if first else ",\n" + items
+    return ""
+
+
+def csv_header(devices=False):
+    return "Timestamp, Amps, Device\n" if devices else "Timestamp, Amps\n"
+
+
+def text_amp(amp):
+    if (abs(amp) > 1.0):
+        return "{:.3f} A".format(amp)
+    if (abs(amp) > 0.001):
+        return "{:.2f} mA".format(amp*1000)
+    if (abs(amp) > 0.000001):
+        return "{:.1f} \u00B5A".format(amp*1000*1000)
+    return "{:.1f} nA".format(amp*1000*1000*1000)
+
+
+def text_charge(mah):
+    return "{:.3f} mAh".format(mah) if abs(mah) >= 1.0 else "{:.3f} \u00B5Ah".format(mah*1000)
+
+
+# 10^k amps as a short label (1nA, 10nA, ... 1A)
+def decade_label(k):
+    return "{}{}".format(10**((k + 12) % 3), ["pA", "nA", "\u00B5A", "mA", "A"][(k + 12)//3])
+
+
+# Runtime metrics of the acquisition and chart pipeline: counters (optionally per device) and
+# histograms with fixed log2 buckets (latencies in seconds, read sizes in bytes). Updated once per
+# chunk/frame, so the cost on the hot path is a couple of perf_counter() calls and a short lock.
+# Exposed as a console report (--stats), a JSON file (--stats-file) and Prometheus text (--metrics-port).
+class Metrics:
+    latency_buckets = [1.0e-6*2**k for k in range(24)]
+    size_buckets = [float(2**k) for k in range(21)]
+
+    descriptions = {
+        "serial_read_seconds": "Time blocked in each serial read",
+        "serial_read_bytes": "Bytes returned by each serial read",
+        "parse_seconds": "Time to parse each serial chunk",
+        "buffer_append_seconds": "Time to append each batch to the sample buffer",
+        "stats_update_seconds": "Time to update the capture statistics and power states per batch",
+        "export_write_seconds": "Time to format and write each export block",
+        "decimate_seconds": "Time to decimate the buffer for each chart frame",
+        "draw_seconds": "Time to draw each chart frame",
+        "samples_total": "Samples received",
+        "parse_errors_total": "Invalid lines received",
+        "negative_values_total": "Negative samples received (clipped in the chart)",
+        "usb_logging_reenabled_total": "Times USB logging was found disabled and re-enabled",
+        "serial_errors_total": "Serial read errors",
+        "export_dropped_samples_total": "Samples dropped because the export writer fell behind",
+        "export_queue_depth": "Batches waiting for the export writer",
+        "stream_clients": "Connected streaming clients (--serve)",
+        "stream_dropped_messages_total": "Streaming messages dropped because a client fell behind",
+        "trigger_windows_total": "Trigger windows started (--trigger)",
+        "trigger_samples_total": "Samples exported in trigger windows (--trigger)",
+    }
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # snapshot of another process' metrics (the acquisition process with --process)
+        self.remote = None
+        self.follower = None
+
+    @staticmethod
+    def key(name, device=None):
+        return name if device == None else '{}{{device="{}"}}'.format(name, device)
+
+    def count(self, name, n=1, device=None):
+        key = self.key(name, device)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value, buckets=latency_buckets):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram == None:
+                histogram = self.histograms[name] = {"bounds": buckets, "counts": [0]*(len(buckets) + 1), "sum": 0.0, "count": 0}
+            histogram["counts"][bisect_left(buckets, value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {"uptime": time.time() - self.start, "counters": dict(self.counters), "gauges": dict(self.gauges),
+                        "histograms": {name: dict(h, counts=list(h["counts"])) for name, h in self.histograms.items()}}
+        if self.remote:
+            for section in ("counters", "gauges"):
+                for key, value in self.remote[section].items():
+                    snapshot[section][key] = snapshot[section].get(key, 0) + value
+            for name, remote in self.remote["histograms"].items():
+                local = snapshot["histograms"].get(name)
+                if local == None:
+                    snapshot["histograms"][name] = remote
+                else:
+                    local.update(counts=[a + b for a, b in zip(local["counts"], remote["counts"])], sum=local["sum"] + remote["sum"], count=local["count"] + remote["count"])
+        return snapshot
+
+    # upper bound of the bucket holding quantile q
+    @staticmethod
+    def quantile(histogram, q):
+        rank = q*histogram["count"]
+        total = 0
+        for bound, count in zip(histogram["bounds"] + [math.inf], histogram["counts"]):
+            total += count
+            if total >= rank and count:
+                return bound
+        return 0.0
+
+    def report(self):
+        snapshot = self.snapshot()
+        lines = ["Pipeline metrics after {:.0f}s:".format(snapshot["uptime"])]
+        for name, h in sorted(snapshot["histograms"].items()):
+            if not h["count"]:
+                continue
+            if name.endswith("_seconds"):
+                lines.append("  {:<24} {:>9} x  mean {:>9.3f}ms  p50 <{:>9.3f}ms  p99 <{:>9.3f}ms".format(name[:-8], h["count"], 1000*h["sum"]/h["count"], 1000*self.quantile(h, 0.5), 1000*self.quantile(h, 0.99)))
+            else:
+                lines.append("  {:<24} {:>9} x  mean {:>9.1f}    p50 <{:>9.0f}    p99 <{:>9.0f}".format(name, h["count"], h["sum"]/h["count"], self.quantile(h, 0.5), self.quantile(h, 0.99)))
+        for key, value in sorted(list(snapshot["counters"].items()) + list(snapshot["gauges"].items())):
+            lines.append("  {:<48} {}".format(key, value))
+        return "\n".join(lines)
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if not name in typed:
+                typed.add(name)
+                lines.append("# HELP currentviewer_{} {}".format(name, self.descriptions.get(name, name)))
+                lines.append("# TYPE currentviewer_{} {}".format(name, kind))
+
+        for section, kind in (("counters", "counter"), ("gauges", "gauge")):
+            for key, value in sorted(snapshot[section].items()):
+                header(key.split('{')[0], kind)
+                lines.append("currentviewer_{} {}".format(key, value))
+        for name, h in sorted(snapshot["histograms"].items()):
+            header(name, "histogram")
+            total = 0
+            for bound, count in zip(h["bounds"] + [math.inf], h["counts"]):
+                total += count
+                lines.append('currentviewer_{}_bucket{{le="{}"}} {}'.format(name, "+Inf" if bound == math.inf else "{:.6g}".format(bound), total))
+            lines.append("currentviewer_{}_sum {}".format(name, h["sum"]))
+            lines.append("currentviewer_{}_count {}".format(name, h["count"]))
+        return "\n".join(lines) + "\n"
+
+    # rewrites the JSON snapshot (write + rename, readers never see a partial file)
+    def save(self, file_name):
+        with open(file_name + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(file_name + ".tmp", file_name)
+
+    # saves the snapshot to file_name every interval seconds from a daemon thread
+    def saveEvery(self, file_name, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save(file_name)
+                except OSError as e:
+                    logging.error("Could not save the metrics to {}: {}".format(file_name, e))
+        Thread(target=run, name="MetricsFile", daemon=True).start()
+
+    # serves the Prometheus text format on http://127.0.0.1:<port>/metrics
+    def serve(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics endpoint: " + format % args)
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        Thread(target=server.serve_forever, name="MetricsHTTP", daemon=True).start()
+        logging.info("Metrics served on http://127.0.0.1:{}/metrics".format(server.server_port))
+        return server
+
+    # merges the snapshots another process sends on snapshot_queue (None ends)
+    def follow(self, snapshot_queue):
+        def run():
+            while True:
+                snapshot = snapshot_queue.get()
+                if snapshot == None:
+                    break
+                self.remote = snapshot
+        self.follower = Thread(target=run, name="MetricsFollow", daemon=True)
+        self.follower.start()
+
+
+metrics = Metrics()
+
+
+# Exact running statistics over the entire capture, updated per batch in O(1) per sample:
+# count/mean/min/max, charge (trapezoidal integration over the real timestamps), quantiles from a
+# log-bucketed sketch (DDSketch style, 1% relative accuracy) and the time spent in each current decade.
+class StreamStats:
+    quantile_accuracy = 0.01
+    quantile_min = 1.0e-12
+    quantile_max = 100.0
+    decades = np.arange(-10, 2)
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.charge = 0.0
+        self.first_ts = None
+        self.last_ts = None
+        self.last_value = None
+
+        self.gamma = (1 + self.quantile_accuracy)/(1 - self.quantile_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.sketch = np.zeros(int(math.ceil(math.log(self.quantile_max/self.quantile_min)/self.log_gamma)) + 1, dtype=np.int64)
+
+        # seconds spent below 10^decades[0], in [10^k, 10^(k+1)) for each decade, and above the last one
+        self.time_at_current = np.zeros(len(self.decades) + 1)
+
+    def update(self, timestamps, values):
+        if len(values) == 0:
+            return
+
+        self.count += len(values)
+        self.sum += float(np.sum(values))
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+
+        index = np.ceil(np.log(np.clip(values, self.quantile_min, self.quantile_max)/self.quantile_min)/self.log_gamma).astype(np.int64)
+        self.sketch += np.bincount(index, minlength=len(self.sketch))
+
+        # integrate from the last sample of the previous batch
+        if self.last_ts == None:
+            self.first_ts = int(timestamps[0])
+        else:
+            timestamps = np.concatenate(([self.last_ts], timestamps))
+            values = np.concatenate(([self.last_value], values))
+        dt = np.diff(timestamps)/1.0e9
+        self.charge += float(np.sum((values[1:] + values[:-1])*dt))/2
+        decade = np.searchsorted(self.decades, np.log10(np.maximum(values[:-1], 1.0e-30)), side='right')
+        self.time_at_current += np.bincount(decade, weights=dt, minlength=len(self.time_at_current))
+
+        self.last_ts = int(timestamps[-1])
+        self.last_value = float(values[-1])
+
+    def mean(self):
+        return self.sum/self.count if self.count else 0.0
+
+    def duration(self):
+        return (self.last_ts - self.first_ts)/1.0e9 if self.count else 0.0
+
+    def chargeMah(self):
+        return self.charge*1000/3600
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.sketch), q*(self.count - 1), side='right'))
+        return self.quantile_min*2*self.gamma**i/(self.gamma + 1)
+
+    def summary(self):
+        bounds = [0.0] + [10.0**k for k in self.decades] + [math.inf]
+        return {
+            "samples": self.count,
+            "start": str(format_timestamps([self.first_ts])[0]) if self.count else None,
+            "end": str(format_timestamps([self.last_ts])[0]) if self.count else None,
+            "duration_s": self.duration(),
+            "mean_a": self.mean(),
+            "min_a": self.min if self.count else None,
+            "max_a": self.max if self.count else None,
+            "p50_a": self.quantile(0.5),
+            "p99_a": self.quantile(0.99),
+            "charge_mah": self.chargeMah(),
+            "time_at_current": [{"from_a": bounds[i], "to_a": bounds[i+1], "seconds": float(seconds)}
+                                for i, seconds in enumerate(self.time_at_current) if seconds > 0],
+        }
+
+    def report(self):
+        if not self.count:
+            return "No samples"
+        lines = ["{} samples in {:.1f}s: mean {}, min {}, max {}, p50 {}, p99 {}, charge {}".format(
+            self.count, self.duration(), text_amp(self.mean()), text_amp(self.min), text_amp(self.max),
+            text_amp(self.quantile(0.5)), text_amp(self.quantile(0.99)), text_charge(self.chargeMah()))]
+        total = max(self.time_at_current.sum(), 1.0e-9)
+        labels = ["0"] + [decade_label(k) for k in self.decades] + [""]
+        for i, seconds in enumerate(self.time_at_current):
+            if seconds > 0:
+                lines.append("  {:>5} .. {:<5} {:10.1f}s {:6.2f}%".format(labels[i], labels[i+1], seconds, 100*seconds/total))
+        return "\n".join(lines)
+
+    def save(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+# Online power state segmentation with log-scale thresholds and hysteresis. A value more than
+# `hysteresis` times away from every threshold selects its state directly, a value close to a
+# threshold keeps the current state if it is one of the two neighbours. A new state must last
+# `debounce` samples to be accepted. Every finished segment is appended to a compact event index
+# (start/end ns, state, mean amps, samples) that can be searched and exported.
+event_dtype = np.dtype([('start', '<i8'), ('end', '<i8'), ('state', '<i1'), ('mean', '<f8'), ('samples', '<i8')])
+
+
+class PowerStateDetector:
+    def __init__(self, thresholds=state_thresholds, hysteresis=state_hysteresis, debounce=state_debounce):
+        log_thresholds = np.log10(np.sort(np.asarray(thresholds, dtype=np.float64)))
+        margin = math.log10(hysteresis)
+        self.lower = log_thresholds - margin
+        self.upper = log_thresholds + margin
+        self.debounce = debounce
+        self.states = len(log_thresholds) + 1
+
+        self.state = None
+        self.start = None
+        self.sum = 0.0
+        self.count = 0
+        # candidate new state (state, start ns, sum, count) while it is being debounced
+        self.pending = None
+        self.last_ts = None
+
+        self.events = np.zeros(64, dtype=event_dtype)
+        self.event_count = 0
+
+    def update(self, timestamps, values):
+        if len(values) == 0:
+            return
+
+        # zone per sample: 2k inside state k, 2i+1 close to threshold i
+        levels = np.log10(np.maximum(values, 1.0e-30))
+        zones = np.searchsorted(self.lower, levels, side='right') + np.searchsorted(self.upper, levels, side='right')
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(zones)) + 1))
+        sums = np.add.reduceat(values, starts)
+        counts = np.diff(np.append(starts, len(values)))
+
+        if self.state == None:
+            self.state = int(zones[0]//2) if zones[0] % 2 == 0 else int(zones[0]//2 + 1)
+            self.start = int(timestamps[0])
+
+        for zone, start, total, count in zip(zones[starts].tolist(), starts.tolist(), sums.tolist(), counts.tolist()):
+            target = zone//2 if zone % 2 == 0 else min(max(self.state, zone//2), zone//2 + 1)
+            if target == self.state:
+                self.mergePending()
+                self.sum += total
+                self.count += count
+                continue
+
+            if self.pending == None or self.pending[0] != target:
+                self.mergePending()
+                self.pending = [target, int(timestamps[start]), 0.0, 0]
+            self.pending[2] += total
+            self.pending[3] += count
+
+            if self.pending[3] >= self.debounce:
+                state, start_ts, pending_sum, pending_count = self.pending
+                self.pending = None
+                self.addEvent(self.start, start_ts, self.state, self.sum, self.count)
+                self.state, self.start, self.sum, self.count = state, start_ts, pending_sum, pending_count
+
+        self.last_ts = int(timestamps[-1])
+
+    def mergePending(self):
+        if self.pending != None:
+            self.sum += self.pending[2]
+            self.count += self.pending[3]
+            self.pending = None
+
+    def addEvent(self, start, end, state, total, count):
+        if self.event_count == len(self.events):
+            self.events = np.concatenate((self.events, np.zeros(len(self.events), dtype=event_dtype)))
+        self.events[self.event_count] = (start, end, state, total/max(1, count), count)
+        self.event_count += 1
+        logging.info("Power state {} for {:.3f}s, mean {}".format(state_name(state, self.states), (end - start)/1.0e9, text_amp(total/max(1, count))))
+
+    # closes the current segment (at exit)
+    def finish(self):
+        if self.state != None and self.last_ts != None:
+            self.mergePending()
+            self.addEvent(self.start, self.last_ts, self.state, self.sum, self.count)
+            self.state = None
+
+    def eventList(self):
+        return self.events[:self.event_count]
+
+    # wake-ups: from leaving the lowest state until returning to it, state is the highest one reached
+    def wakeups(self):
+        events = self.eventList()
+        if len(events) < 2:
+            return events[:0]
+        low = events['state'] == events['state'].min()
+        first = np.flatnonzero(~low[1:] & low[:-1]) + 1
+        if len(first) == 0:
+            return events[:0]
+        returns = np.flatnonzero(low)
+        last = returns[np.minimum(np.searchsorted(returns, first), len(returns) - 1)] - 1
+        last = np.where(last < first, len(events) - 1, last)
+
+        charge = np.concatenate(([0.0], np.cumsum(events['mean']*events['samples'])))
+        samples = np.concatenate(([0], np.cumsum(events['samples'])))
+        wakeups = np.zeros(len(first), dtype=event_dtype)
+        wakeups['start'] = events['start'][first]
+        wakeups['end'] = events['end'][last]
+        # the lowest state segments between wake-ups don't change the maximum
+        wakeups['state'] = np.maximum.reduceat(events['state'], first)
+        wakeups['samples'] = samples[last + 1] - samples[first]
+        wakeups['mean'] = (charge[last + 1] - charge[first])/np.maximum(1, wakeups['samples'])
+        return wakeups
+
+    # first wake-up starting after (direction > 0) or before t (ns), None if there is none
+    def findWakeup(self, t, direction):
+        wakeups = self.wakeups()
+        if direction > 0:
+            i = np.searchsorted(wakeups['start'], t, side='right')
+            return (int(i), len(wakeups), wakeups[i]) if i < len(wakeups) else None
+        i = np.searchsorted(wakeups['start'], t, side='left') - 1
+        return (int(i), len(wakeups), wakeups[i]) if i >= 0 else None
+
+    def save(self, file_name):
+        with open(file_name, "w") as f:
+            f.write("Start, End, Duration, State, Mean Amps, Samples\n")
+            events = self.eventList()
+            starts = format_timestamps(events['start']).tolist()
+            ends = format_timestamps(events['end']).tolist()
+            for event, start, end in zip(events.tolist(), starts, ends):
+                f.write("{},{},{},{},{},{}\n".format(start, end, (event[1] - event[0])/1.0e9, state_name(event[2], self.states), event[3], event[4]))
+
+
+# the default names only apply to as many states (default: the --states count)
+def state_name(state, states=None):
+    states = len(state_thresholds) + 1 if states == None else states
+    return state_names[state] if len(state_names) == states else "state{}".format(state)
+
+
+# Trigger engine of a triggered capture (--trigger), one per device in the acquisition path. A trigger is
+#   RISE/FALL: a run of samples at or above/at or below threshold (recorded for as long as it lasts)
+#   AVG: a run where the mean of the last `window` seconds is at or above threshold
+#   STATE: a power state change of the device's PowerStateDetector
+# and starts a window from pre seconds before it to post seconds after it ends (overlapping windows merge).
+# The last pre seconds of samples are kept in a small ring so a window can reach back before its trigger.
+# All samples are also reduced to one (mean, min, max) summary per `summary` seconds, so the quiet periods
+# stay visible at a low rate.
+class CaptureTrigger:
+    def __init__(self, kind, threshold=None, pre=0.1, post=0.5, window=0.01, summary=1.0):
+        self.kind = kind
+        self.threshold = threshold
+        self.pre = int(pre*1.0e9)
+        self.post = int(post*1.0e9)
+        self.window = int(window*1.0e9)
+        self.summary = int(summary*1.0e9)
+
+        # samples seen and exported so far (indexes), end of the current window (ns)
+        self.seen = 0
+        self.written = 0
+        self.record_until = None
+        # (first index, timestamps, values) batches covering the last pre seconds (and the AVG window)
+        self.ring = deque()
+        self.seen_events = 0
+        self.bucket = None
+        self.windows = 0
+
+    # Returns the samples of this batch (or of the ring) that fall in a trigger window (timestamps, values),
+    # and the completed summaries [(ts, mean, min, max, samples)]
+    def process(self, timestamps, values, detector=None):
+        count = len(values)
+
+        intervals = []
+        if self.kind == 'STATE':
+            if detector != None:
+                changes = detector.eventList()[self.seen_events:]['end']
+                self.seen_events = detector.event_count
+                intervals = [(change - self.pre, change + self.post) for change in changes.tolist()]
+        else:
+            if self.kind == 'AVG':
+                # mean of the samples in (t - window, t], the ring provides the start of the window
+                ring = self.recent(int(timestamps[0]) - self.window)
+                ring_ts = np.concatenate([batch[1] for batch in ring] + [timestamps[:0]])
+                ring_values = np.concatenate([batch[2] for batch in ring] + [values[:0]])
+                all_ts, all_values = np.concatenate((ring_ts, timestamps)), np.concatenate((ring_values, values))
+                sums = np.concatenate(([0.0], np.cumsum(all_values)))
+                end = np.arange(len(ring_values), len(all_values)) + 1
+                begin = np.searchsorted(all_ts, timestamps - self.window, side='right')
+                active = (sums[end] - sums[begin])/np.maximum(1, end - begin) >= self.threshold
+            else:
+                active = values >= self.threshold if self.kind == 'RISE' else values <= self.threshold
+            edges = np.flatnonzero(np.diff(np.concatenate(([False], active, [False])).astype(np.int8)))
+            intervals = [(int(timestamps[start]) - self.pre, int(timestamps[end - 1]) + self.post) for start, end in zip(edges[::2].tolist(), edges[1::2].tolist())]
+
+        keep = np.zeros(count, dtype=bool)
+        if self.record_until != None:
+            keep |= timestamps <= self.record_until
+        earliest = None
+        for start, end in intervals:
+            if self.record_until == None or start > self.record_until:
+                self.windows += 1
+            keep |= (timestamps >= start) & (timestamps <= end)
+            self.record_until = end if self.record_until == None else max(self.record_until, end)
+            earliest = start if earliest == None else min(earliest, start)
+
+        # pre-trigger samples from the ring that were not exported yet
+        parts = []
+        if earliest != None:
+            ring = self.recent(earliest, self.written)
+            ring_ts = np.concatenate([batch[1] for batch in ring] + [timestamps[:0]])
+            ring_values = np.concatenate([batch[2] for batch in ring] + [values[:0]])
+            ring_first = ring[0][0] if ring else self.seen
+            selected = (ring_ts >= earliest) & (np.arange(ring_first, ring_first + len(ring_values)) >= self.written)
+            parts.append((ring_ts[selected], ring_values[selected]))
+        parts.append((timestamps[keep], values[keep]))
+        if keep.any():
+            self.written = self.seen + int(np.flatnonzero(keep)[-1]) + 1
+        elif len(parts[0][1]):
+            self.written = self.seen
+
+        # the ring keeps the last max(pre, window) seconds
+        self.ring.append((self.seen, timestamps, values))
+        self.seen += count
+        cutoff = int(timestamps[-1]) - max(self.pre, self.window if self.kind == 'AVG' else 0)
+        while len(self.ring) > 1 and int(self.ring[0][1][-1]) < cutoff:
+            self.ring.popleft()
+
+        exported = (np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts]))
+        return exported, self.summarize(timestamps, values) if self.summary > 0 else []
+
+    # the ring batches ending at t (ns) or later with samples past index `written`, oldest first. Walks back from
+    # the newest batch so the cost is that of the returned batches, not of the whole pre-trigger ring
+    def recent(self, t, written=0):
+        batches = []
+        for batch in reversed(self.ring):
+            if int(batch[1][-1]) < t or batch[0] + len(batch[2]) <= written:
+                break
+            batches.append(batch)
+        return batches[::-1]
+
+    # summaries of the aligned summary periods completed by this batch
+    def summarize(self, timestamps, values):
+        keys = timestamps // self.summary
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+        rows = []
+        for key, low, high, total, count in zip(keys[starts].tolist(), np.minimum.reduceat(values, starts).tolist(), np.maximum.reduceat(values, starts).tolist(),
+                                                np.add.reduceat(values, starts).tolist(), np.diff(np.append(starts, len(values))).tolist()):
+            if self.bucket != None and self.bucket[0] != key:
+                rows.append(self.summaryRow())
+            if self.bucket == None:
+                self.bucket = [key, low, high, total, count]
+            else:
+                self.bucket = [key, min(self.bucket[1], low), max(self.bucket[2], high), self.bucket[3] + total, self.bucket[4] + count]
+        return rows
+
+    def summaryRow(self):
+        key, low, high, total, count = self.bucket
+        self.bucket = None
+        return (key*self.summary, total/count, low, high, count)
+
+    # the summary of the last (partial) period, at exit
+    def finish(self):
+        return [self.summaryRow()] if self.bucket != None else []
+
+
+# Writes the --trigger summaries of all devices to one CSV file (a line per device and summary period)
+class SummaryWriter:
+    def __init__(self, file_name, devices=None):
+        self.file = open(file_name, "w")
+        self.devices = devices if devices and len(devices) > 1 else None
+        self.lock = Lock()
+        self.file.write("Timestamp, Mean Amps, Min Amps, Max Amps, Samples{}\n".format(", Device" if self.devices else ""))
+
+    def write(self, rows, device=0):
+        if not rows:
+            return
+        times = format_timestamps([row[0] for row in rows]).tolist()
+        suffix = ",{}".format(self.devices[device]) if self.devices else ""
+        with self.lock:
+            self.file.write("".join("{},{},{},{},{}{}\n".format(ts, *row[1:], suffix) for ts, row in zip(times, rows)))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+# --trigger <condition>: (kind, threshold amps or None)
+def parse_trigger(condition):
+    kind, _, threshold = condition.partition(':')
+    kind = kind.upper()
+    if not kind in trigger_kinds:
+        raise ValueError("unknown trigger {}".format(kind))
+    if kind == 'STATE':
+        return kind, None
+    return kind, float(threshold)
+
+
+# --trigger summary file next to the --out file (or in the --out directory for rolling recordings)
+def trigger_summary_file(output_file_name, fmt):
+    if fmt in segment_formats:
+        return path.join(output_file_name, "summary.csv")
+    return path.splitext(output_file_name)[0] + "-summary.csv"
+
+
+# Binary capture format (--format BIN/BIN64), append-only and columnar:
+#   header: magic, version, amps item size (4 = float32, 8 = float64), 48 reserved bytes
+#   chunks: chunk magic, sample count, first/last timestamp, device index, int64 ns timestamps[count], amps[count] (padded to 8 bytes)
+#   index (written on close): (offset, count, first, last, device) per chunk, then index magic, index offset and chunk count
+# If the capture was not closed cleanly the index is missing and readers rebuild it by walking the chunk headers.
+bin_header = struct.Struct("<8sII48x")
+bin_chunk_header = struct.Struct("<4sIqqi4x")
+bin_index_trailer = struct.Struct("<8sqq")
+bin_index_dtype = np.dtype([('offset', '<i8'), ('count', '<i8'), ('first', '<i8'), ('last', '<i8'), ('device', '<i8')])
+
+
+class BinaryCaptureWriter:
+    def __init__(self, file, amps_dtype=np.float32, chunk_samples=8192):
+        self.file = file
+        self.amps_dtype = np.dtype(amps_dtype).newbyteorder('<')
+        self.chunk_samples = chunk_samples
+        self.index = []
+        # samples waiting for a full chunk: per device [(timestamps, amps)] and their count
+        self.pending = {}
+        self.pending_samples = {}
+        self.file.write(bin_header.pack(b"CRBIN\0\0\0", 1, self.amps_dtype.itemsize))
+        self.offset = bin_header.size
+
+    # samples are collected per device and written as chunks of at least chunk_samples (or on flush/close),
+    # so small batches don't each pay for a chunk header and an index entry
+    def writeChunk(self, timestamps, values, device=0):
+        if len(values) == 0:
+            return
+        self.pending.setdefault(device, []).append((np.array(timestamps, dtype='<i8'), np.array(values, dtype=self.amps_dtype)))
+        self.pending_samples[device] = self.pending_samples.get(device, 0) + len(values)
+        if self.pending_samples[device] >= self.chunk_samples:
+            self.writePending(device)
+
+    def writePending(self, device):
+        batches = self.pending.pop(device, None)
+        self.pending_samples.pop(device, None)
+        if not batches:
+            return
+        timestamps = np.concatenate([batch[0] for batch in batches])
+        amps = np.concatenate([batch[1] for batch in batches]).tobytes()
+        count = len(timestamps)
+        self.file.write(bin_chunk_header.pack(b"CHNK", count, int(timestamps[0]), int(timestamps[-1]), device))
+        self.file.write(timestamps.tobytes())
+        self.file.write(amps + b"\0"*(-len(amps) % 8))
+        self.index.append((self.offset, count, int(timestamps[0]), int(timestamps[-1]), device))
+        self.offset += bin_chunk_header.size + 8*count + len(amps) + (-len(amps) % 8)
+
+    def flush(self):
+        for device in list(self.pending):
+            self.writePending(device)
+        self.file.flush()
+
+    def close(self):
+        for device in list(self.pending):
+            self.writePending(device)
+        index = np.array(self.index, dtype=bin_index_dtype)
+        self.file.write(index.tobytes())
+        self.file.write(bin_index_trailer.pack(b"CRINDEX\0", self.offset, len(index)))
+        self.file.close()
+
+
+# Memory-mapped reader for binary captures: chunks are returned as numpy views, no parsing involved
+class BinaryCapture:
+    def __init__(self, filename):
+        self.mm = np.memmap(filename, dtype=np.uint8, mode='r')
+        magic, file_version, amps_size = bin_header.unpack_from(self.mm, 0)
+        if magic != b"CRBIN\0\0\0":
+            raise ValueError("{} is not a CurrentViewer binary capture".format(filename))
+        self.amps_dtype = np.dtype('<f4') if amps_size == 4 else np.dtype('<f8')
+        self.index = self.readIndex()
+
+    def readIndex(self):
+        if len(self.mm) >= bin_header.size + bin_index_trailer.size:
+            magic, offset, count = bin_index_trailer.unpack_from(self.mm, len(self.mm) - bin_index_trailer.size)
+            if magic == b"CRINDEX\0":
+                return self.mm[offset:offset + count*bin_index_dtype.itemsize].view(bin_index_dtype)
+
+        # no index (capture still running or not closed cleanly): walk the chunk headers
+        logging.info("Binary capture has no index, scanning chunks")
+        index = []
+        offset = bin_header.size
+        while offset + bin_chunk_header.size <= len(self.mm):
+            magic, count, first, last, device = bin_chunk_header.unpack_from(self.mm, offset)
+            size = bin_chunk_header.size + count*(8 + self.amps_dtype.itemsize)
+            size += -size % 8
+            if magic != b"CHNK" or offset + size > len(self.mm):
+                break
+            index.append((offset, count, first, last, device))
+            offset += size
+        return np.array(index, dtype=bin_index_dtype)
+
+    def __len__(self):
+        return int(self.index['count'].sum())
+
+    def devices(self):
+        return np.unique(self.index['device']).tolist()
+
+    def chunk(self, i):
+        offset, count = int(self.index['offset'][i]) + bin_chunk_header.size, int(self.index['count'][i])
+        timestamps = self.mm[offset:offset + 8*count].view('<i8')
+        amps = self.mm[offset + 8*count:offset + count*(8 + self.amps_dtype.itemsize)].view(self.amps_dtype)
+        return timestamps, amps
+
+    # yields (timestamps, amps) views of the chunks overlapping [t0, t1] (int64 ns, None = unbounded),
+    # of one device or of all devices (in capture order) if device is None
+    def chunks(self, t0=None, t1=None, device=None):
+        for i in range(len(self.index)):
+            if (t0 != None and self.index['last'][i] < t0) or (t1 != None and self.index['first'][i] > t1):
+                continue
+            if device != None and self.index['device'][i] != device:
+                continue
+            yield self.chunk(i)
+
+    def read(self, t0=None, t1=None, device=None):
+        parts = list(self.chunks(t0, t1, device))
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=self.amps_dtype)
+        timestamps = np.concatenate([part[0] for part in parts])
+        amps = np.concatenate([part[1] for part in parts])
+        keep = np.ones(len(timestamps), dtype=bool)
+        if t0 != None:
+            keep &= timestamps >= t0
+        if t1 != None:
+            keep &= timestamps <= t1
+        return timestamps[keep], amps[keep]
+
+
+# Streams a binary capture to CSV or JSON, one chunk (at most block samples) at a time
+def convert_capture(input_file_name, output_file_name, fmt, block=65536):
+    capture = BinaryCapture(input_file_name)
+    # multi-device captures keep the device index as an extra column
+    devices = len(capture.devices()) > 1
+    first = True
+    with open(output_file_name, "w") as out:
+        if fmt == 'CSV':
+            out.write(csv_header(devices))
+        elif fmt == 'JSON':
+            out.write("{\n\"data\":[\n")
+
+        for i in range(len(capture.index)):
+            timestamps, amps = capture.chunk(i)
+            device = int(capture.index['device'][i]) if devices else None
+            for start in range(0, len(amps), block):
+                out.write(format_samples(timestamps[start:start+block], amps[start:start+block], fmt, first, device))
+                first = False
+
+        if fmt == 'JSON':
+            out.write("\n]\n}\n")
+    return len(capture)
+
+
+# Loads the amps of a recorded capture (BIN or CSV) e.g. to replay it through the simulator
+# (the first device only for multi-device BIN captures)
+def load_trace(file_name):
+    if file_name.upper().endswith('.CSV'):
+        return np.loadtxt(file_name, delimiter=',', skiprows=1, usecols=1, dtype=np.float64, ndmin=1)
+    capture = BinaryCapture(file_name)
+    return np.concatenate([amps for _, amps in capture.chunks(device=capture.devices()[0])]).astype(np.float64)
+
+
+# Rolling recording (--format PARQUET, CSV.GZ or CSV.ZST, --out is then a directory): samples are written
+# to bounded, self-contained segments rotated by size (segment_max_mb) or when the wall clock enters a
+# new segment_seconds slot (slots are aligned, e.g. every hour on the hour). Each segment is written in
+# blocks (a Parquet row group or a compressed CSV member holding one flush worth of samples) so a power
+# loss only loses the blocks not yet written. Open segments end in .part. Closed segments are listed in
+# index.jsonl with their time range and the offset/time range of every block. Queries read only the
+# segments (and, for CSV, only the blocks) that overlap the requested range.
+segment_formats = {"PARQUET": ".parquet", "CSV.GZ": ".csv.gz", "CSV.ZST": ".csv.zst"}
+
+
+class SegmentWriter:
+    # a block is written when this many samples are pending, or at the first flush after block_seconds
+    block_samples = 65536
+    block_seconds = 10.0
+
+    def __init__(self, directory, fmt, devices=None, max_bytes=64*1024*1024, max_seconds=3600):
+        self.directory = directory
+        self.format = fmt
+        self.devices = devices if devices and len(devices) > 1 else None
+        self.max_bytes = max_bytes
+        self.slot_ns = int(max_seconds*1.0e9)
+        os.makedirs(directory, exist_ok=True)
+        if fmt == 'PARQUET':
+            import_parquet()
+        elif fmt == 'CSV.ZST':
+            import_zstandard()
+
+        self.segment = None
+        self.pending = []
+        self.pending_samples = 0
+        self.last_block = time.monotonic()
+        self.segments = 0
+
+    def writeChunk(self, timestamps, values, device=0):
+        # split the batch where it crosses into the next time slot
+        slots = timestamps // self.slot_ns
+        cuts = np.flatnonzero(np.diff(slots)) + 1
+        for part in np.split(np.arange(len(values)), cuts):
+            if len(part) == 0:
+                continue
+            # the rollover is one way: with several devices, a batch still in the previous slot goes to the
+            # current segment instead of reopening its slot
+            slot = int(slots[part[0]]) if self.segment == None else max(int(slots[part[0]]), self.segment["slot"])
+            if self.segment != None and (self.segment["slot"] != slot or self.segment["bytes"] >= self.max_bytes):
+                self.writeBlock()
+                self.closeSegment()
+            if self.segment == None:
+                self.openSegment(slot, int(timestamps[part[0]]))
+            self.pending.append((timestamps[part[0]:part[-1] + 1], values[part[0]:part[-1] + 1], device))
+            self.pending_samples += len(part)
+            if self.pending_samples >= self.block_samples:
+                self.writeBlock()
+
+    def openSegment(self, slot, first):
+        name = "segment-{}-{:04d}{}".format(format_timestamps([first])[0][:19].replace('-', '').replace(':', '').replace(' ', '-'), self.segments, segment_formats[self.format])
+        path_name = path.join(self.directory, name)
+        self.segment = {"slot": slot, "file": name, "first": None, "last": None, "samples": 0, "bytes": 0, "blocks": []}
+        self.segments += 1
+
+        if self.format == 'PARQUET':
+            self.writer = pq.ParquetWriter(path_name + ".part", self.schema(), compression="zstd")
+        else:
+            self.file = open(path_name + ".part", "wb")
+            # the header is a block of its own, every other block is plain rows
+            self.writeCompressed(csv_header(self.devices != None).encode())
+
+    def schema(self):
+        fields = [("time", pa.timestamp("ns")), ("amps", pa.float32())]
+        if self.devices:
+            fields.append(("device", pa.dictionary(pa.int8(), pa.string())))
+        return pa.schema(fields)
+
+    def compress(self, data):
+        if self.format == 'CSV.ZST':
+            return zstandard.ZstdCompressor(level=9).compress(data)
+        return gzip.compress(data, compresslevel=6)
+
+    def writeCompressed(self, data):
+        block = self.compress(data)
+        self.file.write(block)
+        self.segment["bytes"] += len(block)
+        return len(block)
+
+    def writeBlock(self):
+        if not self.pending:
+            return
+        timestamps = np.concatenate([batch[0] for batch in self.pending])
+        values = np.concatenate([batch[1] for batch in self.pending])
+        offset = self.segment["bytes"]
+
+        if self.format == 'PARQUET':
+            columns = {"time": pa.array(timestamps.view('datetime64[ns]')), "amps": pa.array(values.astype(np.float32))}
+            if self.devices:
+                devices = np.concatenate([np.full(len(batch[1]), batch[2], dtype=np.int8) for batch in self.pending])
+                columns["device"] = pa.DictionaryArray.from_arrays(pa.array(devices), pa.array(self.devices))
+            self.writer.write_table(pa.table(columns, schema=self.schema()), row_group_size=len(values))
+            self.segment["bytes"] = os.path.getsize(path.join(self.directory, self.segment["file"] + ".part"))
+        else:
+            text = "".join([format_samples(batch[0], batch[1], 'CSV', device=self.devices[batch[2]] if self.devices else None) for batch in self.pending])
+            self.writeCompressed(text.encode())
+
+        # a block holds the batches of every device, which are only in order per device
+        first, last = int(timestamps.min()), int(timestamps.max())
+        self.segment["first"] = first if self.segment["first"] == None else min(self.segment["first"], first)
+        self.segment["last"] = last if self.segment["last"] == None else max(self.segment["last"], last)
+        self.segment["samples"] += len(values)
+        self.segment["blocks"].append([offset, first, last])
+        self.pending = []
+        self.pending_samples = 0
+        self.last_block = time.monotonic()
+
+    def closeSegment(self):
+        segment = self.segment
+        self.segment = None
+        part_name = path.join(self.directory, segment["file"] + ".part")
+        if self.format == 'PARQUET':
+            self.writer.close()
+        else:
+            self.file.close()
+        segment["bytes"] = os.path.getsize(part_name)
+
+        if segment["samples"] == 0:
+            os.remove(part_name)
+            return
+        os.replace(part_name, path.join(self.directory, segment["file"]))
+
+        entry = {key: segment[key] for key in ("file", "first", "last", "samples", "bytes", "blocks")}
+        with open(path.join(self.directory, "index.jsonl"), "a") as index:
+            index.write(json.dumps(entry) + "\n")
+            index.flush()
+            os.fsync(index.fileno())
+        logging.info("Recording segment {} closed: {} samples, {} bytes".format(segment["file"], segment["samples"], segment["bytes"]))
+
+    # called by the export writer every flush interval
+    def flush(self):
+        if self.segment != None and time.monotonic() - self.last_block >= self.block_seconds:
+            self.writeBlock()
+            if self.format != 'PARQUET':
+                self.file.flush()
+
+    def close(self):
+        if self.segment != None:
+            self.writeBlock()
+            self.closeSegment()
+
+
+# Reader for the segment directories written by SegmentWriter. Segments that were never closed
+# (.part files, e.g. after a power loss) are not in the index and are scanned entirely.
+class Recording:
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = []
+        index_name = path.join(directory, "index.jsonl")
+        if path.exists(index_name):
+            with open(index_name) as index:
+                for line in index:
+                    try:
+                        self.index.append(json.loads(line))
+                    except ValueError:
+                        # torn last line
+                        break
+        indexed = set(entry["file"] for entry in self.index)
+        for name in sorted(os.listdir(directory)):
+            if name.startswith("segment-") and not name in indexed:
+                self.index.append({"file": name, "first": None, "last": None, "samples": None, "blocks": None})
+        self.index.sort(key=lambda entry: entry["file"])
+
+    def __len__(self):
+        return len(self.index)
+
+    # index entries of the segments overlapping [t0, t1] (int64 ns, None = unbounded)
+    def segments(self, t0=None, t1=None):
+        return [entry for entry in self.index if entry["first"] == None or not ((t0 != None and entry["last"] < t0) or (t1 != None and entry["first"] > t1))]
+
+    # returns (int64 ns timestamps, float64 amps, device names or None) of the samples in [t0, t1]
+    def read(self, t0=None, t1=None):
+        parts = [self.readSegment(entry, t0, t1) for entry in self.segments(t0, t1)]
+        parts = [part for part in parts if len(part[0])]
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), None
+        timestamps = np.concatenate([part[0] for part in parts])
+        amps = np.concatenate([part[1] for part in parts])
+        devices = np.concatenate([part[2] for part in parts]) if all(part[2] is not None for part in parts) else None
+        keep = np.ones(len(timestamps), dtype=bool)
+        if t0 != None:
+            keep &= timestamps >= t0
+        if t1 != None:
+            keep &= timestamps <= t1
+        return timestamps[keep], amps[keep], devices[keep] if devices is not None else None
+
+    def readSegment(self, entry, t0, t1):
+        file_name = path.join(self.directory, entry["file"])
+        if ".parquet" in entry["file"]:
+            import pandas as pd
+            import_parquet()
+            filters = [("time", ">=", pd.Timestamp(t0, unit="ns"))] if t0 != None else []
+            filters += [("time", "<=", pd.Timestamp(t1, unit="ns"))] if t1 != None else []
+            table = pq.read_table(file_name, filters=filters or None)
+            devices = table.column("device").to_numpy(zero_copy_only=False).astype(str) if "device" in table.column_names else None
+            return table.column("time").to_numpy().astype('datetime64[ns]').view(np.int64), table.column("amps").to_numpy().astype(np.float64), devices
+
+        with open(file_name, "rb") as f:
+            data = f.read()
+        blocks = entry["blocks"]
+        if blocks:
+            # only the blocks overlapping the range (each block is an independent compressed member)
+            ends = [block[0] for block in blocks[1:]] + [len(data)]
+            data = b"".join(data[block[0]:end] for block, end in zip(blocks, ends) if not ((t0 != None and block[2] < t0) or (t1 != None and block[1] > t1)))
+        return parse_csv_block(self.decompress(data, entry["file"]))
+
+    # decompresses all the complete members/frames (a truncated last one is dropped)
+    @staticmethod
+    def decompress(data, name):
+        out = []
+        if ".zst" in name:
+            if not import_zstandard():
+                raise ImportError("{} needs the zstandard package (pip install zstandard)".format(name))
+            reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True)
+            try:
+                while True:
+                    chunk = reader.read(1 << 20)
+                    if not chunk:
+                        break
+                    out.append(chunk)
+            except zstandard.ZstdError:
+                logging.warning("{}: truncated block skipped".format(name))
+            return b"".join(out)
+
+        while data:
+            member = zlib.decompressobj(wbits=31)
+            chunk = member.decompress(data)
+            if not member.eof:
+                logging.warning("{}: truncated block skipped".format(name))
+                break
+            out.append(chunk)
+            data = member.unused_data
+        return b"".join(out)
+
+
+# Parses a block of complete CSV lines as written by --out (an optional header line, and a device
+# column with several devices). Returns (int64 ns timestamps, float64 amps, device names or None)
+def parse_csv_block(data):
+    import pandas as pd
+    table = pd.read_csv(io.BytesIO(data), header=None, names=["Timestamp", "Amps", "Device"], dtype={"Timestamp": str, "Device": str}, skipinitialspace=True)
+    table = table[table["Timestamp"] != "Timestamp"]
+    devices = table["Device"].to_numpy(dtype=str) if table["Device"].notna().any() else None
+    return np.asarray(table["Timestamp"].to_numpy(dtype=str), dtype='datetime64[ns]').view(np.int64), table["Amps"].to_numpy(dtype=np.float64), devices
+
+
+json_sample = re.compile(rb'"time":"([^"]+)","amps":"([^"]+)"(?:,"device":"([^"]*)")?')
+
+# Same for a block of complete JSON lines (one {"time", "amps"[, "device"]} item per line)
+def parse_json_block(data):
+    items = json_sample.findall(data)
+    if not items:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), None
+    times, amps, devices = zip(*items)
+    devices = np.array(devices).astype(str) if devices[0] else None
+    return np.array(times).astype('datetime64[ns]').view(np.int64), np.array(amps).astype(np.float64), devices
+
+
+# Chunked reader over any capture written by CurrentViewer: CSV or JSON (--out), BIN/BIN64, or a
+# recording directory (PARQUET, CSV.GZ, CSV.ZST). chunks() streams the whole capture in bounded
+# memory and remembers where each chunk is and its time range, so read(t0, t1) can later go straight
+# to the chunks that overlap a time range.
+class CaptureFile:
+    block_bytes = 8*1024*1024
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        if path.isdir(file_name):
+            self.kind = 'RECORDING'
+            self.recording = Recording(file_name)
+        else:
+            with open(file_name, "rb") as f:
+                magic = f.read(8)
+            if magic == b"CRBIN\0\0\0":
+                self.kind = 'BIN'
+                self.binary = BinaryCapture(file_name)
+                # device indexes, looked up once (unique over the whole chunk index)
+                self.binary_devices = self.binary.devices()
+            else:
+                self.kind = 'JSON' if magic.lstrip().startswith(b"{") else 'CSV'
+        # (location, first, last, samples) of every chunk, complete after a full chunks() pass
+        self.blocks = None
+
+    def locations(self):
+        if self.kind == 'BIN':
+            yield from range(len(self.binary.index))
+        elif self.kind == 'RECORDING':
+            yield from self.recording.index
+        else:
+            # blocks of complete lines: (offset, length)
+            with open(self.file_name, "rb") as f:
+                offset = 0
+                rest = b""
+                while True:
+                    data = f.read(self.block_bytes)
+                    block = rest + data
+                    if not block:
+                        break
+                    cut = block.rfind(b"\n") + 1 if data else len(block)
+                    if cut == 0:
+                        rest = block
+                        continue
+                    rest = block[cut:]
+                    yield (offset, cut)
+                    offset += cut
+
+    def load(self, location, t0=None, t1=None):
+        if self.kind == 'BIN':
+            timestamps, amps = self.binary.chunk(location)
+            devices = None
+            if len(self.binary_devices) > 1:
+                devices = np.full(len(amps), str(self.binary.index['device'][location]))
+            return timestamps, amps.astype(np.float64), devices
+        if self.kind == 'RECORDING':
+            return self.recording.readSegment(location, t0, t1)
+
+        with open(self.file_name, "rb") as f:
+            f.seek(location[0])
+            data = f.read(location[1])
+        return parse_json_block(data) if self.kind == 'JSON' else parse_csv_block(data)
+
+    # yields (int64 ns timestamps, float64 amps, device names or None) for the whole capture
+    def chunks(self):
+        blocks = []
+        for location in self.locations():
+            timestamps, amps, devices = self.load(location)
+            if len(amps):
+                # the blocks of a multi-device capture are only in time order per device
+                blocks.append((location, int(timestamps.min()), int(timestamps.max()), len(amps)))
+                yield timestamps, amps, devices
+        self.blocks = blocks
+
+    # names of the devices in the capture ([None] for a single device capture), may scan the capture
+    def devices(self):
+        if self.kind == 'BIN':
+            return [str(i) for i in self.binary_devices] if len(self.binary_devices) > 1 else [None]
+        names = set()
+        for timestamps, amps, devices in self.chunks():
+            if devices is not None:
+                names.update(np.unique(devices).tolist())
+        return sorted(names) if names else [None]
+
+    # samples between t0 and t1 (int64 ns, inclusive), only the overlapping chunks are read
+    def read(self, t0, t1):
+        if self.blocks == None:
+            for chunk in self.chunks():
+                pass
+        parts = [self.load(location, t0, t1) for location, first, last, count in self.blocks if first <= t1 and last >= t0]
+        parts = [part for part in parts if len(part[1])]
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), None
+        timestamps = np.concatenate([part[0] for part in parts])
+        amps = np.concatenate([part[1] for part in parts])
+        devices = np.concatenate([part[2] for part in parts]) if parts[0][2] is not None else None
+        keep = (timestamps >= t0) & (timestamps <= t1)
+        return timestamps[keep], amps[keep], devices[keep] if devices is not None else None
+
+    # number of samples in the chunks overlapping [t0, t1] (an upper bound of what read() returns)
+    def estimate(self, t0, t1):
+        return sum(count for location, first, last, count in self.blocks if first <= t1 and last >= t0)
+
+
+# splits a chunk by device: yields (name, timestamps, amps), name is None for single device captures
+def split_devices(timestamps, amps, devices):
+    if devices is None:
+        yield None, timestamps, amps
+        return
+    for name in np.unique(devices).tolist():
+        mask = devices == name
+        yield name, timestamps[mask], amps[mask]
+
+
+# Streaming min/max/mean overview of a capture of any length in at most ~2*max_points buckets:
+# samples are grouped in buckets of `width` samples and the width doubles (pairs of buckets are
+# merged) every time there are too many buckets.
+class CaptureOverview:
+    def __init__(self, max_points=chart_max_samples):
+        self.max_points = max_points
+        self.width = 1
+        self.ts = np.zeros(0, dtype=np.int64)
+        self.mins = np.zeros(0)
+        self.maxs = np.zeros(0)
+        self.sums = np.zeros(0)
+        self.counts = np.zeros(0, dtype=np.int64)
+        # samples of the incomplete last bucket
+        self.rest = (np.zeros(0, dtype=np.int64), np.zeros(0))
+
+    def add(self, timestamps, values):
+        timestamps = np.concatenate((self.rest[0], timestamps))
+        values = np.concatenate((self.rest[1], values))
+        full = len(values) - len(values) % self.width
+        self.rest = (timestamps[full:], values[full:])
+        if full:
+            edges = np.arange(0, full, self.width)
+            self.append(timestamps[edges], np.minimum.reduceat(values[:full], edges), np.maximum.reduceat(values[:full], edges),
+                        np.add.reduceat(values[:full], edges), np.full(len(edges), self.width))
+
+        while len(self.counts) >= 2*self.max_points:
+            pairs = len(self.counts)//2*2
+            self.ts, self.mins, self.maxs, self.sums, self.counts = (
+                np.concatenate((self.ts[:pairs:2], self.ts[pairs:])),
+                np.concatenate((np.minimum(self.mins[:pairs:2], self.mins[1:pairs:2]), self.mins[pairs:])),
+                np.concatenate((np.maximum(self.maxs[:pairs:2], self.maxs[1:pairs:2]), self.maxs[pairs:])),
+                np.concatenate((self.sums[:pairs:2] + self.sums[1:pairs:2], self.sums[pairs:])),
+                np.concatenate((self.counts[:pairs:2] + self.counts[1:pairs:2], self.counts[pairs:])))
+            self.width *= 2
+
+    def append(self, ts, mins, maxs, sums, counts):
+        self.ts = np.concatenate((self.ts, ts))
+        self.mins = np.concatenate((self.mins, mins))
+        self.maxs = np.concatenate((self.maxs, maxs))
+        self.sums = np.concatenate((self.sums, sums))
+        self.counts = np.concatenate((self.counts, counts))
+
+    # (ts datetime64, means, mins, maxs) of the buckets overlapping [t0, t1] (int64 ns, None = all)
+    def query(self, t0=None, t1=None):
+        ts, mins, maxs, sums, counts = self.ts, self.mins, self.maxs, self.sums, self.counts
+        if len(self.rest[1]):
+            rest_ts, rest = self.rest
+            ts, mins, maxs = np.append(ts, rest_ts[0]), np.append(mins, rest.min()), np.append(maxs, rest.max())
+            sums, counts = np.append(sums, rest.sum()), np.append(counts, len(rest))
+        i0 = 0 if t0 == None else max(0, np.searchsorted(ts, t0, side='right') - 1)
+        i1 = len(ts) if t1 == None else np.searchsorted(ts, t1, side='right')
+        return ts[i0:i1].view('datetime64[ns]'), sums[i0:i1]/counts[i0:i1], mins[i0:i1], maxs[i0:i1]
+
+
+# Writes the samples of a recording directory between t0 and t1 (int64 ns, None = unbounded) to a CSV or JSON file
+def extract_recording(directory, output_file_name, fmt, t0=None, t1=None):
+    timestamps, amps, devices = Recording(directory).read(t0, t1)
+    with open(output_file_name, "w") as out:
+        if fmt == 'CSV':
+            out.write(csv_header(devices is not None))
+        elif fmt == 'JSON':
+            out.write("{\n\"data\":[\n")
+
+        # runs of samples of the same device, written in blocks of at most 65536 samples
+        edges = np.arange(0, len(amps), 65536)
+        if devices is not None:
+            edges = np.union1d(edges, np.flatnonzero(devices[1:] != devices[:-1]) + 1)
+        first = True
+        for start, end in zip(edges.tolist(), np.append(edges[1:], len(amps)).tolist()):
+            out.write(format_samples(timestamps[start:end], amps[start:end], fmt, first, devices[start] if devices is not None else None))
+            first = False
+
+        if fmt == 'JSON':
+            out.write("\n]\n}\n")
+    return len(amps)
+
+
+# Writes exported samples from a dedicated thread so the acquisition loop never blocks on file I/O.
+# Batches are queued without blocking (dropped and counted if the queue is full), collected for
+# flush_interval seconds (or up to max_samples) then formatted in bulk, written as one block and flushed.
+# With several devices (names in capture order) every sample is tagged with its device.
+# A failed write (disk full, drive removed) stops the export: the error is reported and kept in `error`,
+# the later batches are dropped and counted.
+class ExportWriter:
+    def __init__(self, file, fmt, flush_interval=1.0, max_batches=1024, devices=None, max_samples=65536):
+        self.file = file
+        self.format = fmt
+        self.devices = devices if devices and len(devices) > 1 else None
+        self.flush_interval = flush_interval
+        self.max_samples = max_samples
+        self.queue = queue.Queue(maxsize=max_batches)
+        self.first = True
+        self.written_samples = 0
+        self.dropped_batches = 0
+        self.dropped_samples = 0
+        self.max_queue_depth = 0
+        self.error = None
+        self.thread = Thread(target=self.run, name="ExportWriter", daemon=True)
+        self.thread.start()
+
+    def write(self, timestamps, values, device=0):
+        if self.error:
+            self.drop(len(values))
+            return
+        try:
+            self.queue.put_nowait((timestamps, values, device))
+        except queue.Full:
+            self.drop(len(values))
+
+    def drop(self, samples, batches=1):
+        self.dropped_batches += batches
+        self.dropped_samples += samples
+        metrics.count("export_dropped_samples_total", samples)
+
+    def run(self):
+        last_write = time.monotonic()
+        reported_drops = 0
+        pending = []
+        pending_samples = 0
+        running = True
+
+        while running:
+            # batches accumulate until flush_interval has passed since the last write (or max_samples are
+            # waiting), then they are formatted and written as one block
+            try:
+                batch = self.queue.get(timeout=None if self.error else max(0.0, last_write + self.flush_interval - time.monotonic()))
+                if batch == None:
+                    running = False
+                else:
+                    pending.append(batch)
+                    pending_samples += len(batch[1])
+            except queue.Empty:
+                pass
+
+            # after a write error the queue is only drained, so close() is not blocked
+            if self.error:
+                self.drop(pending_samples, len(pending))
+                pending = []
+                pending_samples = 0
+                continue
+
+            if running and pending_samples < self.max_samples and time.monotonic() - last_write < self.flush_interval:
+                continue
+
+            # batches still queued behind the ones about to be written (the collected ones are not a backlog)
+            depth = self.queue.qsize()
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            metrics.gauge("export_queue_depth", depth)
+
+            # the batches of each device are written as one block (stable sort, the samples stay in order)
+            pending_batches = len(pending)
+            try:
+                for device, group in groupby(sorted(pending, key=lambda batch: batch[2]), key=lambda batch: batch[2]):
+                    start = time.perf_counter()
+                    group = list(group)
+                    timestamps = np.concatenate([batch[0] for batch in group])
+                    values = np.concatenate([batch[1] for batch in group])
+                    if isinstance(self.file, (BinaryCaptureWriter, SegmentWriter)):
+                        self.file.writeChunk(timestamps, values, device)
+                    else:
+                        self.file.write(format_samples(timestamps, values, self.format, self.first, self.devices[device] if self.devices else None))
+                    self.first = False
+                    self.written_samples += len(values)
+                    pending_batches -= len(group)
+                    pending_samples -= len(values)
+                    metrics.observe("export_write_seconds", time.perf_counter() - start)
+                self.file.flush()
+            except (OSError, ValueError) as e:
+                self.error = e
+                self.drop(pending_samples, pending_batches)
+                logging.error("Export writer failed, no more samples are saved: {}".format(e))
+                print("Could not write the output file, no more samples are saved: {}".format(e), file=sys.stderr)
+            pending = []
+            pending_samples = 0
+            last_write = time.monotonic()
+
+            if self.dropped_batches != reported_drops and not self.error:
+                reported_drops = self.dropped_batches
+                logging.warning("Export writer is falling behind: queue depth {}/{}, dropped {} batches ({} samples)".format(depth, self.queue.maxsize, self.dropped_batches, self.dropped_samples))
+
+    def stats(self):
+        return {"written_samples": self.written_samples, "queue_depth": self.queue.qsize(), "max_queue_depth": self.max_queue_depth,
+                "dropped_batches": self.dropped_batches, "dropped_samples": self.dropped_samples, "error": str(self.error) if self.error else None}
+
+    # drains the queue and stops the writer thread (the file itself is left open)
+    def close(self, timeout=10.0):
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+                self.thread.join()
+            except queue.Full:
+                logging.error("Export writer is not draining its queue, {} batches are lost".format(self.queue.qsize()))
+        logging.info("Export writer closed: {}".format(self.stats()))
+
+
+# Streaming protocol (--serve/--connect), over plain TCP or WebSocket on the same port:
+#   the client sends its subscription as one JSON line (TCP) or text message (WebSocket), again to change it:
+#     {"points": 1024, "window": 10.0, "frames": true, "raw": false}
+#       points/window: resolution of the decimated frames (about points chart points, up to 2x with the
+#       min/max buckets, over the last window seconds, 0 = the whole buffer)
+#       frames/raw: send decimated frames and/or every sample
+#   the server sends messages of a type byte and a little endian payload, prefixed by its uint32 size on
+#   TCP (type byte included) and one binary message each on WebSocket:
+#     'H' hello: JSON {"version", "device", "devices": [names], "fps", "capacity"}
+#     'F' frame: stream_frame_header (device, points, samples received, last/mean amps over the window,
+#         charge mAh, SPS), then int64 ns timestamps, float32 means, mins and maxs of the points
+#     'R' raw batch: stream_raw_header (device, count, index of the first sample since the server
+#         started, its int64 ns timestamp), then uint32 ns offsets from it and float32 amps
+stream_message_header = struct.Struct("<IB")
+stream_frame_header = struct.Struct("<iiqdddd")
+stream_raw_header = struct.Struct("<iiqq")
+websocket_guid = b"258EAFA5-E914-47DA-95CA-C5AB0DC11B85"
+# largest client message (HTTP upgrade request, subscription line or WebSocket frame) the server accepts
+stream_max_request = 64*1024
+
+
+class StreamMessageTooLarge(ValueError):
+    pass
+
+
+def encode_frame(device, timestamps, means, mins, maxs, samples, last, mean, charge, sps):
+    return b"F" + stream_frame_header.pack(device, len(means), samples, last, mean, charge, sps) + b"".join([
+        np.ascontiguousarray(timestamps).view(np.int64).astype('<i8').tobytes(), np.asarray(means, dtype='<f4').tobytes(),
+        np.asarray(mins, dtype='<f4').tobytes(), np.asarray(maxs, dtype='<f4').tobytes()])
+
+
+# raw samples as batches of at most ~4.29s each (uint32 ns offsets)
+def encode_raw(device, index, timestamps, values):
+    messages = []
+    while len(values):
+        count = int(np.searchsorted(timestamps, timestamps[0] + 0xFFFFFFFF, side='right'))
+        messages.append(b"R" + stream_raw_header.pack(device, count, index, int(timestamps[0])) +
+                        (timestamps[:count] - timestamps[0]).astype('<u4').tobytes() + np.asarray(values[:count], dtype='<f4').tobytes())
+        timestamps, values, index = timestamps[count:], values[count:], index + count
+    return messages
+
+
+def decode_message(message):
+    kind, payload = message[:1], memoryview(message)[1:]
+    if kind == b"H":
+        return "hello", json.loads(bytes(payload))
+    if kind == b"F":
+        device, points, samples, last, mean, charge, sps = stream_frame_header.unpack_from(payload)
+        columns = payload[stream_frame_header.size:]
+        timestamps = np.frombuffer(columns, dtype='<i8', count=points)
+        means, mins, maxs = np.frombuffer(columns, dtype='<f4', count=3*points, offset=8*points).reshape(3, points).astype(np.float64)
+        return "frame", {"device": device, "timestamps": timestamps, "means": means, "mins": mins, "maxs": maxs,
+                         "samples": samples, "last": last, "mean": mean, "charge": charge, "sps": sps}
+    if kind == b"R":
+        device, count, index, first = stream_raw_header.unpack_from(payload)
+        columns = payload[stream_raw_header.size:]
+        timestamps = first + np.frombuffer(columns, dtype='<u4', count=count).astype(np.int64)
+        # float32 like the BIN captures, exports format them with their own shortest representation
+        values = np.frombuffer(columns, dtype='<f4', count=count, offset=4*count)
+        return "raw", (device, index, timestamps, values)
+    return None, None
+
+
+def read_exactly(connection, size):
+    data = b""
+    while len(data) < size:
+        try:
+            chunk = connection.recv(size - len(data))
+        except socket.timeout:
+            # only a timeout between messages is reported, never in the middle of one
+            if data:
+                continue
+            raise
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+# WebSocket (RFC 6455) frames: the server sends unmasked binary frames, reads masked client frames
+def websocket_frame(payload, opcode=0x2):
+    size = len(payload)
+    if size < 126:
+        header = struct.pack("!BB", 0x80 | opcode, size)
+    elif size < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, size)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, size)
+    return header + payload
+
+
+# frames over max_size bytes raise StreamMessageTooLarge before their payload is read
+def read_websocket_frame(connection, max_size=None):
+    first, second = read_exactly(connection, 2)
+    size = second & 0x7F
+    if size == 126:
+        size = struct.unpack("!H", read_exactly(connection, 2))[0]
+    elif size == 127:
+        size = struct.unpack("!Q", read_exactly(connection, 8))[0]
+    if max_size != None and size > max_size:
+        raise StreamMessageTooLarge("WebSocket frame of {} bytes (limit {})".format(size, max_size))
+    mask = read_exactly(connection, 4) if second & 0x80 else None
+    payload = read_exactly(connection, size)
+    if mask:
+        payload = (np.frombuffer(payload, dtype=np.uint8) ^ np.resize(np.frombuffer(mask, dtype=np.uint8), size)).tobytes()
+    return first & 0x0F, payload
+
+
+# One subscriber of the StreamServer: a reader thread follows its subscription, a writer thread sends
+# the messages queued by the publisher. The queue is bounded and never waited on, a slow client
+# loses messages (counted) instead of holding back the publisher or the capture.
+class StreamConnection:
+    def __init__(self, server, connection, address):
+        self.server = server
+        self.connection = connection
+        self.address = address
+        self.websocket = False
+        self.subscription = None
+        self.queue = queue.Queue(maxsize=64)
+        # the writer thread and the reader's close frame share the socket
+        self.send_lock = Lock()
+        self.open = True
+        Thread(target=self.read, name="StreamReader", daemon=True).start()
+
+    def subscribe(self, data):
+        try:
+            subscription = json.loads(data)
+            self.subscription = {"points": max(2, min(100000, int(subscription.get("points", chart_max_samples)))),
+                                 "window": max(0.0, float(subscription.get("window", 0.0))),
+                                 "frames": bool(subscription.get("frames", True)), "raw": bool(subscription.get("raw", False))}
+            logging.info("Stream client {} subscribed: {}".format(self.address, self.subscription))
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.warning("Stream client {}: invalid subscription {}: {}".format(self.address, data, e))
+
+    def read(self):
+        try:
+            data = self.connection.recv(4096)
+            if data.startswith(b"GET "):
+                while not b"\r\n\r\n" in data:
+                    if len(data) > stream_max_request:
+                        raise StreamMessageTooLarge("HTTP request over {} bytes".format(stream_max_request))
+                    chunk = self.connection.recv(4096)
+                    if not chunk:
+                        raise ConnectionError("connection closed")
+                    data += chunk
+                key = re.search(rb"(?im)^sec-websocket-key:\s*(\S+)", data)
+                if key == None:
+                    self.connection.sendall(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+                    raise ConnectionError("not a WebSocket request")
+                accept = base64.b64encode(hashlib.sha1(key.group(1) + websocket_guid).digest())
+                self.connection.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+                self.websocket = True
+                data = b""
+
+            Thread(target=self.write, name="StreamWriter", daemon=True).start()
+            self.send(b"H" + json.dumps(self.server.hello()).encode())
+
+            while self.open:
+                if self.websocket:
+                    opcode, payload = read_websocket_frame(self.connection, stream_max_request)
+                    if opcode == 0x8:
+                        break
+                    if opcode == 0x9:
+                        self.send(payload, opcode=0xA)
+                    elif opcode in (0x1, 0x2):
+                        self.subscribe(payload)
+                else:
+                    while b"\n" in data:
+                        line, data = data.split(b"\n", 1)
+                        if line.strip():
+                            self.subscribe(line)
+                    if len(data) > stream_max_request:
+                        raise StreamMessageTooLarge("line over {} bytes".format(stream_max_request))
+                    chunk = self.connection.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+        except StreamMessageTooLarge as e:
+            logging.warning("Stream client {}: {}, closing".format(self.address, e))
+            if self.websocket:
+                # 1009: message too big
+                self.sendNow(websocket_frame(struct.pack("!H", 1009), opcode=0x8))
+        except OSError as e:
+            logging.debug("Stream client {}: {}".format(self.address, e))
+        except Exception as e:
+            logging.warning("Stream client {}: {}".format(self.address, e))
+        finally:
+            self.close()
+
+    def send(self, message, opcode=0x2):
+        try:
+            self.queue.put_nowait(websocket_frame(message, opcode) if self.websocket else stream_message_header.pack(len(message), message[0]) + message[1:])
+        except queue.Full:
+            metrics.count("stream_dropped_messages_total")
+
+    def write(self):
+        while self.open:
+            message = self.queue.get()
+            if message == None:
+                break
+            if not self.sendNow(message):
+                break
+        self.close()
+
+    def sendNow(self, message):
+        try:
+            with self.send_lock:
+                self.connection.sendall(message)
+            return True
+        except OSError as e:
+            logging.debug("Stream client {}: {}".format(self.address, e))
+            return False
+
+    def close(self):
+        if self.open:
+            self.open = False
+            self.server.remove(self)
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.connection.close()
+
+
+# Publishes the devices' buffers to any number of clients (--serve). A publisher thread wakes up fps
+# times per second and, per device, encodes every new sample once for all the raw subscribers and every
+# (points, window) resolution once for all the frame subscribers of that resolution. It only reads the
+# buffers (like the chart does), so clients come and go without touching the capture.
+class StreamServer:
+    def __init__(self, devices, host="127.0.0.1", port=8765, fps=15):
+        self.devices = devices
+        self.fps = fps
+        self.clients = []
+        self.lock = Lock()
+        self.running = True
+        # samples already published (buffer counts)
+        self.published = [device.buffer.count for device in devices]
+        self.origin = list(self.published)
+        self.listener = socket.create_server((host, port))
+        self.address = self.listener.getsockname()
+        Thread(target=self.accept, name="StreamAccept", daemon=True).start()
+        self.thread = Thread(target=self.run, name="StreamPublisher", daemon=True)
+        self.thread.start()
+        logging.info("Streaming on {}:{}".format(*self.address[:2]))
+
+    def hello(self):
+        return {"version": version, "device": connected_device, "devices": [device.name for device in self.devices],
+                "fps": self.fps, "capacity": self.devices[0].buffer.capacity}
+
+    def accept(self):
+        while self.running:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                break
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.clients.append(StreamConnection(self, connection, address))
+                metrics.gauge("stream_clients", len(self.clients))
+            logging.info("Stream client {} connected".format(address))
+
+    def remove(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+            metrics.gauge("stream_clients", len(self.clients))
+        logging.info("Stream client {} disconnected".format(client.address))
+
+    def run(self):
+        while self.running:
+            start = time.monotonic()
+            with self.lock:
+                clients = [client for client in self.clients if client.subscription != None]
+            for i, device in enumerate(self.devices):
+                self.publish(i, device, clients)
+            time.sleep(max(0.0, 1.0/self.fps - (time.monotonic() - start)))
+
+    def publish(self, i, device, clients):
+        buffer = device.buffer
+        count = buffer.count
+        new = count - self.published[i]
+        self.published[i] = count
+        if new <= 0 or len(buffer) < 2:
+            return
+
+        raw = [client for client in clients if client.subscription["raw"]]
+        if raw:
+            timestamps, values = buffer.last(new)
+            for message in encode_raw(i, count - len(values) - self.origin[i], timestamps, values):
+                for client in raw:
+                    client.send(message)
+
+        # one frame per resolution, shared by the clients that asked for it
+        frames = {}
+        for client in clients:
+            if client.subscription["frames"]:
+                frames.setdefault((client.subscription["points"], client.subscription["window"]), []).append(client)
+        for (points, window), subscribers in frames.items():
+            window_ts, window_data = buffer.last()
+            t1 = int(window_ts[-1])
+            t0 = t1 - int(window*1.0e9) if window > 0 else int(window_ts[0])
+            start = time.perf_counter()
+            if buffer.pyramid:
+                timestamps, means, mins, maxs = buffer.pyramid.query(t0, t1, points)
+            else:
+                timestamps, means, mins, maxs = decimate_minmax(window_ts[np.searchsorted(window_ts, t0):], window_data[np.searchsorted(window_ts, t0):], points)
+            metrics.observe("decimate_seconds", time.perf_counter() - start)
+            visible = window_data[np.searchsorted(window_ts, t0):]
+            message = encode_frame(i, timestamps, means, mins, maxs, device.sample_count, float(window_data[-1]),
+                                   float(np.mean(visible)), device.stats.chargeMah(), device.sps())
+            for client in subscribers:
+                client.send(message)
+
+    def close(self):
+        self.running = False
+        self.listener.close()
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+
+
+# Client side of the streaming protocol: connects, subscribes and yields the decoded messages
+class StreamClient:
+    def __init__(self, host, port, points=chart_max_samples, window=0.0, frames=False, raw=True, timeout=5.0):
+        self.connection = socket.create_connection((host, port), timeout=timeout)
+        self.connection.sendall(json.dumps({"points": points, "window": window, "frames": frames, "raw": raw}).encode() + b"\n")
+        # local clock minus the server's: the samples keep the server's timestamps
+        self.clock_offset = 0
+        self.clock_synced = False
+        kind, self.hello = self.receive()
+        if kind != "hello":
+            raise ConnectionError("unexpected stream server reply")
+
+    # next (kind, payload) message, None when no message arrived within the timeout
+    def receive(self):
+        try:
+            size, kind = stream_message_header.unpack(read_exactly(self.connection, stream_message_header.size))
+        except socket.timeout:
+            return None
+        message = decode_message(bytes([kind]) + read_exactly(self.connection, size - 1))
+        if message[0] == "raw" and len(message[1][2]):
+            # the smallest gap between receiving a batch and its last sample is the clock difference plus
+            # the shortest transit time
+            offset = clock_ns() - int(message[1][2][-1])
+            self.clock_offset = offset if not self.clock_synced else min(self.clock_offset, offset)
+            self.clock_synced = True
+        return message
+
+    def close(self):
+        self.connection.close()
+
+
+# Simulated CurrentRanger for testing and benchmarks without the hardware. The device side of a
+# pseudo-terminal streams samples at `rate` SPS while USB logging is on, and toggles logging on every
+# 'u' it receives (printing USB_LOGGING_ENABLED/DISABLED like the firmware). Samples are either a
+# synthetic sleep/idle/radio cycle or a recorded trace (amps array) played back in a loop, with some
+# negative readings and corrupted lines mixed in. POSIX only (needs pty).
+class SimulatedRanger:
+    def __init__(self, rate=800, trace=None, logging_enabled=False, negative_rate=0.005, corrupt_rate=0.0002, seed=None):
+        self.rate = rate
+        self.trace = None if trace is None else np.asarray(trace, dtype=np.float64)
+        self.logging_enabled = logging_enabled
+        self.negative_rate = negative_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = np.random.default_rng(seed)
+        self.running = False
+        self.thread = None
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.sent_samples = 0
+        self.dropped_bytes = 0
+
+    def start(self):
+        import pty, tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = Thread(target=self.run, name="SimulatedRanger", daemon=True)
+        self.thread.start()
+        logging.info("Simulated {} streaming {} SPS on {}".format(connected_device, self.rate, self.port))
+        return self.port
+
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join()
+        for fd in (self.master, self.slave):
+            if fd != None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    # amps for the absolute sample indices: 1s cycle of ~900ms deep sleep, ~80ms idle and ~20ms radio bursts
+    def samples(self, index):
+        if self.trace is not None:
+            return self.trace[index % len(self.trace)]
+
+        phase = (index % self.rate) / self.rate
+        amps = np.select([phase < 0.9, phase < 0.98], [80e-9, 25e-6], 30e-3)
+        amps = amps * self.random.lognormal(0.0, 0.15, len(index))
+        # short TX peaks inside the radio window
+        amps = np.where((phase >= 0.98) & (self.random.random(len(index)) < 0.05), 120e-3, amps)
+        negative = self.random.random(len(index)) < self.negative_rate
+        return np.where(negative, -amps*self.random.random(len(index)), amps)
+
+    def encode(self, amps):
+        lines = ["{:.3e}\r\n".format(amp) for amp in amps.tolist()]
+        for i in np.flatnonzero(self.random.random(len(lines)) < self.corrupt_rate):
+            # truncated or garbled lines, like the ones seen on a busy USB bus
+            lines[i] = lines[i][:self.random.integers(1, len(lines[i]))] + ("\r\n" if i % 2 else "\x00\x7f?")
+        return "".join(lines).encode("ascii")
+
+    def write(self, data):
+        try:
+            written = os.write(self.master, data)
+        except BlockingIOError:
+            written = 0
+        self.dropped_bytes += len(data) - written
+
+    def run(self):
+        start = time.monotonic()
+        produced = 0
+        while self.running:
+            try:
+                commands = os.read(self.master, 64)
+            except BlockingIOError:
+                commands = b''
+
+            for _ in range(commands.count(b'u')):
+                self.logging_enabled = not self.logging_enabled
+                self.write(b"USB_LOGGING_ENABLED\r\n" if self.logging_enabled else b"USB_LOGGING_DISABLED\r\n")
+
+            due = int((time.monotonic() - start)*self.rate)
+            if self.logging_enabled and due > produced:
+                # at most 100ms worth of samples per write, the rest is caught up in the next iterations
+                count = min(due - produced, max(1, self.rate // 10))
+                self.write(self.encode(self.samples(np.arange(produced, produced + count))))
+                self.sent_samples += count
+                produced += count
+            else:
+                produced = max(produced, due) if not self.logging_enabled else produced
+                time.sleep(0.002)
+
+
 class CRPlot:
-    def __init__(self, sample_buffer = 100):
+    # name labels the device in the chart and exports when capturing from several devices (device = its index),
+    # peers are the other devices drawn in this device's chart
+    def __init__(self, sample_buffer = 100, name = None, device = 0):
         self.port = '/dev/ttyACM0'
+        self.name = name
+        self.device = device
+        self.peers = []
         self.baud = 9600
         self.thread = None
         self.stream_data = True
         self.pause_chart = False
         self.sample_count = 0
+        # set by the first stored samples (or when streaming ends), serialStart waits on it
+        self.receiving = Event()
         self.animation_index = 0
-        self.max_samples = sample_buffer
-        self.data = collections.deque(maxlen=sample_buffer)
-        self.timestamps = collections.deque(maxlen=sample_buffer)
+        # a buffer size, or a ready made buffer (e.g. a SharedSampleBuffer)
+        self.buffer = sample_buffer if isinstance(sample_buffer, SampleBuffer) else SampleBuffer(sample_buffer)
+        self.max_samples = self.buffer.capacity
+        self.stats = StreamStats()
+        self.detector = PowerStateDetector(state_thresholds)
+        self.trigger = CaptureTrigger(**trigger_settings()) if trigger_condition else None
         self.dataStartTS = None
         self.serialConnection = None
+        self.process = None
+        # --open: the capture file shown (statically) and the overview of this device's samples
+        self.capture = None
+        self.overview = None
+        # --replay: (capture file, speed)
+        self.replay = None
+        # --connect: StreamClient of the server streaming the samples, and the local clock minus the server's (ns)
+        self.remote = None
+        self.clock_offset = 0
+        # animation being saved: (process, progress queue, file name), None when idle
+        self.export = None
+        self.export_timer = None
         self.framerate = 30
+        self.envelopes = []
+        self.lines = None
+        self.deviceLines = []
+        self.lastText = None
+        self.legend = None
+        self.blit = False
+        self.background = None
+        self.redraw_needed = True
+        self.xlim = None
+        # (start ns, xlim) of the wake-up shown by the last previous/next jump
+        self.wakeup = None
+        self.timer = None
+        self.refresh_interval = refresh_interval
+        self.frame_time = 0.0
 
     def serialStart(self, port, speed = 115200):
         self.port = port
         self.baud = speed
         logging.info("Trying to connect to port='{}' baud='{}'".format(port, speed))
         try:
-            self.serialConnection = serial.Serial(self.port, self.baud, timeout=5)
+            self.serialConnection = serial.serial_for_url(self.port, self.baud, timeout=5)
             logging.info("Connected to {} at baud {}".format(port, speed))
         except serial.SerialException as e:
             logging.error("Error connecting to serial port: {}".format(e))
@@ -81,12 +2600,8 @@ class CRPlot:
             self.thread = Thread(target=self.serialStream)
             self.thread.start()
 
-            print('Initializing data capture:', end='')
-            wait_timeout = 100
-            while wait_timeout > 0 and self.sample_count == 0:
-                print('.', end='', flush=True)
-                time.sleep(0.01)
-                wait_timeout -= 1
+            print('Initializing data capture:', end='', flush=True)
+            self.receiving.wait(timeout=1.0)
 
             if (self.sample_count == 0):
                 logging.error("Error: No data samples received. Aborting")
@@ -96,55 +2611,185 @@ class CRPlot:
             return True
 
 
+    # GUI side of --process: waits for the acquisition process to start streaming into this device's
+    # shared ring, then follows the ring from a thread (the chart reads the ring directly)
+    def ringStart(self, process, timeout=10.0):
+        self.process = process
+        logging.info("Waiting for the acquisition process to stream into {}".format(self.buffer.name))
+        deadline = time.monotonic() + timeout
+        while self.buffer.state() == SharedSampleBuffer.STARTING and process.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        if self.buffer.state() != SharedSampleBuffer.STREAMING:
+            logging.error("Error: the acquisition process did not start streaming. Aborting")
+            return False
+
+        if self.thread == None:
+            self.thread = Thread(target=self.ringStream)
+            self.thread.start()
+        return True
+
+    # --connect: follows the raw samples of a StreamServer, dispatched to this device and its peers
+    # (in the server's device order) as if they were read from local ports
+    def remoteStart(self, client):
+        self.remote = client
+        self.dataStartTS = datetime.now()
+        for device in self.devices():
+            device.dataStartTS = self.dataStartTS
+        if self.thread == None:
+            self.thread = Thread(target=self.remoteStream)
+            self.thread.start()
+        return True
+
+    def remoteStream(self):
+        devices = self.devices()
+        expected = {}
+        logging.info("Following the stream server {}:{}".format(*self.remote.connection.getpeername()[:2]))
+
+        while self.stream_data:
+            try:
+                message = self.remote.receive()
+            except (OSError, ConnectionError) as e:
+                logging.error("Stream server connection lost: {}".format(e))
+                break
+            if message == None or message[0] != "raw":
+                continue
+            device, index, timestamps, values = message[1]
+            if device >= len(devices):
+                continue
+            if device in expected and index > expected[device]:
+                logging.warning("{} samples lost from the stream server".format(index - expected[device]))
+            expected[device] = index + len(values)
+            devices[device].clock_offset = self.remote.clock_offset
+            devices[device].storeSamples(timestamps, values)
+
+        for device in devices:
+            device.stream_data = False
+        self.remote.close()
+        logging.info('Remote streaming terminated')
+
     def pauseRefresh(self, state):
         logging.debug("pause {}".format(state))
         self.pause_chart = not self.pause_chart
         if self.pause_chart:
             self.ax.set_title('<Paused>', color="yellow")
             self.bpause.label.set_text('Resume')
+            self.lastText.set_text('')
         else:
-            self.ax.set_title(f"Streaming: {connected_device}", color="white")
+            self.ax.set_title(self.streamingTitle(), color="white")
             self.bpause.label.set_text('Pause')
+            # the view may have been zoomed/panned while paused
+            self.xlim = None
+        self.ax.figure.canvas.draw_idle()
 
+    # Saves an animation of the chart without blocking it: the buffers are copied and the frames are rendered
+    # and encoded by a worker process (render_animation), the button shows its progress
     def saveAnimation(self, state):
-        logging.debug("save {}".format(state))
+        if self.export != None:
+            logging.info("Already saving {}".format(self.export[2]))
+            return
 
-        self.bsave.label.set_text('Saving...')
-        plt.gcf().canvas.draw()
         filename = None
         while True:
-            filename = 'current' + str(self.animation_index) + '.gif'
+            filename = 'current' + str(self.animation_index) + '.' + animation_format.lower()
             self.animation_index += 1
             if not path.exists(filename):
                 break
-        logging.info("Animation saved to '{}'".format(filename))
-        self.anim.save(filename, writer='imagemagick', fps=self.framerate)
-        self.bsave.label.set_text('GIF')
+
+        snapshot = [(device.name, *self.animationPoints(device.buffer), device.stats.chargeMah()) for device in self.devices()]
+        context = multiprocessing.get_context('spawn')
+        progress = context.Queue()
+        process = context.Process(target=render_animation, name="AnimationExport", args=(snapshot, filename, animation_format, self.framerate, animation_frames, decimation_mode, chart_max_samples, progress))
+        process.start()
+        logging.info("Saving the animation to '{}' (process {})".format(filename, process.pid))
+        self.export = (process, progress, filename)
+
+        self.bsave.label.set_text('0%')
+        self.export_timer = self.ax.figure.canvas.new_timer(interval=250)
+        self.export_timer.add_callback(self.exportProgress)
+        self.export_timer.start()
+        self.ax.figure.canvas.draw_idle()
+
+    # the window of a buffer for render_animation: (int64 ns timestamps, means, mins, maxs, average SPS)
+    @staticmethod
+    def animationPoints(buffer):
+        window_ts, window_data = buffer.last()
+        sps = (len(window_data) - 1)/max((int(window_ts[-1]) - int(window_ts[0]))/1.0e9, 1.0e-9) if len(window_data) >= 2 else 0.0
+        if len(window_data) <= animation_points:
+            window_ts, window_data = window_ts.copy(), window_data.copy()
+            return window_ts, window_data, window_data, window_data, sps
+        timestamps, means, mins, maxs = buffer.query(int(window_ts[0]), int(window_ts[-1]), animation_points)
+        return timestamps.view(np.int64), means, mins, maxs, sps
+
+    def exportProgress(self):
+        process, progress, filename = self.export
+        # checked before draining: a process that exited has queued all its messages by now
+        alive = process.is_alive()
+        done = None
+        try:
+            while True:
+                message = progress.get_nowait()
+                if message[0] == "frame":
+                    self.bsave.label.set_text('{}%'.format(100*message[1]//message[2]))
+                else:
+                    done = message
+        except queue.Empty:
+            pass
+        if done == None and not alive:
+            done = ("error", "the export process exited with {}".format(process.exitcode))
+
+        if done != None:
+            self.export_timer.stop()
+            process.join()
+            self.export = None
+            self.bsave.label.set_text(animation_format)
+            if done[0] == "done":
+                logging.info("Animation saved to '{}'".format(filename))
+                print("Animation saved to '{}'".format(filename))
+            else:
+                logging.error("Could not save the animation to '{}': {}".format(filename, done[1]))
+                print("Could not save the animation to '{}': {}".format(filename, done[1]), file=sys.stderr)
+        self.ax.figure.canvas.draw_idle()
+
+    # saves the samples in view (read from the window, the --history disk tier or the --open capture) to a CSV file
+    def saveRange(self, event):
+        if not self.pause_chart:
+            self.pauseRefresh(None)
+
+        t0, t1 = [np.datetime64(num2date(x).replace(tzinfo=None), 'ns').astype(np.int64) for x in self.ax.get_xlim()]
+        while True:
+            filename = 'current' + str(self.animation_index) + '.csv'
+            self.animation_index += 1
+            if not path.exists(filename):
+                break
+
+        samples = 0
+        with open(filename, "w") as out:
+            out.write(csv_header(len(self.devices()) > 1))
+            for device in self.devices():
+                if self.capture != None:
+                    timestamps, amps, names = self.capture.read(t0, t1)
+                    if names is not None:
+                        timestamps, amps = timestamps[names == device.name], amps[names == device.name]
+                else:
+                    timestamps, amps = device.buffer.read(t0, t1)
+                for start in range(0, len(amps), 65536):
+                    out.write(format_samples(timestamps[start:start+65536], amps[start:start+65536], 'CSV', device=device.name if self.peers else None))
+                samples += len(amps)
+        logging.info("{} samples in view saved to '{}'".format(samples, filename))
+        self.ax.set_title("<Paused> {} samples saved to {}".format(samples, filename), color="yellow")
+        self.ax.figure.canvas.draw_idle()
 
     def chartSetup(self, refresh_interval=100):
+        import_gui()
         plt.style.use('dark_background')
         fig = plt.figure(num=f"Current Viewer {version}", figsize=(10, 6))
         self.ax = plt.axes()
         ax = self.ax
 
-        ax.set_title(f"Streaming: {connected_device}", color="white")
-
-        fig.text (0.2, 0.88, f"CurrentViewer {version}", color="yellow",  verticalalignment='bottom', horizontalalignment='center', fontsize=9, alpha=0.7)
-        fig.text (0.89, 0.0, f"github.com/MGX3D/CurrentViewer", color="white",  verticalalignment='bottom', horizontalalignment='center', fontsize=9, alpha=0.5)
-
-        ax.set_ylabel("Current draw (Amps)")
-        ax.set_yscale("log", nonpositive='clip')
-        ax.set_ylim(1e-10, 1e1)
-        plt.yticks([1.0e-9, 1.0e-8, 1.0e-7, 1.0e-6, 1.0e-5, 1.0e-4, 1.0e-3, 1.0e-2, 1.0e-1, 1.0], ['1nA', '10nA', '100nA', '1\u00B5A', '10\u00B5A', '100\u00B5A', '1mA', '10mA', '100mA', '1A'], rotation=0)
-        ax.grid(axis="y", which="both", color="yellow", alpha=.3, linewidth=.5)
-
-        ax.set_xlabel("Time")
-        plt.xticks(rotation=20)
+        ax.set_title(self.streamingTitle(), color="white")
+        style_chart(fig, ax)
         ax.set_xlim(datetime.now(), datetime.now() + timedelta(seconds=10))
-        ax.grid(axis="x", color="green", alpha=.4, linewidth=2, linestyle=":")
-
-        #ax.xaxis.set_major_locator(SecondLocator())
-        ax.xaxis.set_major_formatter(DateFormatter('%H:%M:%S'))
 
         def on_xlims_change(event_ax):
             logging.debug("Interactive zoom: {} .. {}".format(num2date(event_ax.get_xlim()[0]), num2date(event_ax.get_xlim()[1])))
@@ -157,25 +2802,64 @@ class CRPlot:
                 self.ax.xaxis.set_major_formatter(DateFormatter('%H:%M:%S'))
                 self.ax.xaxis.set_minor_formatter(DateFormatter('%H:%M:%S.%f'))
 
+            # while paused, re-query the visible range from the aggregate pyramid to show real detail
+            if self.pause_chart:
+                self.zoomPaused(event_ax.get_xlim())
+
         ax.callbacks.connect('xlim_changed', on_xlims_change)
 
-        lines = ax.plot([], [], label="Current")[0]
+        # one trace per device, this device first
+        self.deviceLines = [ax.plot([], [], label=device.name or "Current")[0] for device in self.devices()]
+        self.envelopes = [None]*len(self.deviceLines)
+        lines = self.deviceLines[0]
+        self.lines = lines
 
         lastText = ax.text(0.50, 0.95, '', transform=ax.transAxes)
+        self.lastText = lastText
         statusText = ax.text(0.50, 0.50, '', transform=ax.transAxes)
-        self.anim = animation.FuncAnimation(fig, self.getSerialData, fargs=(lines, plt.legend(), lastText), interval=refresh_interval)
 
-        plt.legend(loc="upper right", framealpha=0.5)
+        # the legend is created once, its text is updated with the Last/Avg stats every frame
+        self.legend = ax.legend(handles=self.deviceLines, labels=[self.legendText(device) for device in self.devices()], loc="upper right", framealpha=0.5)
+
+        # blitting: the lines, SPS and stats are animated, everything else is a cached background
+        self.blit = chart_blit and fig.canvas.supports_blit and self.capture == None
+        for artist in self.deviceLines + [lastText, self.legend]:
+            artist.set_animated(self.blit)
+        fig.canvas.mpl_connect('draw_event', self.onDraw)
+
+        self.refresh_interval = refresh_interval
+        if self.capture == None:
+            self.timer = fig.canvas.new_timer(interval=refresh_interval)
+            self.timer.add_callback(self.refreshChart)
+            self.timer.start()
 
         apause = plt.axes([0.91, 0.15, 0.08, 0.07])
         self.bpause = Button(apause, label='Pause', color='0.2', hovercolor='0.1')
         self.bpause.on_clicked(self.pauseRefresh)
         self.bpause.label.set_color('yellow')
+        # a capture file is always "paused": zooming re-reads the visible range from the file
+        apause.set_visible(self.capture == None)
 
         aanimation = plt.axes([0.91, 0.25, 0.08, 0.07])
-        self.bsave = Button(aanimation, 'GIF', color='0.2', hovercolor='0.1')
+        self.bsave = Button(aanimation, animation_format, color='0.2', hovercolor='0.1')
         self.bsave.on_clicked(self.saveAnimation)
         self.bsave.label.set_color('yellow')
+        aanimation.set_visible(self.capture == None)
+
+        acsv = plt.axes([0.91, 0.55, 0.08, 0.07])
+        self.bcsv = Button(acsv, 'CSV', color='0.2', hovercolor='0.1')
+        self.bcsv.on_clicked(self.saveRange)
+        self.bcsv.label.set_color('yellow')
+
+        aprevious = plt.axes([0.91, 0.35, 0.08, 0.07])
+        self.bprevious = Button(aprevious, '< Wake', color='0.2', hovercolor='0.1')
+        self.bprevious.on_clicked(lambda event: self.jumpToWakeup(-1))
+        self.bprevious.label.set_color('yellow')
+
+        anext = plt.axes([0.91, 0.45, 0.08, 0.07])
+        self.bnext = Button(anext, 'Wake >', color='0.2', hovercolor='0.1')
+        self.bnext.on_clicked(lambda event: self.jumpToWakeup(1))
+        self.bnext.label.set_color('yellow')
 
         crs = mplcursors.cursor(ax, hover=True)
         @crs.connect("add")
@@ -185,6 +2869,8 @@ class CRPlot:
 
         self.framerate = 1000/refresh_interval
         plt.gcf().autofmt_xdate()
+        if self.capture != None:
+            self.showCapture()
         plt.show()
 
 
@@ -195,98 +2881,68 @@ class CRPlot:
 
         self.serialConnection.reset_input_buffer()
         self.sample_count = 0
-        line_count = 0
         error_count = 0
         self.dataStartTS = datetime.now()
 
         # data timeout threshold (seconds) - bails out of no samples received
         data_timeout_ths = 0.5
 
-        line = None
-        device_data = bytearray()
+        device_data = b''
+        chunk_ts = clock_ns()
 
         logging.info("Starting USB streaming loop")
 
         while (self.stream_data):
             try:
-                # get the timestamp before the data string, likely to align better with the actual reading
-                ts = datetime.now()
-
-                chunk_len = device_data.find(b"\n")
-                if chunk_len >= 0:
-                    line = device_data[:chunk_len]
-                    device_data = device_data[chunk_len+1:]
-                else:
-                    line = None
-                    while line == None and self.stream_data:
-                        chunk_len = max(1, min(4096, self.serialConnection.in_waiting))
-                        chunk = self.serialConnection.read(chunk_len)
-                        chunk_len = chunk.find(b"\n")
-                        if chunk_len >= 0:
-                            line = device_data + chunk[:chunk_len]
-                            device_data[0:] = chunk[chunk_len+1:]
-                        else:
-                            device_data.extend(chunk)
-
-                if line == None:
-                    continue
-
-                line = line.decode(encoding="ascii", errors="strict")
-
-                if (line.startswith("USB_LOGGING")):
-                    if (line.startswith("USB_LOGGING_DISABLED")):
+                # read whatever is waiting (blocks for at least one byte), then parse all complete lines at once
+                start = time.perf_counter()
+                chunk = self.serialConnection.read(max(1, self.serialConnection.in_waiting))
+                parse_start = time.perf_counter()
+                metrics.observe("serial_read_seconds", parse_start - start)
+                metrics.observe("serial_read_bytes", len(chunk), Metrics.size_buckets)
+
+                read_ts = clock_ns()
+                values, control, invalid, device_data = parse_chunk(device_data + chunk)
+                metrics.observe("parse_seconds", time.perf_counter() - parse_start)
+
+                # samples are timestamped by interpolating between the arrival of the previous samples and this
+                # chunk's, reads that only brought part of a line don't move the anchor
+                prev_ts = chunk_ts
+                if len(values):
+                    chunk_ts = read_ts
+
+                for line in control:
+                    if (line.startswith(b"USB_LOGGING_DISABLED")):
                         # must have been left open by a different process/instance
                         logging.info("CR USB Logging was disabled. Re-enabling")
+                        metrics.count("usb_logging_reenabled_total", device=self.name)
                         self.serialConnection.write(b'u')
                         self.serialConnection.flush()
-                    continue
 
-                data = float(line)
-                self.sample_count += 1
-                line_count += 1
-
-                if save_file:
-                    if save_format == 'CSV':
-                        save_file.write(f"{ts},{data}\n")
-                    elif save_format == 'JSON':
-                        save_file.write("{}{{\"time\":\"{}\",\"amps\":\"{}\"}}".format(',\n' if self.sample_count>1 else '', ts, data))
-
-                if data < 0.0:
-                    # this happens too often (negative values)
-                    self.timestamps.append(np.datetime64(ts))
-                    self.data.append(1.0e-11)
-                    logging.warning("Unexpected value='{}'".format(line.strip()))
-                else:
-                    self.timestamps.append(np.datetime64(ts))
-                    self.data.append(data)
-                    logging.debug(f"#{self.sample_count}:{ts}: {data}")
+                self.storeSamples(interpolate_timestamps(prev_ts, chunk_ts, len(values)), values)
 
-                if (self.sample_count % 1000 == 0):
-                    logging.debug("{}: '{}' -> {}".format(ts.strftime("%H:%M:%S.%f"), line.rstrip(), data))
-                    dt = datetime.now() - self.dataStartTS
-                    logging.info("Received {} samples in {:.0f}ms ({:.2f} samples/second)".format(self.sample_count, 1000*dt.total_seconds(), self.sample_count/dt.total_seconds()))
-                    print("Received {} samples in {:.0f}ms ({:.2f} samples/second)".format(self.sample_count, 1000*dt.total_seconds(), self.sample_count/dt.total_seconds()))
+                if invalid:
+                    logging.error("Invalid data format: {}".format(invalid))
+                    metrics.count("parse_errors_total", len(invalid), self.name)
+                    error_count += len(invalid)
+                    last_sample = (read_ts - (int(self.buffer.last(1)[0][0]) if len(self.buffer) else chunk_ts))/1.0e9
+                    if (error_count > 100) and  last_sample > data_timeout_ths:
+                        logging.error("Aborting. Error rate is too high {} errors, last valid sample received {} seconds ago".format(error_count, last_sample))
+                        self.stream_data = False
+                        break
 
             except KeyboardInterrupt:
                 logging.info('Terminated by user')
                 break
 
-            except ValueError:
-                logging.error("Invalid data format: '{}': {}".format(line, sys.exc_info()))
-                error_count += 1
-                last_sample = (np.datetime64(datetime.now()) - (self.timestamps[-1] if self.sample_count else np.datetime64(datetime.now())))/np.timedelta64(1, 's')
-                if (error_count > 100) and  last_sample > data_timeout_ths:
-                    logging.error("Aborting. Error rate is too high {} errors, last valid sample received {} seconds ago".format(error_count, last_sample))
-                    self.stream_data = False
-                    break
-                pass
-
             except serial.SerialException as e:
                 logging.error('Serial read error: {}: {}'.format(e.strerror, sys.exc_info()))
+                metrics.count("serial_errors_total", device=self.name)
                 self.stream_data = False
                 break
 
         self.stream_data = False
+        self.receiving.set()
 
         # stop streaming so the device shuts down if in auto mode
         logging.info('Telling CR to stop USB streaming')
@@ -299,64 +2955,381 @@ class CRPlot:
 
         logging.info('Serial streaming terminated')
 
-    def textAmp(self, amp):
-        if (abs(amp) > 1.0):
-            return "{:.3f} A".format(amp)
-        if (abs(amp) > 0.001):
-            return "{:.2f} mA".format(amp*1000)
-        if (abs(amp) > 0.000001):
-            return "{:.1f} \u00B5A".format(amp*1000*1000)
-        return "{:.1f} nA".format(amp*1000*1000*1000)
+    def ringStream(self):
+        self.dataStartTS = datetime.now()
+        logging.info("Following the acquisition process ring {}".format(self.buffer.name))
+
+        while (self.stream_data):
+            timestamps, values, lost = self.buffer.poll()
+            if lost:
+                logging.warning("Chart fell behind the acquisition process: {} samples skipped".format(lost))
+
+            if len(values):
+                self.sample_count = self.buffer.count
+                # the acquisition process overwrites the shared ring without waiting, so the disk tier is
+                # written through here instead of on eviction (the queries skip what is still in the ring)
+                if self.buffer.history:
+                    self.buffer.history.extend(timestamps, values)
+                start = time.perf_counter()
+                self.stats.update(timestamps, values)
+                self.detector.update(timestamps, values)
+                metrics.observe("stats_update_seconds", time.perf_counter() - start)
+            elif self.buffer.state() != SharedSampleBuffer.STREAMING or not self.process.is_alive():
+                break
 
+            time.sleep(ring_poll_interval)
 
-    def getSerialData(self, frame, lines, legend, lastText):
-        if (self.pause_chart or len(self.data) < 2):
-            lastText.set_text('')
-            return
+        self.stream_data = False
+        logging.info('Ring streaming terminated')
 
-        if not self.stream_data:
-            self.ax.set_title('<Disconnected>', color="red")
-            lastText.set_text('')
+    def storeSamples(self, timestamps, values):
+        if len(values) == 0:
             return
 
-        dt = datetime.now() - self.dataStartTS
+        previous_count = self.sample_count
+        self.sample_count += len(values)
+        self.receiving.set()
+        metrics.count("samples_total", len(values), self.name)
+
+        if export_writer and not self.trigger:
+            export_writer.write(timestamps, values, self.device)
+        raw = values
+
+        negative = values < 0.0
+        if negative.any():
+            # this happens too often (negative values)
+            logging.warning("Unexpected values: {} negative samples, first='{}'".format(np.count_nonzero(negative), values[negative][0]))
+            metrics.count("negative_values_total", int(np.count_nonzero(negative)), self.name)
+            values = np.where(negative, 1.0e-11, values)
+
+        start = time.perf_counter()
+        self.buffer.extend(timestamps, values)
+        stats_start = time.perf_counter()
+        self.stats.update(timestamps, values)
+        self.detector.update(timestamps, values)
+        metrics.observe("buffer_append_seconds", stats_start - start)
+        metrics.observe("stats_update_seconds", time.perf_counter() - stats_start)
+
+        if export_writer and self.trigger:
+            windows = self.trigger.windows
+            (window_ts, window_values), summaries = self.trigger.process(timestamps, raw, self.detector)
+            if self.trigger.windows != windows:
+                metrics.count("trigger_windows_total", self.trigger.windows - windows, self.name)
+            if len(window_values):
+                metrics.count("trigger_samples_total", len(window_values), self.name)
+                export_writer.write(window_ts, window_values, self.device)
+            if summary_writer:
+                summary_writer.write(summaries, self.device)
+        logging.debug("#{}: {} samples, last {}".format(self.sample_count, len(values), values[-1]))
+
+        if (self.sample_count // 1000 != previous_count // 1000):
+            dt = datetime.now() - self.dataStartTS
+            device = "{}: ".format(self.name) if self.name else ""
+            logging.info("{}Received {} samples in {:.0f}ms ({:.2f} samples/second)".format(device, self.sample_count, 1000*dt.total_seconds(), self.sample_count/dt.total_seconds()))
+            print("{}Received {} samples in {:.0f}ms ({:.2f} samples/second)".format(device, self.sample_count, 1000*dt.total_seconds(), self.sample_count/dt.total_seconds()))
 
-        # capped at buffer_max_samples
-        sample_set_size = len(self.data)
+    def textAmp(self, amp):
+        return text_amp(amp)
+
+    # this device and its peers, in chart (trace) order
+    def devices(self):
+        return [self] + self.peers
+
+    def streamingTitle(self):
+        if self.peers:
+            return f"Streaming: {len(self.peers) + 1} x {connected_device}"
+        return f"Streaming: {connected_device}"
+
+    def legendText(self, device, samples=None):
+        name = "{}\n".format(device.name) if device.name else ""
+        if samples is None:
+            return name + 'Last: \nAvg: \nCharge: '
+        return name + 'Last: {}\nAvg: {}\nCharge: {}'.format(self.textAmp(samples[-1]), self.textAmp(np.mean(samples)), text_charge(device.stats.chargeMah()))
+
+    # samples/second over the last (up to) 512 samples, 0 if nothing was received for more than 1 second
+    def sps(self):
+        sps_samples = min(512, len(self.buffer))
+        if sps_samples < 2:
+            return 0.0
+        sps_timestamps, _ = self.buffer.last(sps_samples)
+        now = clock_ns() - self.clock_offset
+        if now - sps_timestamps[-1] >= 1000000000:
+            return 0.0
+        return sps_samples/max((now - sps_timestamps[0])/1.0e9, 1.0e-9)
+
+
+    def onDraw(self, event):
+        # a full redraw happened (resize, zoom, cursors, new x range): cache it and put the animated artists back
+        if self.blit:
+            self.background = event.canvas.copy_from_bbox(event.canvas.figure.bbox)
+            self.drawAnimated()
+
+    def drawAnimated(self):
+        for artist in self.envelopes + self.deviceLines + [self.lastText, self.legend]:
+            if artist != None:
+                self.ax.draw_artist(artist)
+
+    def refreshChart(self):
+        if self.pause_chart:
+            return
 
-        timestamps = []
-        samples = [] #np.arange(chart_max_samples, dtype="float64")
+        start = time.perf_counter()
+        canvas = self.ax.figure.canvas
+        self.getSerialData(0, self.lines, self.legend, self.lastText)
 
-        subsamples = max(1, min(max_supersampling, int(sample_set_size/chart_max_samples)))
-        
-        # Sub-sampling for longer window views without the redraw perf impact
-        for i in range(0, chart_max_samples):
-            sample_index = int(sample_set_size*i/chart_max_samples)
-            timestamps.append(self.timestamps[sample_index])
-            supersample = np.array([self.data[i] for i in range(sample_index, sample_index+subsamples)])
-            samples.append(np.median(supersample) if median_filter else np.average(supersample))
+        draw_start = time.perf_counter()
+        if not self.blit or self.background == None or self.redraw_needed:
+            self.redraw_needed = False
+            canvas.draw()
+        else:
+            canvas.restore_region(self.background)
+            self.drawAnimated()
+            canvas.blit(self.ax.figure.bbox)
+        metrics.observe("draw_seconds", time.perf_counter() - draw_start)
+
+        # adapt the frame interval to the measured draw time so the GUI never starves the acquisition thread
+        elapsed = time.perf_counter() - start
+        self.frame_time = elapsed if self.frame_time == 0 else 0.8*self.frame_time + 0.2*elapsed
+        interval = int(min(1000, max(self.refresh_interval, 1000*frame_budget*self.frame_time)))
+        if abs(interval - self.timer.interval) > 0.1*self.timer.interval:
+            logging.debug("Frame takes {:.1f}ms, refresh interval set to {}ms".format(1000*self.frame_time, interval))
+            self.timer.interval = interval
+
+    # Moves the x axis only when the data leaves it. When blitting, the range is paged with 25% headroom
+    # so the ticks (and the cached background) stay the same for many frames.
+    def updateXRange(self, first, last):
+        if self.xlim != None and self.ax.get_xlim() != self.xlim[2]:
+            # zoomed/panned by the user
+            self.xlim = None
+
+        if self.blit:
+            span = max(last - first, 1000000000)
+            if self.xlim != None and self.xlim[0] <= first and last <= self.xlim[1] and 2*span >= self.xlim[1] - self.xlim[0]:
+                return
+            left, right = first, first + span + span//4
+        else:
+            if self.xlim != None and (self.xlim[0], self.xlim[1]) == (first, last):
+                return
+            left, right = first, last
 
-        self.ax.set_xlim(timestamps[0], timestamps[-1])
+        self.ax.set_xlim(np.datetime64(left, 'ns'), np.datetime64(right, 'ns'))
+        self.xlim = (left, right, self.ax.get_xlim())
+        self.redraw_needed = True
 
-        # some machines max out at 100fps, so this should react in 0.5-5 seconds to actual speed
-        sps_samples = min(512, sample_set_size);
-        dt_sps = (np.datetime64(datetime.now()) - self.timestamps[-sps_samples])/np.timedelta64(1, 's');
+    def getSerialData(self, frame, lines, legend, lastText):
+        if (self.pause_chart or len(self.buffer) < 2):
+            lastText.set_text('')
+            return [lastText]
 
-        # if more than 1 second since last sample, automatically set SPS to 0 so we don't have until it slowly decays to 0
-        sps = sps_samples/dt_sps if ((np.datetime64(datetime.now()) - self.timestamps[-1])/np.timedelta64(1, 's')) < 1 else 0.0
+        if not any(device.stream_data for device in self.devices()):
+            if self.ax.get_title() != '<Disconnected>':
+                self.ax.set_title('<Disconnected>', color="red")
+                self.redraw_needed = True
+            lastText.set_text('')
+            return [lastText]
+
+        # Sub-sampling for longer window views without the redraw perf impact, one trace per device
+        first, last = None, None
+        for i, device in enumerate(self.devices()):
+            if len(device.buffer) < 2:
+                continue
+            window_ts, window_data = device.buffer.last()
+            start = time.perf_counter()
+            timestamps, samples, envelope = decimate_window(window_ts, window_data)
+            metrics.observe("decimate_seconds", time.perf_counter() - start)
+            first = int(window_ts[0]) if first == None else min(first, int(window_ts[0]))
+            last = int(window_ts[-1]) if last == None else max(last, int(window_ts[-1]))
+
+            logging.debug("Drawing chart: range {}@{} .. {}@{}".format(samples[0], timestamps[0], samples[-1], timestamps[-1]))
+            (lines if i == 0 else self.deviceLines[i]).set_data(timestamps, samples)
+            self.drawEnvelope(i, timestamps, envelope)
+            legend.get_texts()[i].set_text(self.legendText(device, samples))
+
+        self.updateXRange(first, last)
+
+        # some machines max out at 100fps, so this should react in 0.5-5 seconds to actual speed (aggregate of all devices)
+        sps = sum(device.sps() for device in self.devices())
         lastText.set_text('{:.1f} SPS'.format(sps))
-        if sps > 500:
+        if sps > 500*len(self.deviceLines):
             lastText.set_color("white")
-        elif sps > 100:
+        elif sps > 100*len(self.deviceLines):
             lastText.set_color("yellow")
         else:
             lastText.set_color("red")
 
+        return [artist for artist in self.envelopes + self.deviceLines + [lastText, legend] if artist != None]
+
+
+    # pauses the chart and zooms on the next/previous wake-up from the center of the current view
+    def jumpToWakeup(self, direction):
+        if not self.pause_chart:
+            self.pauseRefresh(None)
+
+        # from the wake-up shown by the last jump if the view wasn't moved since (the view is centered inside
+        # it, its start is the reference for both directions), else from the center of the view
+        if self.wakeup != None and np.allclose(self.ax.get_xlim(), self.wakeup[1]):
+            reference = self.wakeup[0]
+        else:
+            reference = np.datetime64(num2date(sum(self.ax.get_xlim())/2).replace(tzinfo=None), 'ns').astype(np.int64)
+        # with several devices, the closest wake-up of any device in that direction
+        found = None
+        for device in self.devices():
+            candidate = device.detector.findWakeup(reference, direction)
+            if candidate != None and (found == None or direction*(candidate[2]['start'] - found[1][2]['start']) < 0):
+                found = (device, candidate)
+        if found == None:
+            self.ax.set_title('<Paused> no {} wake-up'.format('next' if direction > 0 else 'previous'), color="yellow")
+            self.ax.figure.canvas.draw_idle()
+            return
 
-        logging.debug("Drawing chart: range {}@{} .. {}@{}".format(samples[0], timestamps[0], samples[-1], timestamps[-1]))
-        lines.set_data(timestamps, samples)
-        self.ax.legend(labels=['Last: {}\nAvg: {}'.format( self.textAmp(samples[-1]), self.textAmp(sum(samples)/len(samples)))])
+        device, (index, total, event) = found
+        duration = int(event['end'] - event['start'])
+        self.ax.set_title('<Paused> {}wake-up {}/{}: {} for {:.3f}s, mean {}'.format("{} ".format(device.name) if device.name else "", index + 1, total, state_name(int(event['state']), device.detector.states), duration/1.0e9, self.textAmp(float(event['mean']))), color="yellow")
 
+        # the wake-up in the middle third of the view, the xlim callback re-queries the data
+        pad = max(duration, 10000000)
+        self.ax.set_xlim(np.datetime64(int(event['start']) - pad, 'ns'), np.datetime64(int(event['end']) + pad, 'ns'))
+        self.wakeup = (int(event['start']), self.ax.get_xlim())
+
+    def zoomPaused(self, xlim):
+        t0, t1 = [np.datetime64(num2date(x).replace(tzinfo=None), 'ns').astype(np.int64) for x in xlim]
+        if self.capture != None:
+            self.zoomCapture(t0, t1)
+            return
+
+        for i, device in enumerate(self.devices()):
+            timestamps, means, mins, maxs = device.buffer.query(t0, t1, chart_max_samples)
+            if len(timestamps) < 2:
+                continue
+
+            logging.debug("Paused zoom: {} buckets between {} .. {}".format(len(timestamps), timestamps[0], timestamps[-1]))
+            self.deviceLines[i].set_data(timestamps, means)
+            self.drawEnvelope(i, timestamps, (mins, maxs) if decimation_mode == 'MINMAX' else None)
+        self.ax.figure.canvas.draw_idle()
+
+    # Loads a capture file (--open) for static inspection: one pass over the file in chunks builds each
+    # device's overview, statistics and power state events (devices are added as peers when found)
+    def openCapture(self, capture):
+        self.capture = capture
+        self.pause_chart = True
+        self.stream_data = False
+        devices = {}
+        start = time.monotonic()
+
+        for timestamps, amps, names in capture.chunks():
+            for name, device_ts, device_amps in split_devices(timestamps, amps, names):
+                device = devices.get(name)
+                if device == None:
+                    device = self if not devices else CRPlot(sample_buffer=1, name=name, device=len(devices))
+                    device.name = name
+                    device.capture = capture
+                    device.overview = CaptureOverview(chart_max_samples)
+                    devices[name] = device
+                    if device != self:
+                        self.peers.append(device)
+
+                device.sample_count += len(device_amps)
+                device_amps = np.maximum(device_amps, 1.0e-11)
+                device.overview.add(device_ts, device_amps)
+                device.stats.update(device_ts, device_amps)
+                device.detector.update(device_ts, device_amps)
+
+        for device in devices.values():
+            device.detector.finish()
+        logging.info("Loaded {}: {} samples, {} devices in {:.1f}s".format(capture.file_name, sum(device.sample_count for device in devices.values()), len(devices), time.monotonic() - start))
+        return len(devices) > 0
+
+    def showCapture(self):
+        self.ax.set_title(f"Capture: {path.basename(path.normpath(self.capture.file_name))}", color="white")
+        for i, device in enumerate(self.devices()):
+            timestamps, means, mins, maxs = device.overview.query()
+            self.deviceLines[i].set_data(timestamps, means)
+            self.drawEnvelope(i, timestamps, (mins, maxs) if decimation_mode == 'MINMAX' else None)
+            self.legend.get_texts()[i].set_text("{}Mean: {}\nMax: {}\nCharge: {}".format("{}\n".format(device.name) if device.name else "",
+                self.textAmp(device.stats.mean()), self.textAmp(device.stats.max), text_charge(device.stats.chargeMah())))
+
+        first = min(device.stats.first_ts for device in self.devices())
+        last = max(device.stats.last_ts for device in self.devices())
+        self.lastText.set_text("{} samples, {:.1f}s".format(sum(device.sample_count for device in self.devices()), (last - first)/1.0e9))
+        self.ax.set_xlim(np.datetime64(first, 'ns'), np.datetime64(last, 'ns'))
+
+    # shows [t0, t1] of a capture file: from the overview when the range holds too many samples,
+    # otherwise the raw samples are read from the overlapping chunks and decimated
+    def zoomCapture(self, t0, t1):
+        if self.capture.estimate(t0, t1) > capture_zoom_samples:
+            parts = [(device, device.overview.query(t0, t1)) for device in self.devices()]
+        else:
+            timestamps, amps, names = self.capture.read(t0, t1)
+            parts = []
+            for device in self.devices():
+                mask = names == device.name if names is not None else slice(None)
+                device_ts, device_amps = timestamps[mask], np.maximum(amps[mask], 1.0e-11)
+                parts.append((device, decimate_minmax(device_ts, device_amps, chart_max_samples) if len(device_amps) else None))
+
+        for i, (device, part) in enumerate(parts):
+            if part == None or len(part[0]) < 2:
+                continue
+            timestamps, means, mins, maxs = part
+            logging.debug("Capture zoom: {} points between {} .. {}".format(len(timestamps), timestamps[0], timestamps[-1]))
+            self.deviceLines[i].set_data(timestamps, means)
+            self.drawEnvelope(i, timestamps, (mins, maxs) if decimation_mode == 'MINMAX' else None)
+        self.ax.figure.canvas.draw_idle()
+
+    # Plays a capture file back through the live pipeline (chart, statistics, export) at `speed` times
+    # real time (0 = as fast as possible), re-timestamped on the live clock
+    def replayStart(self, capture, speed=1.0):
+        self.replay = (capture, speed)
+        self.dataStartTS = datetime.now()
+        for device in self.devices():
+            device.dataStartTS = self.dataStartTS
+        if self.thread == None:
+            self.thread = Thread(target=self.replayStream)
+            self.thread.start()
+        return True
+
+    def replayStream(self):
+        capture, speed = self.replay
+        devices = {device.name: device for device in self.devices()}
+        start = clock_ns()
+        first = None
+        logging.info("Replaying {} at {}x".format(capture.file_name, speed if speed > 0 else "max"))
+
+        for timestamps, amps, names in capture.chunks():
+            # the samples of several devices are only in order per device, playback goes through them in time order
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, amps, names = timestamps[order], amps[order], names[order] if names is not None else None
+            if first == None:
+                first = int(timestamps[0])
+            # playback time of every sample, emitted in slices of ~20ms of playback
+            due = start + (((timestamps - first)/speed).astype(np.int64) if speed > 0 else timestamps - first)
+            edges = np.searchsorted(due, np.arange(due[0], due[-1] + 1, 20000000), side='right')
+            for begin, end in zip(np.concatenate(([0], edges)).tolist(), np.append(edges, len(due)).tolist()):
+                if end <= begin:
+                    continue
+                wait = (int(due[end - 1]) - clock_ns())/1.0e9
+                if speed > 0 and wait > 0:
+                    time.sleep(wait)
+                if not self.stream_data:
+                    break
+                for name, device_ts, device_amps in split_devices(due[begin:end], amps[begin:end], names[begin:end] if names is not None else None):
+                    if name in devices:
+                        devices[name].storeSamples(device_ts, device_amps)
+            if not self.stream_data:
+                break
+
+        for device in devices.values():
+            device.stream_data = False
+        logging.info("Replay finished")
+
+    # (re)draws the min/max band of the i-th device trace, in the trace's color
+    def drawEnvelope(self, i, timestamps, envelope):
+        if self.envelopes[i] != None:
+            self.envelopes[i].remove()
+            self.envelopes[i] = None
+
+        if envelope != None:
+            # negative readings are already clipped by the reader, keep the band on the log scale
+            self.envelopes[i] = self.ax.fill_between(timestamps, np.maximum(envelope[0], 1.0e-11), envelope[1], color=self.deviceLines[i].get_color(), alpha=0.3, linewidth=0, animated=self.blit)
 
     def isStreaming(self) -> bool:
         return self.stream_data
@@ -367,31 +3340,348 @@ class CRPlot:
         if self.thread != None:
             self.thread.join()
 
+        if self.export != None and self.export[0].is_alive():
+            print("Waiting for the animation to be saved to '{}'...".format(self.export[2]))
+            self.export[0].join()
+
         if self.serialConnection != None:
             self.serialConnection.close()
 
+        if self.buffer.history:
+            self.buffer.history.close()
+            self.buffer.history = None
+
         logging.info("Connection closed.")
 
 
+# the chart look shared by the live chart and the rendered animations
+def style_chart(fig, ax):
+    fig.text (0.2, 0.88, f"CurrentViewer {version}", color="yellow",  verticalalignment='bottom', horizontalalignment='center', fontsize=9, alpha=0.7)
+    fig.text (0.89, 0.0, f"github.com/MGX3D/CurrentViewer", color="white",  verticalalignment='bottom', horizontalalignment='center', fontsize=9, alpha=0.5)
+
+    ax.set_ylabel("Current draw (Amps)")
+    ax.set_yscale("log", nonpositive='clip')
+    ax.set_ylim(1e-10, 1e1)
+    ax.set_yticks([1.0e-9, 1.0e-8, 1.0e-7, 1.0e-6, 1.0e-5, 1.0e-4, 1.0e-3, 1.0e-2, 1.0e-1, 1.0], ['1nA', '10nA', '100nA', '1\u00B5A', '10\u00B5A', '100\u00B5A', '1mA', '10mA', '100mA', '1A'])
+    ax.grid(axis="y", which="both", color="yellow", alpha=.3, linewidth=.5)
+
+    ax.set_xlabel("Time")
+    ax.tick_params(axis="x", labelrotation=20)
+    ax.grid(axis="x", color="green", alpha=.4, linewidth=2, linestyle=":")
+
+    #ax.xaxis.set_major_locator(SecondLocator())
+    ax.xaxis.set_major_formatter(DateFormatter('%H:%M:%S'))
+
+
+# Entry point of the animation export process ([GIF] button): renders `frames` frames of the chart from a
+# snapshot of the buffers [(name, int64 ns timestamps, means, mins, maxs, SPS, charge mAh)] on an Agg canvas:
+# the samples themselves (means = mins = maxs) or, for large buffers, min/max buckets. The frames
+# replay the last frames/fps seconds of the snapshot in real time with a fixed window (the rest of the
+# snapshot), and are saved as a GIF (Pillow) or piped as raw RGBA frames to ffmpeg (MP4/WebM). The lines
+# are decimated like the chart's (mode and max_samples are its --decimation and --max-chart).
+# Reports ("frame", n, frames), then ("done", file_name) or ("error", message) on progress.
+def render_animation(devices, file_name, fmt, fps, frames, mode, max_samples, progress):
+    encoder = None
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import_gui()
+        from PIL import Image
+
+        devices = [device for device in devices if len(device[1]) >= 2]
+        if not devices:
+            raise ValueError("no samples to animate")
+        first = min(int(device[1][0]) for device in devices)
+        last = max(int(device[1][-1]) for device in devices)
+        playback = min(int(frames*1.0e9/fps), (last - first)//2)
+        span = last - first - playback
+        ends = last - playback + np.linspace(0, playback, frames).astype(np.int64)
+
+        plt.style.use('dark_background')
+        fig = plt.figure(figsize=(10, 6), dpi=100)
+        ax = fig.add_subplot()
+        ax.set_title(f"{connected_device} {len(devices)}x" if len(devices) > 1 else connected_device, color="white")
+        style_chart(fig, ax)
+        lines = [ax.plot([], [], label=name or "Current")[0] for name, timestamps, means, mins, maxs, sps, charge in devices]
+        legend = ax.legend(handles=lines, loc="upper right", framealpha=0.5)
+        sps_text = ax.text(0.50, 0.95, '', transform=ax.transAxes)
+        envelopes = [None]*len(devices)
+        fig.autofmt_xdate()
+        width, height = fig.canvas.get_width_height()
+
+        if fmt != 'GIF':
+            if shutil.which("ffmpeg") == None:
+                raise RuntimeError("{} needs ffmpeg, which was not found".format(fmt))
+            encoder = subprocess.Popen(["ffmpeg", "-loglevel", "error", "-y", "-f", "rawvideo", "-pix_fmt", "rgba", "-s", "{}x{}".format(width, height),
+                                        "-r", str(fps), "-i", "-"] + video_codecs[fmt] + [file_name], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        images = []
+
+        for frame, end in enumerate(ends.tolist()):
+            frame_sps = 0.0
+            for i, (name, timestamps, amps, mins, maxs, sps, charge) in enumerate(devices):
+                i0, i1 = np.searchsorted(timestamps, end - span), np.searchsorted(timestamps, end, side='right')
+                if i1 - i0 < 2:
+                    continue
+                frame_sps += sps
+                if mode == 'MINMAX':
+                    # the envelope of the buckets' own extremes
+                    window_ts, window_data, lower, upper = decimate_envelope(timestamps[i0:i1], amps[i0:i1], mins[i0:i1], maxs[i0:i1], max_samples)
+                    envelope = (lower, upper)
+                else:
+                    window_ts, window_data, envelope = decimate_window(timestamps[i0:i1], amps[i0:i1], mode, max_samples)
+                lines[i].set_data(window_ts, window_data)
+                if envelopes[i] != None:
+                    envelopes[i].remove()
+                    envelopes[i] = None
+                if envelope != None:
+                    envelopes[i] = ax.fill_between(window_ts, np.maximum(envelope[0], 1.0e-11), envelope[1], color=lines[i].get_color(), alpha=0.3, linewidth=0)
+                legend.get_texts()[i].set_text("{}Last: {}\nAvg: {}\nCharge: {}".format("{}\n".format(name) if name else "", text_amp(amps[i1 - 1]), text_amp(np.mean(amps[i0:i1])), text_charge(charge)))
+            ax.set_xlim(np.datetime64(end - span, 'ns'), np.datetime64(end, 'ns'))
+            sps_text.set_text('{:.1f} SPS'.format(frame_sps))
+            fig.canvas.draw()
+
+            if encoder:
+                encoder.stdin.write(bytes(fig.canvas.buffer_rgba()))
+            else:
+                images.append(Image.frombuffer("RGBA", (width, height), bytes(fig.canvas.buffer_rgba()), "raw", "RGBA", 0, 1).convert("RGB").quantize(colors=255))
+            progress.put(("frame", frame + 1, frames))
+
+        if encoder:
+            encoder.stdin.close()
+            if encoder.wait() != 0:
+                raise RuntimeError("ffmpeg failed: {}".format(encoder.stderr.read().decode(errors="replace").strip()))
+        else:
+            images[0].save(file_name, save_all=True, append_images=images[1:], duration=int(1000/fps), loop=0)
+        progress.put(("done", file_name))
+    except Exception as e:
+        if encoder and encoder.poll() == None:
+            encoder.kill()
+        progress.put(("error", str(e)))
+
+
+# Opens the --out file in save_format and starts its export writer (ports in capture order)
+def open_export(output_file_name, ports, fmt, flush_interval, max_batches, segment_bytes, segment_seconds, summaries):
+    global save_file
+    global export_writer
+
+    if fmt in segment_formats:
+        save_file = SegmentWriter(output_file_name, fmt, devices=ports, max_bytes=segment_bytes, max_seconds=segment_seconds)
+    elif fmt.startswith('BIN'):
+        save_file = BinaryCaptureWriter(open(output_file_name, "wb"), np.float64 if fmt == 'BIN64' else np.float32)
+        if len(ports) > 1:
+            logging.info("Binary capture device indexes: {}".format(", ".join("{}={}".format(i, port) for i, port in enumerate(ports))))
+    else:
+        save_file = open(output_file_name, "w+")
+
+    if fmt == 'CSV':
+        save_file.write(csv_header(len(ports) > 1))
+    elif fmt == 'JSON':
+        save_file.write("{\n\"data\":[\n")
+
+    export_writer = ExportWriter(save_file, fmt, flush_interval=flush_interval, max_batches=max_batches, devices=ports)
+
+    if summaries:
+        global summary_writer
+        summary_writer = SummaryWriter(trigger_summary_file(output_file_name, fmt), ports)
+        logging.info("Trigger summaries saved to {}".format(trigger_summary_file(output_file_name, fmt)))
+
+
+# the open_export arguments of the command line settings (--format, --flush, --export-queue, --segment-*, --trigger)
+def export_settings():
+    return {"fmt": save_format, "flush_interval": export_flush_interval, "max_batches": export_queue_batches, "segment_bytes": int(segment_max_mb*1024*1024),
+            "segment_seconds": segment_seconds, "summaries": bool(trigger_condition) and trigger_summary > 0}
+
+
+# the CaptureTrigger arguments of the command line settings, None without --trigger
+def trigger_settings():
+    if not trigger_condition:
+        return None
+    return {"kind": trigger_condition[0], "threshold": trigger_condition[1], "pre": trigger_pre, "post": trigger_post, "window": trigger_window, "summary": trigger_summary}
+
+
+def close_export():
+    if export_writer:
+        export_writer.close()
+
+    if summary_writer:
+        summary_writer.close()
+
+    if save_file:
+        try:
+            if export_writer.format == 'JSON':
+                save_file.write("\n]\n}\n")
+            save_file.close()
+        except (OSError, ValueError) as e:
+            logging.error("Could not close the output file: {}".format(e))
+
+
+# Stops the devices and saves their power state events and statistics to events_file and stats_file
+# (--events, --summary, None = not saved)
+def finish_devices(devices, events_file, stats_file):
+    for device in devices:
+        device.close()
+
+        device.detector.finish()
+        if summary_writer and device.trigger:
+            summary_writer.write(device.trigger.finish(), device.device)
+        if events_file:
+            device.detector.save(device_file_name(events_file, device.name))
+            logging.info("Power state events saved to {}".format(device_file_name(events_file, device.name)))
+
+        if stats_file:
+            device.stats.save(device_file_name(stats_file, device.name))
+            logging.info("Capture statistics saved to {}".format(device_file_name(stats_file, device.name)))
+
+
+# Entry point of the acquisition process (--process): reads the ports into the shared rings created by the
+# GUI process and writes the export, events and statistics. Runs until the GUI sets stop, the devices
+# stop streaming or the GUI process dies (the recording is then closed cleanly).
+# The command line settings are passed over: export (open_export arguments), trigger (CaptureTrigger
+# arguments or None), the power state thresholds and the --events/--summary files. origin is the GUI
+# process' clock_origin, so both processes timestamp on the same timeline.
+def acquisition_process(logs, output_file_name, ports, names, rings, stop, metrics_queue, origin, baud, export, trigger, thresholds, events_file, stats_file):
+    # Ctrl-C is handled by the GUI process, which stops this one
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global clock_origin
+    clock_origin = origin
+
+    log_file, log_size, console_level = logs
+    logging.getLogger().setLevel(logging.DEBUG)
+    # keeps the module level logging calls from installing a default console handler
+    logging.getLogger().addHandler(logging.NullHandler())
+    if log_file:
+        file_logger = RotatingFileHandler(log_file, maxBytes=log_size, backupCount=1)
+        file_logger.setFormatter(logging.Formatter('%(levelname)s:%(asctime)s:%(processName)s:%(threadName)s:%(message)s'))
+        logging.getLogger().addHandler(file_logger)
+    if console_level != None:
+        console_logger = logging.StreamHandler()
+        console_logger.setLevel(console_level)
+        console_logger.setFormatter(logging.Formatter('%(levelname)s:%(message)s'))
+        logging.getLogger().addHandler(console_logger)
+
+    buffers = [SharedSampleBuffer(name=ring, pyramid=False) for ring in rings]
+    if output_file_name:
+        open_export(output_file_name, ports, **export)
+
+    devices = [CRPlot(sample_buffer=buffer, name=name, device=i) for i, (buffer, name) in enumerate(zip(buffers, names))]
+    for device in devices:
+        device.detector = PowerStateDetector(thresholds)
+        device.trigger = CaptureTrigger(**trigger) if trigger else None
+    for device, buffer, port in zip(devices, buffers, ports):
+        if not device.serialStart(port=port, speed=baud):
+            buffer.setState(SharedSampleBuffer.FAILED)
+            break
+        buffer.setState(SharedSampleBuffer.STREAMING)
+    else:
+        parent = multiprocessing.parent_process()
+        lagging = False
+        last_metrics = time.monotonic()
+        while not stop.wait(0.1) and any(device.isStreaming() for device in devices) and parent.is_alive():
+            if time.monotonic() - last_metrics >= 1.0:
+                last_metrics = time.monotonic()
+                metrics_queue.put(metrics.snapshot())
+            # the GUI is not waited for, only reported when it misses samples
+            if any(buffer.lag() > buffer.capacity for buffer in buffers) != lagging:
+                lagging = not lagging
+                if lagging:
+                    logging.warning("The GUI process fell more than a buffer behind, it is missing samples")
+
+        if not parent.is_alive():
+            logging.error("GUI process exited, closing the capture")
+            # nobody reads the metrics any more, exiting must not wait for the queue to be flushed
+            metrics_queue.cancel_join_thread()
+
+    finish_devices(devices, events_file, stats_file)
+    close_export()
+    metrics_queue.put(metrics.snapshot())
+    metrics_queue.put(None)
+    for buffer in buffers:
+        buffer.setState(SharedSampleBuffer.STOPPED if buffer.state() != SharedSampleBuffer.FAILED else SharedSampleBuffer.FAILED)
+        buffer.close()
+    logging.info("Acquisition process done")
+
+
+# Gives the device buffer its disk tier when --history is set (one file per device, deleted at exit)
+def attach_history(device):
+    if history_max_gb > 0:
+        file_name = path.join(history_dir or tempfile.gettempdir(), device_file_name("current_viewer-history-{}.bin".format(os.getpid()), device.name))
+        device.buffer.history = SampleHistory(file_name, history_max_gb*1024*1024*1024)
+        logging.info("History of up to {} samples kept in {}".format(device.buffer.history.capacity, file_name))
+    return device
+
+
+# per device file name for multi-device captures: stats.json -> stats-<device>.json
+def device_file_name(file_name, device):
+    if device == None:
+        return file_name
+    root, ext = path.splitext(file_name)
+    return "{}-{}{}".format(root, "".join(c if c.isalnum() else "_" for c in device.strip("/\\")), ext)
+
+
 def init_argparse() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
-        usage="%(prog)s -p <port> [OPTION]",
+        usage="%(prog)s -p <port> [<port> ...] [OPTION]",
         description="CurrentRanger R3 Viewer"
     )
 
     parser.add_argument("--version", action="version", version = f"{parser.prog} version {version}")
-    parser.add_argument("-p", "--port", nargs=1, required=True, help="Set the serial port (backed by USB or BlueTooth) to connect to (example: /dev/ttyACM0 or COM3)")
+    parser.add_argument("-p", "--port", action="extend", nargs='+', help="Set the serial port (backed by USB or BlueTooth) to connect to (example: /dev/ttyACM0 or COM3). Several ports capture from several devices on a shared timeline")
+    parser.add_argument("--simulate", metavar='<sps>', type=int, nargs=1, help=f"Connect to a simulated {connected_device} streaming <sps> samples/second instead of --port (POSIX only)")
+    parser.add_argument("--sim-devices", metavar='<n>', type=int, nargs=1, help=f"Set how many simulated devices --simulate starts (default: 1)")
+    parser.add_argument("--sim-trace", metavar='<file>', nargs=1, help=f"Play back the amps recorded in <file> (BIN or CSV capture) in the simulator instead of the synthetic power cycle")
     parser.add_argument("-s", "--baud", metavar='<n>', type=int, nargs=1, help=f"Set the serial baud rate (default: {baud})")
 
     parser.add_argument("-o", "--out", metavar='<file>', nargs=1, help=f"Save the output samples to <file> in the format set by --format")
-    parser.add_argument("--format", metavar='<fmt>', nargs=1, help=f"Set the output format to one of: CSV, JSON")
+    parser.add_argument("--format", metavar='<fmt>', nargs=1, help=f"Set the output format to one of: {', '.join(save_formats)} (BIN is float32, BIN64 float64 binary, PARQUET and CSV.GZ/CSV.ZST record rolling segments in the --out directory)")
+    parser.add_argument("--convert", metavar='<file>', nargs=1, help=f"Convert the binary capture <file> to the --out file (CSV or JSON) and exit")
+    parser.add_argument("--segment-size", metavar='<MB>', type=float, nargs=1, help=f"Set the maximum size of a recording segment in megabytes (default: {segment_max_mb})")
+    parser.add_argument("--segment-time", metavar='<s>', type=float, nargs=1, help=f"Start a new recording segment every <s> seconds of wall clock time (default: {segment_seconds})")
+    parser.add_argument("--extract", metavar='<dir>', nargs=1, help=f"Write the samples of the recording <dir> between --from and --to to the --out file (CSV or JSON) and exit")
+    parser.add_argument("--from", dest="time_from", metavar='<time>', nargs=1, help=f"Start of the --extract range (example: \"2020-11-09 14:00\")")
+    parser.add_argument("--to", dest="time_to", metavar='<time>', nargs=1, help=f"End of the --extract range (example: \"2020-11-09 14:05\")")
+
+    parser.add_argument("--trigger", metavar='<condition>', nargs=1, help=f"Only save the samples around triggers to --out: rise:<amps> / fall:<amps> (samples at or above / below amps), avg:<amps> (--trigger-window average at or above amps) or state (power state changes, see --states)")
+    parser.add_argument("--pre", metavar='<s>', type=float, nargs=1, help=f"Set how many seconds before a trigger are saved (default: {trigger_pre})")
+    parser.add_argument("--post", metavar='<s>', type=float, nargs=1, help=f"Set how many seconds after a trigger are saved (default: {trigger_post})")
+    parser.add_argument("--trigger-window", metavar='<s>', type=float, nargs=1, help=f"Set the averaging window of avg:<amps> triggers in seconds (default: {trigger_window})")
+    parser.add_argument("--trigger-summary", metavar='<s>', type=float, nargs=1, help=f"Save the mean/min/max of every <s> seconds to <out>-summary.csv with --trigger, 0 to disable (default: {trigger_summary})")
+
+    parser.add_argument("--open", metavar='<file>', nargs=1, help=f"Show a capture (CSV, JSON or BIN file, or a recording directory) in the chart instead of a live device. The capture is read in chunks, zooming in re-reads the visible range")
+    parser.add_argument("--replay", metavar='<file>', nargs=1, help=f"Play a capture back through the live chart, statistics and --out file as if it was streamed by the device(s)")
+    parser.add_argument("--speed", metavar='<x>', type=float, nargs=1, help=f"Set the --replay speed as a multiple of real time, 0 to replay as fast as possible (default: 1)")
+
+    parser.add_argument("--serve", metavar='<[host:]port>', nargs=1, help=f"Stream the capture to --connect clients and WebSocket viewers on <port> (localhost, or host 0.0.0.0 for the LAN). No authentication, use on trusted networks only")
+    parser.add_argument("--serve-fps", metavar='<n>', type=int, nargs=1, help=f"Set how many times per second the stream is published (default: {serve_fps})")
+    parser.add_argument("--connect", metavar='<host:port>', nargs=1, help=f"Show (and --out, --summary, ...) the samples streamed by a --serve instance instead of a local device")
+
+    parser.add_argument("--process", action="store_true", default=False, help="Run the acquisition (serial reads and the --out, --summary and --events files) in a separate process sharing the sample buffer with the GUI, so chart rendering never stalls the capture")
+
+    parser.add_argument("--flush", metavar='<s>', type=float, nargs=1, help=f"Set how often the output file is flushed to disk in seconds (default: {export_flush_interval})")
+    parser.add_argument("--export-queue", metavar='<batches>', type=int, nargs=1, help=f"Set how many sample batches can wait for the output file writer before they are dropped (default: {export_queue_batches})")
+
+    parser.add_argument("--summary", metavar='<file>', nargs=1, help=f"Save the capture statistics (mean, min/max, p50/p99, charge, time at current) to <file> (JSON) at exit")
+    parser.add_argument("--summary-interval", metavar='<s>', type=float, nargs=1, help=f"Print the capture statistics every <s> seconds in --no-gui mode, 0 to print them only at exit (default: {stats_interval})")
+
+    parser.add_argument("--stats", action="store_true", default=False, help="Print the pipeline metrics (per stage latencies, serial read sizes, error counters) with the capture statistics")
+    parser.add_argument("--stats-file", metavar='<file>', nargs=1, help=f"Rewrite the pipeline metrics to <file> (JSON) every --stats-interval seconds and at exit")
+    parser.add_argument("--stats-interval", metavar='<s>', type=float, nargs=1, help=f"Set how often the --stats-file is rewritten in seconds (default: {metrics_interval})")
+    parser.add_argument("--metrics-port", metavar='<port>', type=int, nargs=1, help=f"Serve the pipeline metrics in Prometheus text format on http://127.0.0.1:<port>/metrics")
+
+    parser.add_argument("--states", metavar='<amps>', nargs=1, help=f"Set the comma separated thresholds between power states (default: {','.join(str(t) for t in state_thresholds)}, i.e. {'/'.join(state_names)})")
+    parser.add_argument("--events", metavar='<file>', nargs=1, help=f"Save the detected power state segments (start, end, duration, state, mean) to <file> (CSV) at exit")
 
     parser.add_argument("--gui", dest="gui", action="store_true", default=True, help="Display the GUI / Interactive chart (default: ON)")
     parser.add_argument("-g", "--no-gui", dest="gui", action="store_false", help="Do not display the GUI / Interactive Chart. Useful for automation")
 
     parser.add_argument("-b", "--buffer", metavar='<samples>', type=int, nargs=1, help=f"Set the chart buffer size (window size) in # of samples (default: {buffer_max_samples})")
+    parser.add_argument("--history", metavar='<GB>', type=float, nargs=1, help=f"Keep the samples that leave the chart buffer in a file of up to <GB> gigabytes (oldest dropped first) to zoom/pan into them while paused (default: off)")
+    parser.add_argument("--history-dir", metavar='<dir>', nargs=1, help=f"Set the directory of the --history file, preferably on a local disk (default: {tempfile.gettempdir()})")
     parser.add_argument("-m", "--max-chart", metavar='<samples>', type=int, nargs=1, help=f"Set the chart max # samples displayed (default: {chart_max_samples})")
+    parser.add_argument("-d", "--decimation", metavar='<mode>', nargs=1, help=f"Set how the buffer is reduced to the chart samples, one of: {', '.join(decimation_modes)} (default: {decimation_mode})")
     parser.add_argument("-r", "--refresh", metavar='<ms>', type=int, nargs=1, help=f"Set the live chart refresh interval in milliseconds (default: {refresh_interval})")
+    parser.add_argument("--no-blit", dest="blit", action="store_false", default=True, help="Redraw the whole chart every frame instead of blitting the line over a cached background (for backends with blitting issues)")
+    parser.add_argument("--video-format", metavar='<fmt>', nargs=1, help=f"Set the format of the chart animation saved by the GIF button, one of: {', '.join(animation_formats)} (MP4 and WEBM need ffmpeg, default: {animation_format})")
+    parser.add_argument("--video-frames", metavar='<n>', type=int, nargs=1, help=f"Set the number of frames of the saved chart animation (default: {animation_frames})")
     parser.add_argument("-v", "--verbose", action="count", default=0, help="Increase logging verbosity (can be specified multiple times)")
     parser.add_argument("-c", "--console", default=False, action="store_true", help="Show the debug messages on the console")
     parser.add_argument("-n", "--no-log", default=False, action="store_true", help=f"Disable debug logging (enabled by default)")
@@ -410,6 +3700,9 @@ def main():
     parser = init_argparse()
     args = parser.parse_args()
 
+    if not args.port and not args.convert and not args.extract and not args.simulate and not args.open and not args.replay and not args.connect:
+        parser.error("the following arguments are required: -p/--port")
+
     if args.log_file:
         global logfile
         logfile = args.log_file[0]
@@ -421,6 +3714,46 @@ def main():
         global refresh_interval
         refresh_interval = args.refresh[0]
 
+    if args.states:
+        global state_thresholds
+        try:
+            state_thresholds = sorted(float(value) for value in args.states[0].split(','))
+        except ValueError:
+            print(f"Invalid power state thresholds {args.states[0]}", file=sys.stderr)
+            return -4
+
+    if args.events:
+        global events_file
+        events_file = args.events[0]
+
+    if args.summary:
+        global stats_file
+        stats_file = args.summary[0]
+
+    if args.summary_interval:
+        global stats_interval
+        stats_interval = args.summary_interval[0]
+
+    if args.stats:
+        global print_metrics
+        print_metrics = True
+
+    if args.stats_file:
+        global metrics_file
+        metrics_file = args.stats_file[0]
+
+    if args.stats_interval:
+        global metrics_interval
+        metrics_interval = max(0.1, args.stats_interval[0])
+
+    if args.metrics_port:
+        global metrics_port
+        metrics_port = args.metrics_port[0]
+
+    if not args.blit:
+        global chart_blit
+        chart_blit = False
+
     if args.baud:
         global baud
         baud = args.baud[0]
@@ -436,6 +3769,75 @@ def main():
             print("Command line error: Buffer size cannot be smaller than the chart sample size", file=sys.stderr)
             return -1
 
+    if args.history:
+        global history_max_gb
+        history_max_gb = max(0.0, args.history[0])
+
+    if args.history_dir:
+        global history_dir
+        history_dir = args.history_dir[0]
+        if not path.isdir(history_dir):
+            print(f"Command line error: the --history-dir {history_dir} does not exist", file=sys.stderr)
+            return -1
+
+    if args.trigger:
+        global trigger_condition
+        try:
+            trigger_condition = parse_trigger(args.trigger[0])
+        except ValueError as e:
+            print(f"Invalid trigger {args.trigger[0]}: {e}", file=sys.stderr)
+            return -4
+        if not args.out:
+            print("Command line error: --trigger needs an --out file", file=sys.stderr)
+            return -1
+
+    if args.pre:
+        global trigger_pre
+        trigger_pre = max(0.0, args.pre[0])
+
+    if args.post:
+        global trigger_post
+        trigger_post = max(0.0, args.post[0])
+
+    if args.trigger_window:
+        global trigger_window
+        trigger_window = max(0.0, args.trigger_window[0])
+
+    if args.trigger_summary != None:
+        global trigger_summary
+        trigger_summary = max(0.0, args.trigger_summary[0])
+
+    if args.serve:
+        global serve_address
+        host, _, port = args.serve[0].rpartition(':')
+        try:
+            serve_address = (host or "127.0.0.1", int(port))
+        except ValueError:
+            print(f"Invalid --serve address {args.serve[0]}", file=sys.stderr)
+            return -1
+
+    if args.serve_fps:
+        global serve_fps
+        serve_fps = max(1, args.serve_fps[0])
+
+    if args.video_format:
+        global animation_format
+        animation_format = args.video_format[0].upper()
+        if not animation_format in animation_formats:
+            print(f"Unknown video format {animation_format}", file=sys.stderr)
+            return -3
+
+    if args.video_frames:
+        global animation_frames
+        animation_frames = max(2, args.video_frames[0])
+
+    if args.decimation:
+        global decimation_mode
+        decimation_mode = args.decimation[0].upper()
+        if not decimation_mode in decimation_modes:
+            print(f"Unknown decimation mode {decimation_mode}", file=sys.stderr)
+            return -3
+
     logging_level = logging.DEBUG if args.verbose>2 else (logging.INFO if args.verbose>1 else (logging.WARNING if args.verbose>0 else logging.ERROR))
 
     # disable matplotlib logging for fonts, seems to be quite noisy
@@ -458,55 +3860,229 @@ def main():
         logging.getLogger().addHandler(console_logger)
 
 
-    global save_file
     global save_format
 
+    if args.flush:
+        global export_flush_interval
+        export_flush_interval = args.flush[0]
+
+    if args.export_queue:
+        global export_queue_batches
+        export_queue_batches = max(1, args.export_queue[0])
+
     if args.format:
         save_format = args.format[0].upper()
-        if not save_format in ["CSV", "JSON"]:
+        if not save_format in save_formats:
             print(f"Unknown format {save_format}", file=sys.stderr)
             return -2
 
-    if args.out:
-        output_file_name = args.out[0]
-        save_file = open(output_file_name, "w+")
+    if args.out and not save_format:
+        if path.isdir(args.out[0]) or args.out[0].endswith(('/', '\\')):
+            save_format = 'PARQUET' if import_parquet() else 'CSV.GZ'
+        else:
+            save_format = 'CSV' if args.out[0].upper().endswith('.CSV') else ('BIN' if args.out[0].upper().endswith('.BIN') else 'JSON')
+        logging.info(f"Save format automatically set to {save_format} for {args.out[0]}")
+
+    if (save_format == 'PARQUET' and not import_parquet()) or (save_format == 'CSV.ZST' and not import_zstandard()):
+        package = 'pyarrow' if save_format == 'PARQUET' else 'zstandard'
+        print(f"Format {save_format} needs the {package} package (pip install {package})", file=sys.stderr)
+        return -2
+
+    if args.segment_size:
+        global segment_max_mb
+        segment_max_mb = args.segment_size[0]
+
+    if args.segment_time:
+        global segment_seconds
+        segment_seconds = max(1.0, args.segment_time[0])
+
+    if args.convert or args.extract:
+        if not args.out or save_format.startswith('BIN') or save_format in segment_formats:
+            print("Command line error: --convert and --extract need a CSV or JSON --out file", file=sys.stderr)
+            return -1
 
-        if not save_format:
-            save_format = 'CSV' if output_file_name.upper().endswith('.CSV') else 'JSON'
-            logging.info(f"Save format automatically set to {save_format} for {args.out[0]}")
+    if args.convert:
+        print("Converting {} to {}...".format(args.convert[0], args.out[0]))
+        print("Done, {} samples.".format(convert_capture(args.convert[0], args.out[0], save_format)))
+        return 0
 
-        if save_format == 'CSV':
-            save_file.write("Timestamp, Amps\n")
-        elif save_format == 'JSON':
-            save_file.write("{\n\"data\":[\n")
+    if args.extract:
+        try:
+            t0, t1 = [np.datetime64(value[0], 'ns').astype(np.int64) if value else None for value in (args.time_from, args.time_to)]
+        except ValueError as e:
+            print(f"Invalid --from/--to time: {e}", file=sys.stderr)
+            return -1
+        print("Extracting {} to {}...".format(args.extract[0], args.out[0]))
+        print("Done, {} samples.".format(extract_recording(args.extract[0], args.out[0], save_format, t0, t1)))
+        return 0
 
     logging.info("CurrentViewer v{}. System: {}, Platform: {}, Machine: {}, Python: {}".format(version, platform.system(), platform.platform(), platform.machine(), platform.python_version()))
 
-    csp = CRPlot(sample_buffer=buffer_max_samples)
+    capture = None
+    if args.open or args.replay:
+        capture_file_name = (args.open or args.replay)[0]
+        try:
+            capture = CaptureFile(capture_file_name)
+        except (OSError, ValueError) as e:
+            print(f"Could not open {capture_file_name}: {e}", file=sys.stderr)
+            return -1
 
-    if csp.serialStart(port=args.port[0], speed=baud):
+    if args.open:
+        print("Loading {}...".format(capture_file_name))
+        csp = CRPlot(sample_buffer=chart_max_samples)
+        if not csp.openCapture(capture):
+            print(f"No samples in {capture_file_name}", file=sys.stderr)
+            return -1
+        if args.gui:
+            csp.chartSetup(refresh_interval=refresh_interval)
+        else:
+            for device in csp.devices():
+                print("{}{}".format("{}: ".format(device.name) if device.name else "", device.stats.report()))
+        finish_devices(csp.devices(), events_file, stats_file)
+        return 0
+
+    if metrics_file:
+        metrics.saveEvery(metrics_file, metrics_interval)
+
+    if metrics_port:
+        try:
+            metrics.serve(metrics_port)
+        except OSError as e:
+            print(f"Could not serve the metrics on port {metrics_port}: {e}", file=sys.stderr)
+            return -5
+
+    simulators = []
+    if args.simulate:
+        trace = load_trace(args.sim_trace[0]) if args.sim_trace else None
+        simulators = [SimulatedRanger(rate=max(1, args.simulate[0]), trace=trace, seed=i) for i in range(max(1, args.sim_devices[0] if args.sim_devices else 1))]
+        args.port = [simulator.start() for simulator in simulators]
+
+    # several devices: one reader thread per port, all timestamped by the shared sample clock and drawn in one chart
+    ports = list(dict.fromkeys(args.port or []))
+    names = ports if len(ports) > 1 else [None]
+
+    process = None
+    if args.connect:
+        host, _, port = args.connect[0].rpartition(':')
+        try:
+            client = StreamClient(host or "127.0.0.1", int(port))
+        except (OSError, ValueError, ConnectionError) as e:
+            print(f"Fatal: Could not connect to the stream server {args.connect[0]}: {e}", file=sys.stderr)
+            return -1
+        names = client.hello["devices"]
+        if args.out:
+            open_export(args.out[0], names if len(names) > 1 else [args.connect[0]], **export_settings())
+
+        devices = [attach_history(CRPlot(sample_buffer=buffer_max_samples, name=name, device=i)) for i, name in enumerate(names)]
+        devices[0].peers = devices[1:]
+        connected = devices[0].remoteStart(client)
+    elif capture:
+        # the devices of the capture stand in for the ports
+        names = capture.devices()
+        if args.out:
+            open_export(args.out[0], names if len(names) > 1 else [capture_file_name], **export_settings())
+
+        devices = [attach_history(CRPlot(sample_buffer=buffer_max_samples, name=name, device=i)) for i, name in enumerate(names)]
+        devices[0].peers = devices[1:]
+        connected = devices[0].replayStart(capture, args.speed[0] if args.speed else 1.0)
+    elif args.process:
+        # the acquisition process owns the ports and the export, the GUI follows its shared rings
+        rings = [SharedSampleBuffer(buffer_max_samples) for port in ports]
+        logs = (None if args.no_log else device_file_name(logfile, "acquisition"), log_size, logging_level if args.console else None)
+        context = multiprocessing.get_context('spawn')
+        stop = context.Event()
+        # the acquisition stages are measured in the other process, which sends its metrics over
+        metrics_queue = context.Queue()
+        metrics.follow(metrics_queue)
+        process = context.Process(target=acquisition_process, name="Acquisition", args=(logs, args.out[0] if args.out else None, ports, names, [ring.name for ring in rings], stop, metrics_queue,
+                                                                                   clock_origin, baud, export_settings(), trigger_settings(), state_thresholds, events_file, stats_file))
+        process.start()
+        logging.info("Acquisition process {} started".format(process.pid))
+
+        devices = [attach_history(CRPlot(sample_buffer=ring, name=name, device=i)) for i, (ring, name) in enumerate(zip(rings, names))]
+        connected = True
+        for device, port in zip(devices, ports):
+            if not device.ringStart(process):
+                print("Fatal: Could not connect to USB/BT COM port {}. Check the logs for more information".format(port), file=sys.stderr)
+                connected = False
+                break
+    else:
+        if args.out:
+            open_export(args.out[0], ports, **export_settings())
+
+        devices = [attach_history(CRPlot(sample_buffer=buffer_max_samples, name=name, device=i)) for i, name in enumerate(names)]
+        connected = True
+        for device, port in zip(devices, ports):
+            if not device.serialStart(port=port, speed=baud):
+                print("Fatal: Could not connect to USB/BT COM port {}. Check the logs for more information".format(port), file=sys.stderr)
+                connected = False
+                break
+
+    csp = devices[0]
+    csp.peers = devices[1:]
+
+    server = None
+    if connected and serve_address:
+        try:
+            server = StreamServer(devices, *serve_address, fps=serve_fps)
+            print("Streaming on {}:{}".format(*server.address[:2]))
+        except OSError as e:
+            print(f"Could not stream on {serve_address[0]}:{serve_address[1]}: {e}", file=sys.stderr)
+            connected = False
+            for device in devices:
+                device.close()
+
+    if connected:
         if args.gui:
             print("Starting live chart...")
             csp.chartSetup(refresh_interval=refresh_interval)
         else:
             print("Running with no GUI (press Ctrl-C to stop)...")
+            last_report = time.monotonic()
             try:
-                while csp.isStreaming():
+                while any(device.isStreaming() for device in devices):
                     time.sleep(0.01)
+                    if stats_interval > 0 and time.monotonic() - last_report >= stats_interval:
+                        last_report = time.monotonic()
+                        for device in devices:
+                            print("{}{}".format("{}: ".format(device.name) if device.name else "", device.stats.report()))
+                        if print_metrics:
+                            print(metrics.report())
             except KeyboardInterrupt:
                 logging.info('Terminated')
-                csp.close()
+                for device in devices:
+                    device.close()
 
+            for device in devices:
+                print("{}{}".format("{}: ".format(device.name) if device.name else "", device.stats.report()))
             print("Done.")
+
+    if server:
+        server.close()
+
+    if process:
+        # the acquisition process saves the export, events and statistics itself
+        stop.set()
+        process.join()
+        metrics.follower.join(timeout=5)
+        logging.info("Acquisition process exited with {}".format(process.exitcode))
+        for device in devices:
+            device.close()
+            device.buffer.close(unlink=True)
     else:
-        print("Fatal: Could not connect to USB/BT COM port {}. Check the logs for more information".format(args.port[0]), file=sys.stderr)
+        finish_devices(devices, events_file, stats_file)
 
-    csp.close()
+    for simulator in simulators:
+        simulator.stop()
 
-    if save_file:
-        if save_format == 'JSON':
-            save_file.write("\n]\n}\n")
-        save_file.close()
+    if not process:
+        close_export()
+
+    if metrics_file:
+        metrics.save(metrics_file)
+
+    if print_metrics:
+        print(metrics.report())
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,954 @@
+import base64
+import contextlib
+import io
+import json
+import os
+import queue
+import socket
+import struct
+import subprocess
+import sys
+import time
+from datetime import datetime
+from threading import Thread
+
+import matplotlib
+import numpy as np
+import pytest
+
+import current_viewer as cv
+
+
+# Serial port stand-in returning the scripted reads one at a time, ends the stream when they run out
+class ScriptedSerial:
+    def __init__(self, plot, reads):
+        self.plot = plot
+        self.reads = list(reads)
+        self.in_waiting = 0
+
+    def read(self, size=1):
+        if not self.reads:
+            self.plot.stream_data = False
+            return b''
+        return self.reads.pop(0)
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+
+# Clock stand-in advancing by a fixed step on every call
+class SteppingClock:
+    def __init__(self, step):
+        self.now = 1_000_000_000
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def stream(reads, clock, monkeypatch):
+    monkeypatch.setattr(cv, "clock_ns", clock)
+    plot = cv.CRPlot(sample_buffer=10000)
+    plot.serialConnection = ScriptedSerial(plot, reads)
+    plot.stream_data = True
+    with contextlib.redirect_stdout(io.StringIO()):
+        plot.serialStream()
+    return plot
+
+
+def test_timestamps_span_fragmented_reads(monkeypatch):
+    # 5000 SPS arriving every 0.5ms, every other read only brings the start of a line
+    line = b"0.000123\n"
+    reads = [line[:4], line[4:] + line*4]
+    plot = stream(reads*100, SteppingClock(500_000), monkeypatch)
+
+    timestamps, values = plot.buffer.last()
+    assert len(values) == 500
+    assert np.all(np.diff(timestamps) == 200_000)
+
+
+# File stand-in recording the size of every write
+class RecordingFile(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append(len(text))
+        return super().write(text)
+
+
+def test_export_writer_batches_per_flush_interval():
+    file = RecordingFile()
+    writer = cv.ExportWriter(file, 'CSV', flush_interval=0.2)
+    start = cv.clock_ns()
+    for i in range(100):
+        writer.write(start + np.arange(2, dtype=np.int64) + 2*i, np.full(2, 1.0e-3))
+        time.sleep(0.005)
+    writer.close()
+
+    assert writer.written_samples == 200
+    assert len(file.getvalue().splitlines()) == 200
+    # ~0.5s of 2 sample batches: a write per flush interval and the last one at close
+    assert len(file.writes) <= 4
+    # the batches collected for a flush interval are no backlog
+    assert writer.max_queue_depth <= 1
+    assert cv.metrics.snapshot()["gauges"]["export_queue_depth"] <= 1
+
+
+def test_export_writer_caps_pending_samples():
+    file = RecordingFile()
+    writer = cv.ExportWriter(file, 'CSV', flush_interval=60, max_samples=100)
+    for i in range(10):
+        writer.write(np.arange(50, dtype=np.int64) + 50*i, np.full(50, 1.0e-3))
+    writer.close()
+
+    assert len(file.writes) == 5
+
+
+def test_binary_capture_size_with_small_batches(tmp_path):
+    # one minute at 800 SPS arriving in 1-3 sample batches, flushed every second like the export writer
+    rng = np.random.default_rng(1)
+    file_name = str(tmp_path / "trickle.bin")
+    writer = cv.BinaryCaptureWriter(open(file_name, "wb"))
+    timestamps = 1_000_000_000 + np.arange(800*60, dtype=np.int64)*1_250_000
+    amps = rng.uniform(1.0e-9, 1.0e-1, len(timestamps))
+    start = 0
+    while start < len(timestamps):
+        end = min(len(timestamps), start + int(rng.integers(1, 4)))
+        writer.writeChunk(timestamps[start:end], amps[start:end])
+        if start // 800 != end // 800:
+            writer.flush()
+        start = end
+    writer.close()
+
+    # 12 bytes per float32 sample plus the chunk headers and index
+    assert os.path.getsize(file_name)/len(timestamps) < 12.2
+
+    capture = cv.BinaryCapture(file_name)
+    assert len(capture) == len(timestamps)
+    read = list(capture.chunks())
+    assert np.array_equal(np.concatenate([chunk[0] for chunk in read]), timestamps)
+    assert np.array_equal(np.concatenate([chunk[1] for chunk in read]), amps.astype(np.float32))
+
+
+def test_wakeup_navigation_steps_through_the_index():
+    matplotlib.use('Agg')
+    plot = cv.CRPlot(sample_buffer=20000)
+    plot.dataStartTS = datetime.now()
+    # 10s at 1000 SPS with 100ms wake-ups at 1, 3, 5, 7 and 9s
+    timestamps = cv.clock_ns() - 10_000_000_000 + np.arange(10000, dtype=np.int64)*1_000_000
+    amps = np.full(10000, 1.0e-7)
+    for second in range(1, 10, 2):
+        amps[second*1000:second*1000 + 100] = 5.0e-3
+    with contextlib.redirect_stdout(io.StringIO()):
+        plot.storeSamples(timestamps, amps)
+    plot.chartSetup(refresh_interval=100)
+    plot.pauseRefresh(None)
+    plot.ax.set_xlim(np.datetime64(int(timestamps[0]), 'ns'), np.datetime64(int(timestamps[500]), 'ns'))
+
+    shown = []
+    for direction in [1, 1, 1, -1, -1, -1, 1, 1, 1, 1, 1]:
+        plot.jumpToWakeup(direction)
+        shown.append(plot.ax.get_title())
+    cv.plt.close('all')
+
+    assert [title.split()[2].rstrip(':') if title.startswith('<Paused> wake-up') else None for title in shown] == \
+        ['1/5', '2/5', '3/5', '2/5', '1/5', None, '2/5', '3/5', '4/5', '5/5', None]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_stream_server_rejects_oversized_messages():
+    server = cv.StreamServer([cv.CRPlot(sample_buffer=1000)], port=0)
+    try:
+        # WebSocket frame announcing a 2^63 byte payload: closed with 1009
+        connection = socket.create_connection(server.address[:2], timeout=5)
+        connection.sendall(b"GET / HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: " +
+                           base64.b64encode(os.urandom(16)) + b"\r\nSec-WebSocket-Version: 13\r\n\r\n")
+        reply = b""
+        while not b"\r\n\r\n" in reply:
+            reply += connection.recv(1)
+        assert reply.startswith(b"HTTP/1.1 101")
+        connection.sendall(struct.pack("!BBQ", 0x81, 0x80 | 127, 1 << 63) + os.urandom(4))
+        opcode, payload = None, None
+        while opcode != 0x8:
+            opcode, payload = cv.read_websocket_frame(connection)
+        assert struct.unpack("!H", payload) == (1009,)
+        assert wait_for(lambda: len(server.clients) == 0)
+        connection.close()
+
+        # TCP subscription line that never ends
+        connection = socket.create_connection(server.address[:2], timeout=5)
+        with contextlib.suppress(OSError):
+            connection.sendall(b"x"*(cv.stream_max_request + 8192))
+        assert wait_for(lambda: len(server.clients) == 0)
+        connection.close()
+    finally:
+        server.close()
+
+
+def trigger_batches(trigger, timestamps, amps, batch=200):
+    exported = [trigger.process(timestamps[i:i + batch], amps[i:i + batch])[0] for i in range(0, len(amps), batch)]
+    return np.concatenate([part[0] for part in exported]), np.concatenate([part[1] for part in exported])
+
+
+def test_trigger_captures_pre_and_post_windows():
+    # 10s at 10k SPS with 5ms pulses at 3s and 7s
+    timestamps = 1_000_000_000 + np.arange(100000, dtype=np.int64)*100_000
+    amps = np.full(100000, 1.0e-6)
+    for second in (3, 7):
+        amps[second*10000:second*10000 + 50] = 1.0e-2
+    for kind in ('RISE', 'AVG'):
+        trigger = cv.CaptureTrigger(kind, threshold=1.0e-3, pre=1.0, post=0.5, window=0.001, summary=0)
+        exported_ts, exported_amps = trigger_batches(trigger, timestamps, amps)
+
+        # the 1ms mean stays above the threshold until the last pulse sample leaves the window
+        tail = 9 if kind == 'AVG' else 0
+        expected = np.zeros(len(timestamps), dtype=bool)
+        for second in (3, 7):
+            start, end = timestamps[second*10000], timestamps[second*10000 + 49 + tail]
+            expected |= (timestamps >= start - 1_000_000_000) & (timestamps <= end + 500_000_000)
+        assert trigger.windows == 2
+        assert np.array_equal(exported_ts, timestamps[expected])
+        assert np.array_equal(exported_amps, amps[expected])
+
+
+def test_trigger_batch_cost_does_not_grow_with_pre():
+    # 100k SPS in 200 sample batches, the ring holds 0.1s or 10s of them
+    timestamps = 1_000_000_000 + np.arange(2_000_000, dtype=np.int64)*10_000
+    amps = np.full(len(timestamps), 1.0e-6)
+    amps[-100:] = 1.0e-2
+    costs = {}
+    for pre in (0.1, 10.0):
+        trigger = cv.CaptureTrigger('AVG', threshold=1.0e-3, pre=pre, post=0.1, window=0.01, summary=0)
+        trigger_batches(trigger, timestamps[:1_200_000], amps[:1_200_000])
+        start = time.perf_counter()
+        exported_ts, _ = trigger_batches(trigger, timestamps[1_200_000:], amps[1_200_000:])
+        costs[pre] = time.perf_counter() - start
+        # the window reaches back pre seconds before the trigger
+        assert exported_ts[0] <= timestamps[-1] - int(pre*1.0e9) + 10_000_000
+    assert costs[10.0] < 3*costs[0.1]
+
+
+# File stand-in failing like a full disk after a number of writes
+class FailingFile(RecordingFile):
+    def __init__(self, writes):
+        super().__init__()
+        self.remaining = writes
+
+    def write(self, text):
+        if self.remaining == 0:
+            raise OSError(28, "No space left on device")
+        self.remaining -= 1
+        return super().write(text)
+
+
+def test_export_writer_stops_on_write_errors():
+    file = FailingFile(2)
+    writer = cv.ExportWriter(file, 'CSV', flush_interval=0.01, max_batches=4)
+    with contextlib.redirect_stderr(io.StringIO()) as stderr:
+        for i in range(20):
+            writer.write(np.arange(10, dtype=np.int64) + 10*i, np.full(10, 1.0e-3))
+            time.sleep(0.02)
+        start = time.monotonic()
+        writer.close(timeout=2.0)
+
+    assert time.monotonic() - start < 2.0
+    assert not writer.thread.is_alive()
+    assert isinstance(writer.error, OSError)
+    assert "No space left on device" in stderr.getvalue()
+    assert len(file.writes) == 2
+    assert writer.written_samples + writer.dropped_samples == 200
+
+
+# Export process stand-in whose "done" message lands just as it exits
+class ExitingProcess:
+    def __init__(self, progress):
+        self.progress = progress
+        self.exitcode = 0
+
+    def is_alive(self):
+        self.progress.put(("done",))
+        return False
+
+    def join(self):
+        pass
+
+
+def test_animation_export_done_at_exit_is_reported_saved():
+    matplotlib.use('Agg')
+    plot = cv.CRPlot(sample_buffer=1000)
+    plot.dataStartTS = datetime.now()
+    plot.chartSetup(refresh_interval=100)
+    progress = queue.Queue()
+    plot.export = (ExitingProcess(progress), progress, "chart.gif")
+    plot.export_timer = plot.ax.figure.canvas.new_timer()
+    with contextlib.redirect_stdout(io.StringIO()) as stdout, contextlib.redirect_stderr(io.StringIO()) as stderr:
+        plot.exportProgress()
+    cv.plt.close('all')
+
+    assert plot.export == None
+    assert "Animation saved to 'chart.gif'" in stdout.getvalue()
+    assert stderr.getvalue() == ""
+
+
+def test_import_leaves_heavy_modules_unloaded():
+    script = ("import sys\n"
+              "import current_viewer\n"
+              "print(' '.join(name for name in ('matplotlib', 'mplcursors', 'pandas', 'pyarrow', 'zstandard') if name in sys.modules))\n")
+    loaded = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(cv.__file__)), capture_output=True, text=True, check=True).stdout.split()
+    assert loaded == []
+
+
+def test_sample_buffer_keeps_the_last_samples_across_wraps():
+    rng = np.random.default_rng(2)
+    buffer = cv.SampleBuffer(1000)
+    timestamps = np.arange(5000, dtype=np.int64)*1000
+    amps = rng.uniform(1.0e-9, 1.0e-1, len(timestamps))
+    start = 0
+    # batches of every size up to more than the capacity, and single appends
+    while start < len(timestamps):
+        end = min(len(timestamps), start + int(rng.integers(1, 1500)))
+        if end - start == 1:
+            buffer.append(np.datetime64(int(timestamps[start]), 'ns'), amps[start])
+        else:
+            buffer.extend(timestamps[start:end], amps[start:end])
+        start = end
+
+        window_ts, window_amps = buffer.last()
+        assert len(buffer) == min(end, 1000)
+        assert np.array_equal(window_ts, timestamps[max(0, end - 1000):end])
+        assert np.array_equal(window_amps, amps[max(0, end - 1000):end])
+        assert np.array_equal(buffer.last(10)[1], amps[max(0, end - 10):end])
+    assert buffer.lastTimestamp() == np.datetime64(int(timestamps[-1]), 'ns')
+    t0, t1 = int(timestamps[4200]), int(timestamps[4700])
+    assert np.array_equal(buffer.read(t0, t1)[1], amps[4200:4701])
+
+
+def test_pyramid_query_matches_brute_force():
+    rng = np.random.default_rng(3)
+    buffer = cv.SampleBuffer(20000)
+    timestamps = np.arange(50000, dtype=np.int64)*1000
+    amps = rng.uniform(1.0e-9, 1.0e-1, len(timestamps))
+    start = 0
+    while start < len(timestamps):
+        end = min(len(timestamps), start + int(rng.integers(1, 3000)))
+        buffer.extend(timestamps[start:end], amps[start:end])
+        start = end
+
+    window_ts, window_amps = buffer.last()
+    for _ in range(50):
+        i, j = np.sort(rng.integers(0, len(window_ts), 2))
+        max_points = int(rng.integers(2, 500))
+        bucket_ts, means, mins, maxs = buffer.pyramid.query(int(window_ts[i]), int(window_ts[j]), max_points)
+
+        # every bucket reduces the samples from its timestamp to the next one (one extra sample on each side)
+        i0, i1 = max(0, i - 1), min(len(window_ts), j + 2)
+        edges = np.searchsorted(window_ts, bucket_ts.view(np.int64))
+        assert edges[0] == i0
+        assert np.all(np.diff(edges) > 0)
+        assert len(edges) <= 2*max_points + 2
+        assert np.array_equal(mins, np.minimum.reduceat(window_amps[i0:i1], edges - i0))
+        assert np.array_equal(maxs, np.maximum.reduceat(window_amps[i0:i1], edges - i0))
+        assert np.allclose(means, np.add.reduceat(window_amps[i0:i1], edges - i0)/np.diff(np.append(edges, i1)), rtol=1.0e-12)
+
+
+def test_parse_chunk_round_trip():
+    rng = np.random.default_rng(4)
+    amps = rng.uniform(1.0e-9, 1.0e-1, 2000)
+    lines = ["{:.3e}\r\n".format(amp).encode() for amp in amps.tolist()]
+    # firmware control replies and corrupted lines mixed with the samples
+    lines[100:100] = [b"USB_LOGGING_ENABLED\r\n"]
+    lines[500:500] = [b"1.2x3e-4\r\n", b"nan\r\n", b"\x00\x7f?\r\n"]
+    lines[1500:1500] = [b"USB_LOGGING_DISABLED\r\n"]
+    stream = b"".join(lines)
+
+    # the stream cut at arbitrary points, each chunk starting with the remainder of the previous one
+    values, control, invalid = [], [], []
+    remainder = b""
+    for start, end in zip([0] + list(range(7, len(stream), 977)), list(range(7, len(stream), 977)) + [len(stream)]):
+        chunk_values, chunk_control, chunk_invalid, remainder = cv.parse_chunk(remainder + stream[start:end])
+        values.append(chunk_values)
+        control += chunk_control
+        invalid += chunk_invalid
+
+    assert remainder == b""
+    assert np.array_equal(np.concatenate(values), np.array(["{:.3e}".format(amp) for amp in amps.tolist()], dtype=np.float64))
+    assert control == [b"USB_LOGGING_ENABLED\r", b"USB_LOGGING_DISABLED\r"]
+    assert invalid == [b"1.2x3e-4\r", b"\x00\x7f?\r", b"nan"]
+
+    values, control, invalid, remainder = cv.parse_chunk(b"1.0e-3\r\n2.0e-3\r\n3.0e")
+    assert values.tolist() == [1.0e-3, 2.0e-3] and control == [] and invalid == []
+    assert remainder == b"3.0e"
+
+
+def test_stream_stats_match_the_whole_capture():
+    rng = np.random.default_rng(5)
+    timestamps = 1_000_000_000 + np.cumsum(rng.integers(900_000, 1_100_000, 20000)).astype(np.int64)
+    amps = 10.0**rng.uniform(-8, -1, len(timestamps))
+    stats = cv.StreamStats()
+    start = 0
+    while start < len(timestamps):
+        end = min(len(timestamps), start + int(rng.integers(1, 500)))
+        stats.update(timestamps[start:end], amps[start:end])
+        start = end
+
+    assert stats.count == len(amps)
+    assert np.isclose(stats.mean(), amps.mean())
+    assert stats.min == amps.min() and stats.max == amps.max()
+    assert np.isclose(stats.duration(), (timestamps[-1] - timestamps[0])/1.0e9)
+    # trapezoidal charge in A.s, reported in mAh
+    dt = np.diff(timestamps)/1.0e9
+    assert np.isclose(stats.chargeMah(), np.sum((amps[1:] + amps[:-1])*dt)/2*1000/3600)
+    for q in (0.01, 0.5, 0.99):
+        exact = np.sort(amps)[int(q*(len(amps) - 1))]
+        assert abs(stats.quantile(q) - exact) <= 2*stats.quantile_accuracy*exact
+    # each sample holds its value until the next one
+    decades = np.floor(np.log10(amps[:-1])).astype(int)
+    for k in range(-8, -1):
+        assert np.isclose(stats.time_at_current[k - int(stats.decades[0]) + 1], dt[decades == k].sum())
+    assert np.isclose(stats.time_at_current.sum(), stats.duration())
+
+
+def test_segment_recording_write_read_and_index(tmp_path):
+    # 35s at 1000 SPS in 10s segments, from 5s into a slot
+    timestamps = 1_700_000_005_000_000_000 + np.arange(35000, dtype=np.int64)*1_000_000
+    amps = np.random.default_rng(6).uniform(1.0e-9, 1.0e-1, len(timestamps))
+    formats = ['CSV.GZ'] + (['CSV.ZST'] if cv.import_zstandard() else []) + (['PARQUET'] if cv.import_parquet() else [])
+    for fmt in formats:
+        directory = str(tmp_path / fmt)
+        writer = cv.SegmentWriter(directory, fmt, max_seconds=10)
+        writer.block_samples = 2000
+        for start in range(0, len(timestamps), 700):
+            writer.writeChunk(timestamps[start:start + 700], amps[start:start + 700])
+        writer.close()
+
+        recording = cv.Recording(directory)
+        expected = amps.astype(np.float32).astype(np.float64) if fmt == 'PARQUET' else amps
+        assert len(recording) == 4
+        assert [entry["samples"] for entry in recording.index] == [5000, 10000, 10000, 10000]
+        assert [entry["first"] for entry in recording.index] == [int(timestamps[i]) for i in (0, 5000, 15000, 25000)]
+        assert [entry["last"] for entry in recording.index] == [int(timestamps[i]) for i in (4999, 14999, 24999, 34999)]
+        assert all(entry["blocks"][-1][2] == entry["last"] for entry in recording.index)
+        read_ts, read_amps, devices = recording.read()
+        # pandas' fast float parser is not correctly rounded (~1e-12 relative)
+        assert np.array_equal(read_ts, timestamps) and np.allclose(read_amps, expected, rtol=1.0e-9, atol=0) and devices is None
+
+        # a range only reads the segments (and CSV blocks) it overlaps
+        t0, t1 = int(timestamps[12345]), int(timestamps[16789])
+        assert [entry["first"] for entry in recording.segments(t0, t1)] == [int(timestamps[5000]), int(timestamps[15000])]
+        read_ts, read_amps, _ = recording.read(t0, t1)
+        assert np.array_equal(read_ts, timestamps[12345:16790]) and np.allclose(read_amps, expected[12345:16790], rtol=1.0e-9, atol=0)
+
+        # a segment left open (power loss) is not indexed but still read
+        later = timestamps[-1] + 1_000_000 + np.arange(3000, dtype=np.int64)*1_000_000
+        writer = cv.SegmentWriter(directory, fmt, max_seconds=10)
+        writer.writeChunk(later, np.full(3000, 1.0e-3))
+        writer.writeBlock()
+        if fmt != 'PARQUET':
+            writer.file.flush()
+            recording = cv.Recording(directory)
+            assert len(recording) == 5 and recording.index[-1]["file"].endswith(".part")
+            assert np.array_equal(recording.read(int(later[0]))[0], later)
+        writer.close()
+
+        # two devices flushed together, B 5ms behind A: the blocks hold both and B crosses the slots last
+        directory = str(tmp_path / (fmt + "-devices"))
+        writer = cv.SegmentWriter(directory, fmt, devices=["A", "B"], max_seconds=10)
+        writer.block_samples = 2000
+        for start in range(0, len(timestamps), 700):
+            writer.writeChunk(timestamps[start:start + 700], amps[start:start + 700], 0)
+            writer.writeChunk(timestamps[start:start + 700] - 5_000_000, amps[start:start + 700], 1)
+        writer.close()
+
+        recording = cv.Recording(directory)
+        assert len(recording) == 4
+        assert sum(entry["samples"] for entry in recording.index) == 2*len(timestamps)
+        assert recording.index[0]["first"] == int(timestamps[0]) - 5_000_000
+        for device, offset in (("A", 0), ("B", 5_000_000)):
+            read_ts, read_amps, devices = recording.read()
+            assert np.array_equal(np.sort(read_ts[devices == device]), timestamps - offset)
+        # samples of B before the first sample of A
+        read_ts, _, devices = recording.read(None, int(timestamps[0]) - 3_000_000)
+        assert devices.tolist() == ["B"]*3
+        # B's samples just before a slot boundary, written after A opened the next segment
+        t0, t1 = int(timestamps[14990]), int(timestamps[15010])
+        read_ts, _, devices = recording.read(t0, t1)
+        assert np.sum(devices == "A") == 21 and np.sum(devices == "B") == 21
+
+
+def test_history_tier_keeps_the_evicted_samples(tmp_path):
+    rng = np.random.default_rng(7)
+    buffer = cv.SampleBuffer(10000)
+    # room for 3 blocks of 4096 samples, the oldest are overwritten
+    buffer.history = cv.SampleHistory(str(tmp_path / "history.bin"), 3*4096*cv.SampleHistory.record_dtype.itemsize)
+    timestamps = np.arange(40000, dtype=np.int64)*1_000_000
+    amps = rng.uniform(1.0e-9, 1.0e-1, len(timestamps))
+    start = 0
+    while start < len(timestamps):
+        end = min(len(timestamps), start + int(rng.integers(1, 15000)))
+        buffer.extend(timestamps[start:end], amps[start:end])
+        start = end
+
+    oldest = 30000 - buffer.history.capacity
+    read_ts, read_amps = buffer.read(int(timestamps[0]), int(timestamps[-1]))
+    assert np.array_equal(read_ts, timestamps[oldest:]) and np.array_equal(read_amps, amps[oldest:])
+    read_ts, read_amps = buffer.read(int(timestamps[20000]), int(timestamps[32000]))
+    assert np.array_equal(read_ts, timestamps[20000:32001]) and np.array_equal(read_amps, amps[20000:32001])
+
+    # whole-block buckets from the block summaries plus the partial blocks at both ends, checked like the pyramid
+    history_ts, history_amps = timestamps[oldest:30000], amps[oldest:30000]
+    for i, j, max_points in ((0, len(history_ts) - 1, 2), (100, 12000, 8), (5000, 6000, 64)):
+        bucket_ts, means, mins, maxs = buffer.history.query(int(history_ts[i]), int(history_ts[j]), max_points)
+        edges = np.searchsorted(history_ts, bucket_ts.view(np.int64))
+        assert edges[0] == i
+        assert np.array_equal(mins, np.minimum.reduceat(history_amps[i:j + 1], edges - i))
+        assert np.array_equal(maxs, np.maximum.reduceat(history_amps[i:j + 1], edges - i))
+        assert np.allclose(means, np.add.reduceat(history_amps[i:j + 1], edges - i)/np.diff(np.append(edges, j + 1)), rtol=1.0e-12)
+    buffer.history.close()
+    assert not os.path.exists(str(tmp_path / "history.bin"))
+
+
+def test_shared_ring_poll_counts_lost_and_torn_samples():
+    writer = cv.SharedSampleBuffer(1000, pyramid=False)
+    reader = cv.SharedSampleBuffer(name=writer.name, pyramid=False)
+    try:
+        timestamps = np.arange(10000, dtype=np.int64)*1000
+        amps = np.arange(10000, dtype=np.float64)
+
+        writer.extend(timestamps[:300], amps[:300])
+        assert reader.lag() == 300
+        read_ts, read_amps, lost = reader.poll()
+        assert np.array_equal(read_ts, timestamps[:300]) and np.array_equal(read_amps, amps[:300]) and lost == 0
+        assert reader.lag() == 0
+
+        # the reader falls more than a ring behind: only the last capacity samples are left
+        for start in range(300, 2800, 500):
+            writer.extend(timestamps[start:start + 500], amps[start:start + 500])
+        assert reader.lag() == 2500
+        read_ts, read_amps, lost = reader.poll()
+        assert np.array_equal(read_amps, amps[1800:2800]) and lost == 1500
+
+        # the writer announced 300 more samples while the reader copied 900: the oldest 200 may be torn
+        writer.extend(timestamps[2800:3700], amps[2800:3700])
+        writer.header[cv.SharedSampleBuffer.WRITING] = 4000
+        read_ts, read_amps, lost = reader.poll()
+        assert np.array_equal(read_amps, amps[3000:3700]) and lost == 200
+        assert reader.lost == 1700
+
+        # the returned samples are copies, later writes do not change them
+        writer.extend(timestamps[3700:4700], amps[3700:4700])
+        assert np.array_equal(read_amps, amps[3000:3700])
+    finally:
+        reader.close()
+        writer.close(unlink=True)
+
+
+# stands in for the GUI process of --process: starts the acquisition process on the simulated port, waits for
+# it to stream and then dies without stopping it
+crashing_gui = """
+import os, signal, sys, time, multiprocessing
+import current_viewer as cv
+
+if __name__ == '__main__':
+    port, out, stats = sys.argv[1:4]
+    ring = cv.SharedSampleBuffer(10000)
+    context = multiprocessing.get_context('spawn')
+    stop, metrics_queue = context.Event(), context.Queue()
+    process = context.Process(target=cv.acquisition_process, args=((None, 0, None), out, [port], [None], [ring.name], stop, metrics_queue,
+                                                                   cv.clock_origin, cv.baud, dict(cv.export_settings(), fmt="CSV"), None, cv.state_thresholds, None, stats))
+    process.start()
+    deadline = time.monotonic() + 20
+    while ring.state() == cv.SharedSampleBuffer.STARTING and time.monotonic() < deadline:
+        time.sleep(0.01)
+    print(process.pid, ring.state(), flush=True)
+    time.sleep(0.5)
+    os.kill(os.getpid(), signal.SIGKILL)
+"""
+
+
+def test_acquisition_process_closes_the_capture_when_the_gui_dies(tmp_path):
+    simulator = cv.SimulatedRanger(rate=1000, seed=1, corrupt_rate=0.0)
+    port = simulator.start()
+    out, stats = str(tmp_path / "capture.csv"), str(tmp_path / "stats.json")
+    try:
+        gui = subprocess.run([sys.executable, "-c", crashing_gui, port, out, stats], cwd=os.path.dirname(os.path.abspath(cv.__file__)),
+                             capture_output=True, text=True, timeout=60)
+        pid, state = map(int, gui.stdout.split()[-2:])
+        assert state == cv.SharedSampleBuffer.STREAMING
+        # the orphaned acquisition process notices, saves the statistics, closes the export and exits
+        assert wait_for(lambda: os.path.exists(stats), timeout=20)
+        with open(stats) as f:
+            assert json.load(f)["samples"] > 0
+        assert wait_for(lambda: not os.path.exists("/proc/{}".format(pid)) or open("/proc/{}/stat".format(pid)).read().split()[2] == "Z", timeout=20)
+        with open(out) as f:
+            assert len(f.read().splitlines()) > 1
+    finally:
+        simulator.stop()
+
+
+def test_connected_viewer_sps_with_a_skewed_server_clock():
+    # the server's clock is 5s behind the viewer's
+    source = cv.CRPlot(sample_buffer=100000)
+    server = cv.StreamServer([source], port=0, fps=30)
+    viewer = cv.CRPlot(sample_buffer=100000)
+    try:
+        viewer.stream_data = True
+        viewer.remoteStart(cv.StreamClient(*server.address[:2]))
+        for _ in range(40):
+            now = cv.clock_ns() - 5_000_000_000
+            source.buffer.extend(now - 50_000_000 + np.arange(1, 51, dtype=np.int64)*1_000_000, np.full(50, 1.0e-3))
+            time.sleep(0.05)
+        assert 500 < viewer.sps() < 2000
+        assert abs(viewer.clock_offset - 5_000_000_000) < 500_000_000
+    finally:
+        viewer.stream_data = False
+        viewer.thread.join(timeout=10)
+        server.close()
+
+
+# Subscriber stand-in recording the messages published to it
+class RecordingSubscriber:
+    def __init__(self, points, window=0.0, frames=True, raw=False):
+        self.subscription = {"points": points, "window": window, "frames": frames, "raw": raw}
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+
+def test_stream_frames_are_encoded_once_per_resolution(monkeypatch):
+    device = cv.CRPlot(sample_buffer=10000)
+    server = cv.StreamServer([device], port=0, fps=1)
+    server.running = False
+    try:
+        encoded = []
+        encode_frame = cv.encode_frame
+        monkeypatch.setattr(cv, "encode_frame", lambda *args: encoded.append(args[1]) or encode_frame(*args))
+        subscribers = [RecordingSubscriber(100), RecordingSubscriber(100), RecordingSubscriber(500), RecordingSubscriber(100, 1.0)]
+        device.buffer.extend(np.arange(5000, dtype=np.int64)*1_000_000, np.full(5000, 1.0e-3))
+        server.publish(0, device, subscribers)
+
+        assert len(encoded) == 3
+        assert all(len(subscriber.messages) == 1 for subscriber in subscribers)
+        assert subscribers[0].messages[0] is subscribers[1].messages[0]
+        assert len({id(subscriber.messages[0]) for subscriber in subscribers}) == 3
+    finally:
+        server.close()
+
+
+def test_slow_stream_client_does_not_hold_back_the_others():
+    device = cv.CRPlot(sample_buffer=1_000_000)
+    server = cv.StreamServer([device], port=0, fps=100)
+    # subscribes to every sample and never reads
+    slow = socket.create_connection(server.address[:2])
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    slow.sendall(b'{"raw": true, "frames": false}\n')
+    client = cv.StreamClient(*server.address[:2])
+    dropped = cv.metrics.snapshot()["counters"].get("stream_dropped_messages_total", 0)
+    received = []
+
+    def receive():
+        while True:
+            try:
+                message = client.receive()
+            except OSError:
+                break
+            if message and message[0] == "raw":
+                received.append(len(message[1][3]))
+
+    Thread(target=receive, daemon=True).start()
+    try:
+        assert wait_for(lambda: len(server.clients) == 2 and all(c.subscription for c in server.clients))
+        total = 0
+        for k in range(200):
+            device.buffer.extend(k*100_000_000 + np.arange(20_000, dtype=np.int64)*1000, np.full(20_000, 1.0e-3))
+            total += 20_000
+            time.sleep(0.01)
+
+        # the fast client gets every sample while the slow one drops messages
+        assert wait_for(lambda: sum(received) == total, timeout=20)
+        assert server.published[0] == device.buffer.count
+        assert cv.metrics.snapshot()["counters"]["stream_dropped_messages_total"] > dropped
+    finally:
+        client.close()
+        slow.close()
+        server.close()
+
+
+def test_minmax_decimation_keeps_every_bucket_extreme():
+    rng = np.random.default_rng(8)
+    timestamps = np.arange(10007, dtype=np.int64)*1000
+    amps = rng.uniform(1.0e-7, 1.0e-6, len(timestamps))
+    # single sample spikes that a strided decimation skips
+    spikes = rng.choice(len(amps), 20, replace=False)
+    amps[spikes] = 1.0e-2
+    for max_points in (7, 100, 2048, 20000):
+        bucket_ts, means, mins, maxs = cv.decimate_minmax(timestamps, amps, max_points)
+        assert len(bucket_ts) <= max_points
+        edges = np.searchsorted(timestamps, bucket_ts.view(np.int64))
+        assert edges[0] == 0
+        assert np.array_equal(mins, np.minimum.reduceat(amps, edges)) and np.array_equal(maxs, np.maximum.reduceat(amps, edges))
+        assert np.allclose(means, np.add.reduceat(amps, edges)/np.diff(np.append(edges, len(amps))))
+        assert np.sum(maxs == 1.0e-2) == len(np.unique(np.searchsorted(edges, spikes, side='right')))
+
+
+# LTTB one bucket at a time, with the previous bucket's selected point approximated by its mean like decimate_lttb
+def reference_lttb(ts, data, max_points):
+    n = len(data)
+    width = -(-(n - 2) // (max_points - 2))
+    x = (ts - ts[0]).astype(np.float64)
+    y = np.log10(np.maximum(data, 1.0e-12))
+    buckets = [np.arange(start, min(start + width, n - 1)) for start in range(1, n - 1, width)]
+    selected = [0]
+    for b, bucket in enumerate(buckets):
+        ax, ay = (x[0], y[0]) if b == 0 else (x[buckets[b - 1]].mean(), y[buckets[b - 1]].mean())
+        cx, cy = (x[n - 1], y[n - 1]) if b == len(buckets) - 1 else (x[buckets[b + 1]].mean(), y[buckets[b + 1]].mean())
+        area = [abs((ax - cx)*(y[i] - ay) - (ax - x[i])*(cy - ay)) for i in bucket]
+        selected.append(int(bucket[int(np.argmax(area))]))
+    selected.append(n - 1)
+    return ts[selected], data[selected]
+
+
+def test_lttb_matches_a_reference_loop():
+    rng = np.random.default_rng(9)
+    for n, max_points in ((100, 10), (257, 17), (1000, 64), (50, 100)):
+        timestamps = np.cumsum(rng.integers(1, 1000, n)).astype(np.int64)
+        amps = 10.0**rng.uniform(-9, -2, n)
+        bucket_ts, samples = cv.decimate_lttb(timestamps, amps, max_points)
+        assert len(samples) <= max_points
+        if n <= max_points:
+            assert np.array_equal(samples, amps)
+            continue
+        expected_ts, expected = reference_lttb(timestamps, amps, max_points)
+        assert np.array_equal(bucket_ts.view(np.int64), expected_ts) and np.array_equal(samples, expected)
+
+
+# 4s at 1000 SPS from devices A and B, written like the export writer does: per flush a batch of A and then
+# one of B that is a second behind, so the blocks are not in time order
+def capture_fixture(tmp_path, fmt):
+    rng = np.random.default_rng(10)
+    samples = {name: (1_700_000_000_000_000_000 + offset + np.arange(4000, dtype=np.int64)*1_000_000, 10.0**rng.uniform(-8, -2, 4000))
+               for name, offset in (("A", 1_000_000_000), ("B", 0))}
+    file_name = str(tmp_path / ("capture." + fmt.lower()))
+    if fmt == 'BIN':
+        writer = cv.BinaryCaptureWriter(open(file_name, "wb"), np.float64)
+        for k in range(0, 4000, 1000):
+            for device, name in enumerate(("A", "B")):
+                writer.writeChunk(samples[name][0][k:k + 1000], samples[name][1][k:k + 1000], device)
+            writer.flush()
+        writer.close()
+        return file_name, {str(device): samples[name] for device, name in enumerate(("A", "B"))}
+    with open(file_name, "w") as f:
+        f.write(cv.csv_header(True))
+        for k in range(0, 4000, 1000):
+            for name in ("A", "B"):
+                f.write(cv.format_samples(samples[name][0][k:k + 1000], samples[name][1][k:k + 1000], 'CSV', device=name))
+    return file_name, samples
+
+
+def test_open_capture_overview_and_statistics(tmp_path):
+    for fmt in ('CSV', 'BIN'):
+        file_name, samples = capture_fixture(tmp_path, fmt)
+        capture = cv.CaptureFile(file_name)
+        plot = cv.CRPlot(sample_buffer=1)
+        assert plot.openCapture(capture)
+
+        devices = {device.name: device for device in plot.devices()}
+        assert sorted(devices) == sorted(samples)
+        for name, (timestamps, amps) in samples.items():
+            device = devices[name]
+            assert device.sample_count == len(amps) and device.stats.count == len(amps)
+            assert np.isclose(device.stats.mean(), amps.mean()) and np.isclose(device.stats.max, amps.max())
+            dt = np.diff(timestamps)/1.0e9
+            assert np.isclose(device.stats.chargeMah(), np.sum((amps[1:] + amps[:-1])*dt)/2*1000/3600)
+
+            bucket_ts, means, mins, maxs = device.overview.query()
+            edges = np.searchsorted(timestamps, bucket_ts.view(np.int64))
+            assert edges[0] == 0 and len(bucket_ts) < 2*cv.chart_max_samples
+            assert np.allclose(mins, np.minimum.reduceat(amps, edges)) and np.allclose(maxs, np.maximum.reduceat(amps, edges))
+            assert np.allclose(means, np.add.reduceat(amps, edges)/np.diff(np.append(edges, len(amps))))
+
+        # a range in the first second only holds samples of B, written after the A samples of each block
+        t0, t1 = int(samples[plot.name][0][0]) - 1_000_000_000, int(samples[plot.name][0][0]) - 500_000_000
+        read_ts, read_amps, names = capture.read(min(t0, t1), max(t0, t1))
+        expected = {name: np.sum((timestamps >= t0) & (timestamps <= t1)) for name, (timestamps, amps) in samples.items()}
+        assert {name: np.sum(names == name) for name in samples} == expected
+
+
+def test_replay_releases_devices_in_time_order(tmp_path, monkeypatch):
+    file_name, samples = capture_fixture(tmp_path, 'CSV')
+    capture = cv.CaptureFile(file_name)
+    devices = [cv.CRPlot(sample_buffer=10000, name=name, device=i) for i, name in enumerate(capture.devices())]
+    devices[0].peers = devices[1:]
+    released = []
+    store = cv.CRPlot.storeSamples
+    monkeypatch.setattr(cv.CRPlot, "storeSamples", lambda self, timestamps, values: released.append((self.name, timestamps.copy())) or store(self, timestamps, values))
+    with contextlib.redirect_stdout(io.StringIO()):
+        devices[0].replayStart(capture, speed=10.0)
+        devices[0].thread.join(timeout=10)
+    assert not devices[0].thread.is_alive()
+
+    # re-timestamped on the live clock, in playback order across both devices (each 20ms playback slice is
+    # released one device after the other)
+    starts = np.array([int(timestamps[0]) for _, timestamps in released])
+    assert np.all(np.diff(starts) > -20_000_000)
+    for device in devices:
+        timestamps, values = device.buffer.last()
+        assert np.allclose(values, np.maximum(samples[device.name][1], 1.0e-11), rtol=1.0e-9)
+        assert np.all(np.diff(timestamps) > 0)
+
+
+def test_multi_device_export_round_trip(tmp_path, monkeypatch):
+    ports = ["/dev/ttyACM0", "/dev/ttyACM1"]
+    rng = np.random.default_rng(11)
+    # 3s at 1000 SPS from both devices, arriving in 50 sample batches, the second device 3ms behind
+    samples = [(1_700_000_000_000_000_000 - 3_000_000*i + np.arange(3000, dtype=np.int64)*1_000_000, 10.0**rng.uniform(-8, -2, 3000)) for i in range(2)]
+    for fmt in ('CSV', 'JSON', 'BIN64', 'CSV.GZ'):
+        for name in ("save_file", "export_writer", "summary_writer"):
+            monkeypatch.setattr(cv, name, None)
+        out = str(tmp_path / ("capture-" + fmt.lower().replace('.', '-') + ("" if fmt in cv.segment_formats else "." + fmt[:3].lower())))
+        stats = str(tmp_path / (fmt + "-stats.json"))
+        cv.open_export(out, ports, fmt, flush_interval=0.01, max_batches=1024, segment_bytes=1 << 20, segment_seconds=3600, summaries=False)
+        devices = [cv.CRPlot(sample_buffer=10000, name=port, device=i) for i, port in enumerate(ports)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for device in devices:
+                device.dataStartTS = datetime.now()
+            for start in range(0, 3000, 50):
+                for device, (timestamps, amps) in zip(devices, samples):
+                    device.storeSamples(timestamps[start:start + 50], amps[start:start + 50])
+            cv.finish_devices(devices, None, stats)
+            cv.close_export()
+        assert cv.export_writer.written_samples == 6000
+
+        # the device column (or BIN device index) brings every sample back to its device
+        capture = cv.CaptureFile(out)
+        names = capture.devices()
+        assert names == (["0", "1"] if fmt == 'BIN64' else ports)
+        timestamps, amps, devices_read = (np.concatenate(column) if column[0] is not None else None for column in zip(*capture.chunks()))
+        for name, (expected_ts, expected_amps) in zip(names, samples):
+            mask = devices_read == name
+            assert np.array_equal(timestamps[mask], expected_ts)
+            assert np.allclose(amps[mask], expected_amps, rtol=1.0e-9, atol=0)
+
+        # one statistics file per device
+        for port, (expected_ts, expected_amps) in zip(ports, samples):
+            with open(cv.device_file_name(stats, port)) as f:
+                summary = json.load(f)
+            assert summary["samples"] == 3000 and np.isclose(summary["mean_a"], expected_amps.mean())
+
+
+def test_animation_gets_a_bounded_snapshot(tmp_path):
+    buffer = cv.SampleBuffer(400_000)
+    timestamps = np.arange(400_000, dtype=np.int64)*100_000
+    amps = np.full(len(timestamps), 1.0e-6)
+    amps[123_457] = 5.0e-2
+    buffer.extend(timestamps, amps)
+
+    # large buffers are reduced to min/max buckets that keep the spikes
+    snapshot_ts, means, mins, maxs, sps = cv.CRPlot.animationPoints(buffer)
+    assert len(snapshot_ts) <= 2*cv.animation_points + 2
+    assert snapshot_ts.dtype == np.int64 and snapshot_ts[0] == timestamps[0]
+    assert maxs.max() == 5.0e-2 and mins.min() == 1.0e-6
+    assert np.isclose(sps, 10000)
+    # small ones are sent as they are
+    small = cv.SampleBuffer(1000)
+    small.extend(timestamps[:1000], amps[:1000])
+    small_ts, small_means, small_mins, small_maxs, _ = cv.CRPlot.animationPoints(small)
+    assert np.array_equal(small_ts, timestamps[:1000]) and np.array_equal(small_maxs, amps[:1000])
+
+    progress = queue.Queue()
+    file_name = str(tmp_path / "chart.gif")
+    cv.render_animation([("A", snapshot_ts, means, mins, maxs, sps, 0.0)], file_name, 'GIF', 30, 3, 'MINMAX', 512, progress)
+    messages = []
+    while not progress.empty():
+        messages.append(progress.get())
+    assert messages[-1] == ("done", file_name)
+    assert [message[1] for message in messages[:-1]] == [1, 2, 3]
+    assert os.path.getsize(file_name) > 0
+
+
+# Feeds 100ms of 1000 SPS per frame and records the x range, full draws and blits of every frame
+def chart_frames(blit, monkeypatch, frames=40):
+    matplotlib.use('Agg')
+    monkeypatch.setattr(cv, "chart_blit", blit)
+    plot = cv.CRPlot(sample_buffer=2000)
+    plot.dataStartTS = datetime.now()
+    plot.chartSetup(refresh_interval=100)
+    plot.stream_data = True
+    canvas = plot.ax.figure.canvas
+    calls = {"draw": 0, "blit": 0}
+    draw, blit_region = canvas.draw, canvas.blit
+
+    def counting_draw(*args, **kwargs):
+        calls["draw"] += 1
+        return draw(*args, **kwargs)
+
+    def counting_blit(*args, **kwargs):
+        calls["blit"] += 1
+        return blit_region(*args, **kwargs)
+
+    monkeypatch.setattr(canvas, "draw", counting_draw)
+    monkeypatch.setattr(canvas, "blit", counting_blit)
+
+    start = cv.clock_ns() - frames*100_000_000
+    shown = []
+    for frame in range(frames):
+        with contextlib.redirect_stdout(io.StringIO()):
+            plot.storeSamples(start + (frame*100 + np.arange(100, dtype=np.int64))*1_000_000, np.full(100, 1.0e-3))
+        plot.refreshChart()
+        window_ts, _ = plot.buffer.last()
+        limits = tuple(matplotlib.dates.num2date(limit).timestamp() for limit in plot.ax.get_xlim())
+        shown.append((int(window_ts[0]), int(window_ts[-1]), plot.xlim[0], plot.xlim[1], limits, dict(calls)))
+    blitting = plot.blit
+    cv.plt.close('all')
+    return blitting, shown
+
+
+def test_blit_pages_the_x_axis_with_headroom(monkeypatch):
+    blitting, shown = chart_frames(True, monkeypatch)
+    assert blitting
+
+    pages = 0
+    for i, (first, last, left, right, limits, calls) in enumerate(shown):
+        # the axis shows the page, and the page holds all the data with 25% headroom over the data span
+        assert limits == (pytest.approx(left/1e9, abs=1e-3), pytest.approx(right/1e9, abs=1e-3))
+        assert left <= first and last <= right
+        span = max(last - first, 1_000_000_000)
+        moved = i == 0 or (left, right) != shown[i - 1][2:4]
+        if moved:
+            pages += 1
+            assert (left, right) == (first, first + span + span//4)
+        else:
+            # the page only moves when the data leaves it
+            assert shown[i - 1][1] <= right
+        # a new page is drawn in full, every other frame is blitted over the cached background
+        assert calls["draw"] == pages
+        assert calls["blit"] == i + 1 - pages
+    assert 1 < pages < len(shown)//4
+    # the window filled up and slid, and the page followed it
+    assert shown[-1][0] > shown[0][0] and shown[-1][2] > shown[0][2]
+
+
+def test_no_blit_falls_back_to_a_full_draw(monkeypatch):
+    blitting, shown = chart_frames(False, monkeypatch)
+    assert not blitting
+
+    for i, (first, last, left, right, limits, calls) in enumerate(shown):
+        # the axis follows the data exactly and every frame is a full draw
+        assert (left, right) == (first, last)
+        assert limits == (pytest.approx(first/1e9, abs=1e-3), pytest.approx(last/1e9, abs=1e-3))
+        assert calls == {"draw": i + 1, "blit": 0}